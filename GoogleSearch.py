@@ -1,12 +1,12 @@
 from serpapi import GoogleSearch
-from bs4 import BeautifulSoup
 from dotenv import load_dotenv
 from datetime import datetime, timedelta
 import csv
 import os
-import requests
 import openai
-import threading
+import article_fetcher
+import llm_verdict
+import text_chunker
 
 list_states = {
     "AK": "Alaska", "AL": "Alabama", "AR": "Arkansas", "AZ": "Arizona",
@@ -134,7 +134,7 @@ def helper(query, county, state, start, end, csv_path1, csv_path2, csv_path3, da
                     
                     elif text is not None and len(text) > 5000:
                         text = text.lower()
-                        text = shorten_text(text)
+                        text = shorten_text(text, county, state, start, end)
 
                     else:
                         text = text.lower()
@@ -225,38 +225,15 @@ def helper(query, county, state, start, end, csv_path1, csv_path2, csv_path3, da
         print(f"Error during search or file writing: {e}")
 
 
-# helper function to reduce text from scraped results
-def shorten_text(text):
-    new_text = text[:88888]
-    return new_text
+# helper function to reduce text from scraped results to the passages most relevant to the search
+def shorten_text(text, county=None, state=None, start=None, end=None):
+    return text_chunker.select_passages(text, county, state, start, end, text_chunker.token_budget("gpt-4-turbo"),
+                                        "gpt-4-turbo").text
 
 
 # helper function to scrape text of links from google search api results
-def scrape_article_text(url, timeout=8):  # puts a timer of 15 seconds total
-    class ContentFetcher(threading.Thread):
-        def __init__(self, url):
-            super().__init__()
-            self.url = url
-            self.result = None
-
-        def run(self):
-            try:
-                response = requests.get(self.url, timeout=6)  # ensures the request itself also respects a timeout
-                if response.status_code == 200:
-                    soup = BeautifulSoup(response.text, 'html.parser')
-                    self.result = soup.get_text(separator=' ', strip=True)
-            except Exception as e:
-                print(f"Error scraping {self.url}: {e}")
-                self.result = None
-
-    fetcher = ContentFetcher(url)
-    fetcher.start()
-    fetcher.join(timeout)
-    if fetcher.is_alive():
-        fetcher.result = False  # indicate a timeout happened
-        fetcher.join()  # ensure the thread finishes
-
-    return fetcher.result  # returns scraped text if success, None if error with scraping, or False if over time limit
+def scrape_article_text(url, timeout=8):
+    return article_fetcher.fetch_article_text(url, timeout)  # checks the local article store first, returns scraped text if success, None if error with scraping, or False if over time limit
 
 
 # helper function to check validity of the links
@@ -264,47 +241,29 @@ def analyze_with_chatgpt(text, state, location, start, end):
     openai.api_key = open_ai_key
     # print(date, location)
 
-    # questions we ask gpt to check
-    questions = [
-        f"Here are four questions, please answer them all.\
-        \n1. Does this text mention {location} or {state}? Explicitly say yes or no in the first word of your response along with your explanation.\
-        \n2. Is the text related to immigration raids/arrests? Explicitly say yes or no in the first word of your response along with your explanation.\
-        \n3. Does this text mention the date and is the date of this immigration raid between {start} and {end}? Explicitly say yes or no in the first word of your response along with your explanation.\
-        \n4. Does this text confirm that the raid was conducted by Immigration and Customs Enforcement? Explicitly say yes or no in the first word of your response along with your explanation."
-
-
-        # number of arrests that occured in this specific {county} if mention
-        # total arrests of this immigration raid if mention
-        # list the city in this immigration raid
-        # list the county name
-        # target 12345
-        # how many of them have previous conviction
-        # how many female if mention
-        # what are the nationality of those people in this specific {county}
-    ]
-        
-    # res = []
-    for question in questions:
-        response = openai.ChatCompletion.create(
-            model="gpt-4-turbo",
-            messages=[
-                {"role": "system", "content": "Analyze the provided text for specific information."},
-                {"role": "user", "content": text},
-                {"role": "user", "content": question}
-            ]
-        )
-        # print(question + ":")
-        answer = response['choices'][0]['message']['content'].strip().lower() # grab the response from gpt for the question
-        # words = answer.split()  # Split the response into words
-        # print(answer + "\n")  # for debugging
-        if "no." in answer or "no," in answer or "no " in answer or "no*" in answer:
-            return False, answer
-    
-    # no longer need this since we only have one question
-    # for item in res:
-    #     if item == False:  # mark link as invalid if any of the gpt questions did not pass
-    #         return False
-    return True, answer
+    # questions we ask gpt to check, answered as json (see llm_verdict) so that a "no" inside an explanation cannot reject the link
+    question = f"Here are four questions, please answer them all.\
+        \n1. Does this text mention {location} or {state}?\
+        \n2. Is the text related to immigration raids/arrests?\
+        \n3. Does this text mention the date and is the date of this immigration raid between {start} and {end}?\
+        \n4. Does this text confirm that the raid was conducted by Immigration and Customs Enforcement?\
+        \nReply with only a JSON object of this form:\n" + llm_verdict.VERDICT_FORMAT.format(location=location)
+
+    response = openai.ChatCompletion.create(
+        model="gpt-4-turbo",
+        response_format={"type": "json_object"},
+        messages=[
+            {"role": "system", "content": "Analyze the provided text for specific information."},
+            {"role": "user", "content": text},
+            {"role": "user", "content": question}
+        ]
+    )
+    answer = response['choices'][0]['message']['content'].strip()  # grab the response from gpt for the question
+    verdict = llm_verdict.parse_verdict(answer)
+    if verdict is None:
+        print(f"Could not read the gpt answer: {answer[:200]}")
+        return False, answer
+    return verdict.valid, verdict.explanation()  # valid only if all four questions were answered yes
 
 
 def search_and_export(data):
@@ -0,0 +1,377 @@
+"""
+Detection of abnormal arrest days in the reconstructed TRAC daily arrest series.
+
+Builds the abnormal_arrest_dates file every scraper starts from
+(main.parse_csv, bing_search_arrest_dataset.process_csv_and_search), which
+used to be put together by hand.
+
+The daily series (one row per county and day with an arrests count, or one
+row per arrest) is turned into a county x day matrix. For every cell the
+baseline is the trailing window of the window_days days before it, the day
+itself excluded. A day is abnormal when it has at least min_arrests arrests and
+
+    robust z   (arrests - median) / (1.4826 * MAD)  is at least z_threshold, and / or
+    poisson    P(X >= arrests) for a Poisson with the baseline mean is at most p_threshold
+
+(method "both", "robust_z" or "poisson"). The first window_days days of the
+series have no full baseline and are not scored. Everything is NumPy over
+the whole matrix, the rolling medians in blocks of counties to bound memory,
+so all ~3,000 counties since 2014 take seconds.
+
+    python anomaly_days.py daily_arrests.csv abnormal_arrest_dates.csv --z 4 --p 1e-4
+
+With --state the run is incremental (AnomalyState): the matrix and the abnormal
+days found so far are kept in the state file, a new TRAC release only rescores
+the windows it touches, and the abnormal days that are new or changed are also
+written to the --delta file. The delta has the same layout, so only those rows
+are searched:
+
+    python anomaly_days.py release_2019.csv --state anomaly_state.npz --delta abnormal_arrest_dates_delta.csv
+    main.search_and_export(main.parse_csv("abnormal_arrest_dates_delta.csv"))  # appends to the result files
+    bing_search_arrest_dataset.process_csv_and_search("abnormal_arrest_dates_delta.csv", key, endpoint,
+                                                      journal_file="delta.log", output_name="delta_search_results")
+"""
+import argparse
+import json
+import math
+import os
+
+import numpy as np
+import pandas as pd
+from numpy.lib.stride_tricks import sliding_window_view
+
+import row_source
+
+DEFAULT_START = "2014-01-01"
+WINDOW_DAYS = 28
+MIN_ARRESTS = 5
+Z_THRESHOLD = 4.0
+P_THRESHOLD = 1e-4
+MIN_SCALE = 1.0  # floor of the robust scale, most counties have a median and MAD of 0 arrests
+LAMBDA_FLOOR = 0.1  # floor of the poisson mean, so a first arrest in a quiet county is not infinitely unlikely
+METHODS = ("both", "robust_z", "poisson")
+BLOCK_COUNTIES = 16  # counties per block of rolling windows, small blocks stay in cache
+TAIL_TERMS = 100
+
+COUNTY_COLUMNS = ["StateCountyFIPS", "CountyName", "ST", "FIPSState", "FIPSCounty"]
+SCORE_COLUMNS = ["arrests", "expected", "z_score", "p_value"]
+OUTPUT_COLUMNS = row_source.INPUT_COLUMNS + SCORE_COLUMNS
+
+
+def load_daily_counts(path, count_column="arrests", start=DEFAULT_START):
+    """
+    Read the daily arrest series as a typed DataFrame (arrestdate, county columns, arrests).
+    Without a count_column in the file every row counts as one arrest.
+    """
+    daily = pd.read_csv(path, dtype="string", keep_default_na=False, na_values=[""])
+    daily = row_source.typed_columns(daily)
+    if count_column in daily:
+        daily["arrests"] = pd.to_numeric(daily[count_column], errors="coerce").fillna(0)
+    else:
+        daily["arrests"] = 1
+    daily = daily[daily["arrestdate"].notna()]
+    if start is not None:
+        daily = daily[daily["arrestdate"] >= pd.Timestamp(start)]
+    return daily[["arrestdate"] + COUNTY_COLUMNS + ["arrests"]]
+
+
+def arrest_matrix(daily):
+    """
+    Sum the daily series into a county x day matrix of arrests.
+    Returns (counts, counties, days): counts is float64 [county, day], counties the
+    county columns of every matrix row and days the DatetimeIndex of the columns.
+    """
+    keys = daily[COUNTY_COLUMNS]
+    county_codes = keys.groupby(COUNTY_COLUMNS, dropna=False, sort=True).ngroup().to_numpy()
+    counties = keys.assign(_code=county_codes).drop_duplicates("_code").sort_values("_code")
+    counties = counties.drop(columns="_code").reset_index(drop=True)
+    first = daily["arrestdate"].min()
+    days = pd.date_range(first, daily["arrestdate"].max(), freq="D")
+    day_codes = ((daily["arrestdate"] - first) // pd.Timedelta(days=1)).to_numpy()
+    counts = np.zeros((len(counties), len(days)))
+    np.add.at(counts, (county_codes, day_codes), daily["arrests"].to_numpy(dtype=float))
+    return counts, counties, days
+
+
+def rolling_baseline(counts, window_days=WINDOW_DAYS, block_counties=BLOCK_COUNTIES):
+    """
+    Trailing baseline of every cell over the window_days days before it.
+    Returns (mean, median, mad) matrices shaped like counts, NaN for the first window_days days.
+    """
+    n_counties, n_days = counts.shape
+    mean = np.full(counts.shape, np.nan)
+    median = np.full(counts.shape, np.nan)
+    mad = np.full(counts.shape, np.nan)
+    if n_days <= window_days:
+        return mean, median, mad
+
+    totals = np.cumsum(np.pad(counts, ((0, 0), (1, 0))), axis=1)
+    mean[:, window_days:] = (totals[:, window_days:-1] - totals[:, :-window_days - 1]) / window_days
+    for block in range(0, n_counties, block_counties):
+        rows = slice(block, block + block_counties)
+        # windows[c, d] are the window_days days before day d + window_days, float32 is exact for counts
+        windows = np.sort(sliding_window_view(counts[rows, :-1].astype(np.float32), window_days, axis=1), axis=2)
+        block_median = _sorted_median(windows)
+        deviations = np.abs(windows - block_median[:, :, None])
+        deviations.sort(axis=2)
+        median[rows, window_days:] = block_median
+        mad[rows, window_days:] = _sorted_median(deviations)
+    return mean, median, mad
+
+
+# median along the last axis of an array already sorted along it, sorting short windows beats np.median's partition
+def _sorted_median(values):
+    middle = values.shape[-1] // 2
+    if values.shape[-1] % 2:
+        return values[..., middle]
+    return (values[..., middle - 1] + values[..., middle]) / 2
+
+
+def robust_z(counts, median, mad, min_scale=MIN_SCALE):
+    """Robust z score of every cell against its baseline median and MAD"""
+    return (counts - median) / np.maximum(1.4826 * mad, min_scale)
+
+
+def _log_factorials(limit):
+    return np.array([math.lgamma(k + 1) for k in range(int(limit) + 1)])
+
+
+def poisson_tail(arrests, expected, terms=TAIL_TERMS):
+    """
+    P(X >= arrests) for X ~ Poisson(expected), element-wise over 1-d arrays where arrests > expected.
+    The tail is pmf(arrests) * (1 + l/(a+1) + l^2/((a+1)(a+2)) + ...), summed in log space.
+    """
+    arrests = np.asarray(arrests, dtype=float)
+    expected = np.asarray(expected, dtype=float)
+    if not len(arrests):
+        return np.array([])
+    log_pmf = arrests * np.log(expected) - expected - _log_factorials(arrests.max())[arrests.astype(int)]
+    ratios = expected[:, None] / (arrests[:, None] + np.arange(1, terms + 1))
+    series = 1 + np.cumprod(ratios, axis=1).sum(axis=1)
+    return np.minimum(1.0, np.exp(log_pmf + np.log(series)))
+
+
+def score_matrix(counts, window_days=WINDOW_DAYS, min_arrests=MIN_ARRESTS, block_counties=BLOCK_COUNTIES):
+    """
+    Baseline and scores of every cell. Returns (expected, z, p): the baseline mean,
+    the robust z score and the poisson tail probability (1 where it is not computed).
+    """
+    mean, median, mad = rolling_baseline(counts, window_days, block_counties)
+    z = robust_z(counts, median, mad)
+    expected = np.maximum(mean, LAMBDA_FLOOR)
+    p = np.ones(counts.shape)
+    candidates = np.nonzero((counts >= min_arrests) & (counts > expected))  # NaN baselines compare False
+    p[candidates] = poisson_tail(counts[candidates], expected[candidates])
+    return expected, z, p
+
+
+def flag_cells(counts, z, p, method="both", min_arrests=MIN_ARRESTS, z_threshold=Z_THRESHOLD,
+               p_threshold=P_THRESHOLD):
+    """Boolean county x day matrix of the abnormal days"""
+    if method not in METHODS:
+        raise ValueError(f"method must be one of {METHODS}")
+    flagged = counts >= min_arrests
+    if method in ("both", "robust_z"):
+        flagged &= z >= z_threshold  # NaN z (no baseline) is never flagged
+    if method in ("both", "poisson"):
+        flagged &= p <= p_threshold
+    return flagged
+
+
+# helper function to lay out abnormal cells as rows of the abnormal_arrest_dates file
+def _found_frame(counties, days, county_index, day_index, arrests, expected, z, p):
+    found = counties.iloc[county_index].reset_index(drop=True)
+    found.insert(0, "arrestdate", days[day_index])
+    found["arrests"] = arrests
+    found["expected"] = np.round(expected, 3)
+    found["z_score"] = np.round(z, 2)
+    found["p_value"] = p
+    return found.sort_values(["arrestdate", "StateCountyFIPS"], kind="stable")[OUTPUT_COLUMNS].reset_index(drop=True)
+
+
+def abnormal_days(daily, window_days=WINDOW_DAYS, method="both", min_arrests=MIN_ARRESTS, z_threshold=Z_THRESHOLD,
+                  p_threshold=P_THRESHOLD, block_counties=BLOCK_COUNTIES):
+    """
+    The abnormal county-days of the daily series, one row each in the abnormal_arrest_dates
+    layout (row_source.INPUT_COLUMNS) plus arrests, expected, z_score and p_value.
+    """
+    counts, counties, days = arrest_matrix(daily)
+    expected, z, p = score_matrix(counts, window_days, min_arrests, block_counties)
+    cells = np.nonzero(flag_cells(counts, z, p, method, min_arrests, z_threshold, p_threshold))
+    return _found_frame(counties, days, cells[0], cells[1], counts[cells], expected[cells], z[cells], p[cells])
+
+
+# --- incremental updates ---------------------------------------------------------
+
+STATE_FILE = "anomaly_state.npz"
+
+
+# helper function with the identity of every county row, NA as None so the tuples can be dict keys
+def _county_keys(counties):
+    columns = [counties[column].astype(object).where(counties[column].notna(), None) for column in COUNTY_COLUMNS]
+    return list(zip(*columns))
+
+
+class AnomalyState:
+    """
+    What a run leaves behind for the next release: the county x day matrix with its
+    counties and first day, the detection parameters, and every abnormal cell found
+    so far as (county row, day index) -> (arrests, expected, z, p).
+
+    update() merges a release into the matrix, rescores only the counties and days
+    whose windows the release touched and returns the abnormal days that are new or
+    whose arrests changed. Within the dates a release covers it replaces what was
+    there, so a revised release corrects earlier numbers.
+    """
+
+    def __init__(self, counts=None, counties=None, first_day=None, params=None, flagged=None):
+        self.counts = counts if counts is not None else np.zeros((0, 0))
+        self.counties = counties if counties is not None else pd.DataFrame({column: [] for column in COUNTY_COLUMNS})
+        self.first_day = first_day
+        self.params = params or {}
+        self.flagged = flagged or {}
+
+    @property
+    def days(self):
+        return pd.date_range(self.first_day, periods=self.counts.shape[1], freq="D")
+
+    def _merge(self, daily):
+        """Merge a release into the matrix, returns the boolean matrix of the cells it changed"""
+        release, release_counties, release_days = arrest_matrix(daily)
+        index = {key: i for i, key in enumerate(_county_keys(self.counties))}
+        new_counties = []
+        rows = []
+        for position, key in enumerate(_county_keys(release_counties)):
+            if key not in index:
+                index[key] = len(index)
+                new_counties.append(position)
+            rows.append(index[key])
+        if new_counties:
+            added = release_counties.iloc[new_counties]
+            self.counties = pd.concat([self.counties, added], ignore_index=True) if len(self.counties) else \
+                added.reset_index(drop=True)
+
+        first = release_days[0] if self.first_day is None else min(self.first_day, release_days[0])
+        shift = 0 if self.first_day is None else (self.first_day - first).days
+        n_days = max(shift + self.counts.shape[1], (release_days[-1] - first).days + 1)
+        counts = np.zeros((len(index), n_days))
+        counts[:self.counts.shape[0], shift:shift + self.counts.shape[1]] = self.counts
+        previous = counts.copy()
+        self.flagged = {(county, day + shift): value for (county, day), value in self.flagged.items()}
+        self.counts, self.first_day = counts, first
+
+        start = (release_days[0] - first).days
+        covered = slice(start, start + len(release_days))
+        counts[:, covered] = 0
+        counts[np.array(rows), covered] = release
+        return counts != previous
+
+    def update(self, daily, window_days=WINDOW_DAYS, method="both", min_arrests=MIN_ARRESTS,
+               z_threshold=Z_THRESHOLD, p_threshold=P_THRESHOLD, block_counties=BLOCK_COUNTIES):
+        """
+        Add a release of the daily series. Returns (delta, removed): the abnormal days that are new
+        or whose arrests changed (abnormal_days layout) and how many earlier ones no longer qualify.
+        """
+        params = {"window_days": window_days, "method": method, "min_arrests": min_arrests,
+                  "z_threshold": z_threshold, "p_threshold": p_threshold}
+        changed = self._merge(daily)
+        if params != self.params:  # other thresholds, every cell has to be looked at again
+            affected = np.arange(self.counts.shape[0])
+            first_changed = 0
+        else:
+            affected = np.nonzero(changed.any(axis=1))[0]
+            first_changed = int(np.nonzero(changed.any(axis=0))[0].min()) if len(affected) else self.counts.shape[1]
+        self.params = params
+
+        # a changed day moves the windows of the window_days days after it, scoring starts one window earlier
+        begin = max(0, first_changed - window_days)
+        counts = self.counts[affected, begin:]
+        expected, z, p = score_matrix(counts, window_days, min_arrests, block_counties)
+        flagged = flag_cells(counts, z, p, method, min_arrests, z_threshold, p_threshold)
+        flagged[:, :first_changed - begin] = False
+        found = {}
+        for row, column in zip(*np.nonzero(flagged)):
+            found[(int(affected[row]), int(column + begin))] = (float(counts[row, column]), float(expected[row, column]),
+                                                                float(z[row, column]), float(p[row, column]))
+
+        affected_rows = set(affected.tolist())
+        stale = [cell for cell in self.flagged if cell[0] in affected_rows and cell[1] >= first_changed]
+        delta = [cell for cell, value in found.items()
+                 if cell not in self.flagged or self.flagged[cell][0] != value[0]]
+        removed = [cell for cell in stale if cell not in found]
+        for cell in stale:
+            del self.flagged[cell]
+        self.flagged.update(found)
+        return self._frame(delta), len(removed)
+
+    def _frame(self, cells):
+        if not cells:
+            return _found_frame(self.counties, self.days, [], [], [], [], [], [])
+        values = np.array([self.flagged[cell] for cell in cells])
+        county_index, day_index = (np.array(axis) for axis in zip(*cells))
+        return _found_frame(self.counties, self.days, county_index, day_index, *values.T)
+
+    def abnormal_days(self):
+        """Every abnormal day found so far, in the abnormal_days layout"""
+        return self._frame(list(self.flagged))
+
+    def save(self, path=STATE_FILE):
+        cells = list(self.flagged)
+        counties = {f"county_{column}": self.counties[column].astype("string").fillna("").to_numpy(dtype=str)
+                    for column in COUNTY_COLUMNS}
+        np.savez_compressed(path, counts=self.counts.astype(np.float32), first_day=str(self.first_day.date()),
+                            params=json.dumps(self.params), cells=np.array(cells, dtype=np.int64).reshape(-1, 2),
+                            values=np.array([self.flagged[cell] for cell in cells]).reshape(-1, 4), **counties)
+
+    @classmethod
+    def load(cls, path=STATE_FILE):
+        """The state saved at path, an empty state if there is none yet"""
+        if not os.path.exists(path):
+            return cls()
+        with np.load(path) as saved:
+            counties = pd.DataFrame({column: pd.Series(saved[f"county_{column}"], dtype="string").replace("", pd.NA)
+                                     for column in COUNTY_COLUMNS})
+            for column in ("StateCountyFIPS", "FIPSState", "FIPSCounty"):
+                counties[column] = pd.to_numeric(counties[column]).astype("Int64")
+            flagged = {(int(county), int(day)): tuple(float(v) for v in value)
+                       for (county, day), value in zip(saved["cells"], saved["values"])}
+            return cls(saved["counts"].astype(float), counties, pd.Timestamp(str(saved["first_day"])),
+                       json.loads(str(saved["params"])), flagged)
+
+
+def write_abnormal_days(found, path):
+    """Write the abnormal days as csv, dates as m/d/Y so row_source reads them like the hand-made file"""
+    out = found.copy()
+    out["arrestdate"] = out["arrestdate"].dt.strftime("%m/%d/%Y")
+    out.to_csv(path, index=False)
+    return path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Find abnormal arrest days in the daily TRAC arrest series")
+    parser.add_argument("daily_csv", help="one row per county and day (or per arrest) with arrestdate and FIPS columns")
+    parser.add_argument("output_csv", nargs="?", default="abnormal_arrest_dates.csv")
+    parser.add_argument("--count-column", default="arrests")
+    parser.add_argument("--start", default=DEFAULT_START, help="first day of the series to use")
+    parser.add_argument("--window", type=int, default=WINDOW_DAYS, help="days of trailing baseline")
+    parser.add_argument("--method", choices=METHODS, default="both")
+    parser.add_argument("--min-arrests", type=float, default=MIN_ARRESTS)
+    parser.add_argument("--z", type=float, default=Z_THRESHOLD, help="robust z score threshold")
+    parser.add_argument("--p", type=float, default=P_THRESHOLD, help="poisson tail probability threshold")
+    parser.add_argument("--state", help="state file of incremental runs, the input is a new release added to it")
+    parser.add_argument("--delta", default="abnormal_arrest_dates_delta.csv",
+                        help="with --state, where the new or changed abnormal days go")
+    args = parser.parse_args()
+
+    daily = load_daily_counts(args.daily_csv, args.count_column, args.start)
+    if args.state:
+        state = AnomalyState.load(args.state)
+        delta, removed = state.update(daily, args.window, args.method, args.min_arrests, args.z, args.p)
+        state.save(args.state)
+        found = state.abnormal_days()
+        write_abnormal_days(delta, args.delta)
+        print(f"{len(delta)} new or changed abnormal days written to {args.delta}, {removed} no longer abnormal")
+    else:
+        found = abnormal_days(daily, args.window, args.method, args.min_arrests, args.z, args.p)
+    write_abnormal_days(found, args.output_csv)
+    print(f"{len(found)} abnormal days in {found['StateCountyFIPS'].nunique()} counties written to {args.output_csv}")
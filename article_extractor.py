@@ -0,0 +1,191 @@
+"""
+Boilerplate removal for scraped news pages.
+
+Instead of the text of the whole page (menus, footers, share buttons, lists of
+other stories) only the article itself is kept: its headline, its publication
+date and the paragraphs of the block that holds the story. Scripts, navigation
+and blocks whose class or id is a page furniture name (a whole class token such
+as "sidebar" or "share-buttons", not "has-sidebar") are dropped, then every
+block is scored by the paragraph text directly inside it, less the text that is
+only links, and the best block wins (a simplified readability scorer).
+
+The parser is lxml when it is installed (several times faster) and the
+standard library html.parser otherwise. Pages where no article block can be
+found are scored once more on the untouched page, with the furniture only
+stripped inside the chosen block, so a story inside a wrapper that looks like
+furniture is never thrown away with it. If that fails too the text of the
+whole (unstripped) page is used, so nothing is lost compared to the old scraper.
+"""
+import copy
+import json
+import re
+from collections import namedtuple
+
+from bs4 import BeautifulSoup
+
+try:
+    import lxml  # noqa: F401, only needed as the BeautifulSoup parser
+    PARSER = "lxml"
+except ImportError:
+    PARSER = "html.parser"
+
+MIN_ARTICLE_CHARS = 250  # below this the chosen block is probably not the story, use the whole page
+MIN_PARAGRAPH_CHARS = 25
+
+DROP_TAGS = ["script", "style", "noscript", "template", "svg", "iframe", "form", "button", "select",
+             "nav", "header", "footer", "aside", "figure"]
+# matched against whole class / id tokens, e.g. "sidebar", "site-footer", "share-buttons" but not "has-sidebar"
+BOILERPLATE = re.compile(
+    r"(?:(?:site|main|global|page|top|bottom|js)[-_])?"
+    r"(?:nav|navbar|navigation|menu|footer|sidebar|comments?|share|sharing|social|related|recommended|promo|advert|"
+    r"ads?|sponsored|cookies?|newsletter|subscribe|signup|breadcrumbs?|trending|popular|outbrain|taboola|modal|popup)"
+    r"(?:[-_](?:bar|box|buttons?|links?|icons?|tools|widget|list|posts|stories|articles|menu|nav|container|wrapper|"
+    r"area|block|section|module|banner|notice|consent))*",
+    re.IGNORECASE)
+BLOCK_TAGS = ["article", "main", "section", "div", "td"]
+TEXT_TAGS = ["p", "h2", "h3", "h4", "li", "blockquote", "pre"]
+
+# meta tags that carry the publication date, in order of preference
+DATE_META = ["article:published_time", "og:published_time", "datepublished", "pubdate", "publishdate",
+             "publish-date", "date", "dc.date", "dc.date.issued", "parsely-pub-date", "sailthru.date",
+             "article.published", "cxenseparse:recs:publishtime"]
+TITLE_META = ["og:title", "twitter:title"]
+
+Article = namedtuple("Article", ["title", "published", "text"])
+
+
+def _text_of(tag):
+    return re.sub(r"\s+", " ", tag.get_text(" ", strip=True)).strip()
+
+
+def _meta(soup, names):
+    found = {}
+    for meta in soup.find_all("meta"):
+        name = (meta.get("property") or meta.get("name") or meta.get("itemprop") or "").lower()
+        if name in names and meta.get("content") and name not in found:
+            found[name] = meta["content"].strip()
+    for name in names:
+        if name in found:
+            return found[name]
+    return None
+
+
+def _json_ld_date(soup):
+    for script in soup.find_all("script", type="application/ld+json"):
+        try:
+            data = json.loads(script.string or "")
+        except ValueError:
+            continue
+        stack = [data]
+        while stack:
+            item = stack.pop()
+            if isinstance(item, list):
+                stack.extend(item)
+            elif isinstance(item, dict):
+                if isinstance(item.get("datePublished"), str):
+                    return item["datePublished"].strip()
+                stack.extend(v for v in item.values() if isinstance(v, (list, dict)))
+    return None
+
+
+def find_title(soup):
+    title = _meta(soup, TITLE_META)
+    if not title:
+        h1 = soup.find("h1")
+        title = _text_of(h1) if h1 is not None else None
+    if not title and soup.title is not None:
+        title = _text_of(soup.title)
+    return title or None
+
+
+def find_published(soup):
+    published = _meta(soup, DATE_META) or _json_ld_date(soup)
+    if not published:
+        time_tag = soup.find("time", datetime=True)
+        published = time_tag["datetime"].strip() if time_tag is not None else None
+    return published or None
+
+
+def _is_boilerplate(tag):
+    if tag.attrs is None:
+        return False
+    tokens = list(tag.get("class") or []) + (tag.get("id") or "").split()
+    return tag.name not in ("article", "main", "body") and any(BOILERPLATE.fullmatch(token) for token in tokens)
+
+
+def _strip_boilerplate(root):
+    # only the descendants of root, root itself is kept
+    for tag in root.find_all(DROP_TAGS) + root.find_all(_is_boilerplate):
+        if not tag.decomposed:  # may be inside a tag that is already gone
+            tag.decompose()
+
+
+def _link_density(tag, text_length):
+    link_length = sum(len(_text_of(a)) for a in tag.find_all("a"))
+    return link_length / text_length if text_length else 1.0
+
+
+def _best_block(soup):
+    # every paragraph adds its length to its parent and half of it to its grandparent
+    scores = {}
+    blocks = {}
+    for paragraph in soup.find_all("p"):
+        length = len(_text_of(paragraph))
+        if length < MIN_PARAGRAPH_CHARS:
+            continue
+        score = 1 + min(length / 100, 3) + _text_of(paragraph).count(",")
+        for parent, weight in ((paragraph.parent, 1.0), (paragraph.parent.parent if paragraph.parent else None, 0.5)):
+            if parent is None or parent.name not in BLOCK_TAGS:
+                continue
+            key = id(parent)
+            blocks[key] = parent
+            scores[key] = scores.get(key, 0.0) + score * weight
+    best, best_score = None, 0.0
+    for key, score in scores.items():
+        block = blocks[key]
+        score *= 1 - _link_density(block, len(_text_of(block)))
+        if block.name in ("article", "main"):
+            score *= 1.25
+        if score > best_score:
+            best, best_score = block, score
+    return best
+
+
+def _block_text(block):
+    lines = []
+    for tag in block.find_all(TEXT_TAGS):
+        if tag.find_parent(TEXT_TAGS) is not None:
+            continue  # already part of an enclosing paragraph or list item
+        text = _text_of(tag)
+        if text and (tag.name != "li" or _link_density(tag, len(text)) < 0.5):
+            lines.append(text)
+    return "\n".join(lines)
+
+
+def extract_article(html):
+    """Return the Article (title, published, text) of a page, any field may be None / empty"""
+    soup = BeautifulSoup(html, PARSER)
+    title = find_title(soup)
+    published = find_published(soup)
+    stripped = copy.copy(soup)
+    _strip_boilerplate(stripped)
+    block = _best_block(stripped)
+    text = _block_text(block) if block is not None else ""
+    if len(text) < MIN_ARTICLE_CHARS:
+        # the story may sit in a wrapper that looks like furniture: choose on the whole page, strip inside the block only
+        block = _best_block(soup)
+        if block is not None:
+            block = copy.copy(block)
+            _strip_boilerplate(block)
+            text = _block_text(block)
+    if len(text) < MIN_ARTICLE_CHARS:
+        text = _text_of(soup.body or soup)
+    return Article(title, published, text)
+
+
+def article_text(article):
+    """The article as the text handed to the checks: headline and date first, then the body"""
+    header = [line for line in (article.title, f"Published: {article.published}" if article.published else None) if line]
+    if not article.text:
+        return ""
+    return "\n".join(header + [article.text])
@@ -0,0 +1,165 @@
+"""
+Asynchronous article fetcher shared by the scrapers.
+
+All requests go through one httpx.AsyncClient, so connections are pooled and kept
+alive across articles, and every host gets its own concurrency cap so a single
+news site is not hammered by a whole batch of links. A request that runs past
+its timeout is cancelled instead of being left running in a background thread.
+
+When given an ArticleStore, pages already in the local store are served from it
+and only revalidated (If-None-Match / If-Modified-Since) once their TTL is up.
+If the revalidation fails (network error, timeout or a 5xx answer) the stored
+text is served as it is. Store reads and writes run in worker threads, never on
+the event loop.
+Pages are reduced to their article (headline, publication date and body, see
+article_extractor) before they are stored, so the store and every gpt call only
+carry the story itself.
+
+The synchronous helpers at the bottom run the fetcher on a single background
+event loop, so threaded code (main.helper, pipeline.py) shares one connection
+pool and one article store.
+"""
+import asyncio
+import threading
+from urllib.parse import urlsplit
+
+import httpx
+
+import article_extractor
+from article_store import ArticleStore
+
+DEFAULT_TIMEOUT = 8  # seconds allowed for one article, same as main.scrape_article_text
+MAX_CONNECTIONS = 100
+MAX_KEEPALIVE_CONNECTIONS = 20
+PER_HOST_LIMIT = 4
+HEADERS = {"User-Agent": "Mozilla/5.0 (compatible; immigration-raids-research/1.0)"}
+
+
+# helper function to turn the html of a page into the plain text of its article
+def html_to_text(html):
+    return article_extractor.article_text(article_extractor.extract_article(html))
+
+
+class ArticleFetcher:
+    """
+    Fetches article text over a pooled httpx.AsyncClient.
+
+    fetch_text returns the scraped text, None if the page could not be scraped,
+    or False if it took longer than timeout seconds (the same convention as
+    main.scrape_article_text).
+    """
+
+    def __init__(self, timeout=DEFAULT_TIMEOUT, per_host_limit=PER_HOST_LIMIT,
+                 max_connections=MAX_CONNECTIONS, max_keepalive_connections=MAX_KEEPALIVE_CONNECTIONS,
+                 store=None):
+        self.timeout = timeout
+        self.store = store
+        self.per_host_limit = per_host_limit
+        self.limits = httpx.Limits(max_connections=max_connections,
+                                   max_keepalive_connections=max_keepalive_connections)
+        self._client = None
+        self._host_slots = {}
+
+    def _get_client(self):
+        if self._client is None:
+            self._client = httpx.AsyncClient(limits=self.limits, headers=HEADERS,
+                                             follow_redirects=True, timeout=self.timeout)
+        return self._client
+
+    def _slot(self, url):
+        host = urlsplit(url).hostname or ""
+        if host not in self._host_slots:
+            self._host_slots[host] = asyncio.Semaphore(self.per_host_limit)
+        return self._host_slots[host]
+
+    async def _get(self, url, cached=None):
+        headers = cached.revalidation_headers() if cached is not None else None
+        response = await self._get_client().get(url, headers=headers)
+        if response.status_code == 304 and cached is not None:
+            await asyncio.to_thread(self.store.touch, url)
+            return cached.text
+        if response.status_code >= 500 and cached is not None:
+            return cached.text  # the server is down, the stale text beats none
+        if response.status_code != 200:
+            return None
+        # parsing and storing are blocking, keep them off the event loop
+        return await asyncio.to_thread(self._parse_and_store, url, response)
+
+    def _parse_and_store(self, url, response):
+        text = html_to_text(response.text)
+        if self.store is not None and text:
+            self.store.put(url, text, response.headers.get("ETag"), response.headers.get("Last-Modified"))
+        return text
+
+    async def fetch_text(self, url, timeout=None):
+        """Fetch one url and return its text, None on error or False on timeout"""
+        if not url or url == "N/A":
+            return None
+        timeout = self.timeout if timeout is None else timeout
+        # sqlite and zlib are blocking, keep them off the event loop
+        cached = await asyncio.to_thread(self.store.get, url) if self.store is not None else None
+        if cached is not None and cached.fresh:
+            return cached.text
+        async with self._slot(url):
+            try:
+                # wait_for cancels the request when the time is up
+                return await asyncio.wait_for(self._get(url, cached), timeout)
+            except asyncio.TimeoutError:
+                return cached.text if cached is not None else False  # a stale text if we have one
+            except Exception as e:
+                print(f"Error scraping {url}: {e}")
+                return cached.text if cached is not None else None
+
+    async def fetch_texts(self, links, timeout=None):
+        """Fetch every link concurrently and return their texts in the same order"""
+        return await asyncio.gather(*(self.fetch_text(link, timeout) for link in links))
+
+    async def fetch_results(self, organic_results, timeout=None):
+        """Batch API for one search: fetch the text of every organic result"""
+        return await self.fetch_texts([result.get("link", "N/A") for result in organic_results], timeout)
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+# --- synchronous access from threaded code -----------------------------------
+
+_loop = None
+_fetcher = None
+_lock = threading.Lock()
+
+
+def _get_loop():
+    global _loop, _fetcher
+    with _lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name="article-fetcher", daemon=True).start()
+            _fetcher = ArticleFetcher(store=ArticleStore())
+    return _loop
+
+
+def fetch_article_texts(links, timeout=DEFAULT_TIMEOUT):
+    """Fetch a batch of links on the shared event loop and block until all of them are done"""
+    loop = _get_loop()
+    future = asyncio.run_coroutine_threadsafe(_fetcher.fetch_texts(links, timeout), loop)
+    return future.result()
+
+
+def fetch_article_text(url, timeout=DEFAULT_TIMEOUT):
+    return fetch_article_texts([url], timeout)[0]
+
+
+def close():
+    """Close the shared connection pool and stop the background loop"""
+    global _loop, _fetcher
+    with _lock:
+        if _loop is None:
+            return
+        asyncio.run_coroutine_threadsafe(_fetcher.aclose(), _loop).result()
+        _fetcher.store.close()
+        _loop.call_soon_threadsafe(_loop.stop)
+        _loop = None
+        _fetcher = None
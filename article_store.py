@@ -0,0 +1,144 @@
+"""
+Persistent local store of scraped article text, keyed by URL.
+
+Texts are zlib-compressed and stored once per content hash, so the same press
+release reached through several URLs only takes space once. Every URL keeps the
+ETag / Last-Modified headers it was served with: while an entry is younger than
+the TTL it is returned without touching the network, afterwards the fetcher
+revalidates it with a conditional request. Once the store grows past max_bytes
+the least recently used pages are evicted.
+"""
+import hashlib
+import sqlite3
+import threading
+import time
+import zlib
+
+ARTICLE_STORE_FILE = 'article_store.sqlite3'
+DEFAULT_TTL = 30 * 24 * 3600  # news articles rarely change, revalidate after 30 days
+DEFAULT_MAX_BYTES = 2 * 1024 ** 3  # 2 GB of compressed text
+
+
+class CachedArticle:
+    """A page as it was last stored: its text plus what is needed to revalidate it"""
+    __slots__ = ("url", "text", "etag", "last_modified", "fetched_at", "fresh")
+
+    def __init__(self, url, text, etag, last_modified, fetched_at, fresh):
+        self.url = url
+        self.text = text
+        self.etag = etag
+        self.last_modified = last_modified
+        self.fetched_at = fetched_at
+        self.fresh = fresh
+
+    def revalidation_headers(self):
+        """Headers for a conditional GET of this page"""
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+
+class ArticleStore:
+    """sqlite backed article cache, safe to share between threads"""
+
+    def __init__(self, path=ARTICLE_STORE_FILE, ttl=DEFAULT_TTL, max_bytes=DEFAULT_MAX_BYTES):
+        self.path = path
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS blobs (
+                hash TEXT PRIMARY KEY,
+                data BLOB NOT NULL,
+                size INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS pages (
+                url TEXT PRIMARY KEY,
+                hash TEXT NOT NULL,
+                etag TEXT,
+                last_modified TEXT,
+                fetched_at REAL NOT NULL,
+                last_access REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS pages_hash ON pages(hash);
+            CREATE INDEX IF NOT EXISTS pages_last_access ON pages(last_access);
+        """)
+        self._conn.commit()
+        self._total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM blobs").fetchone()[0]
+
+    def get(self, url):
+        """Return the CachedArticle stored for url, or None if it has never been stored"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT p.hash, p.etag, p.last_modified, p.fetched_at, b.data "
+                "FROM pages p JOIN blobs b ON b.hash = p.hash WHERE p.url = ?", (url,)).fetchone()
+            if row is None:
+                return None
+            now = time.time()
+            self._conn.execute("UPDATE pages SET last_access = ? WHERE url = ?", (now, url))
+            self._conn.commit()
+        content_hash, etag, last_modified, fetched_at, data = row
+        text = zlib.decompress(data).decode("utf-8")
+        return CachedArticle(url, text, etag, last_modified, fetched_at, now - fetched_at < self.ttl)
+
+    def put(self, url, text, etag=None, last_modified=None):
+        """Store the text fetched for url together with its validators"""
+        raw = text.encode("utf-8")
+        content_hash = hashlib.sha256(raw).hexdigest()
+        data = zlib.compress(raw, 6)
+        now = time.time()
+        with self._lock:
+            old = self._conn.execute("SELECT hash FROM pages WHERE url = ?", (url,)).fetchone()
+            inserted = self._conn.execute("INSERT OR IGNORE INTO blobs (hash, data, size) VALUES (?, ?, ?)",
+                                          (content_hash, data, len(data))).rowcount
+            self._total += len(data) if inserted else 0
+            self._conn.execute(
+                "INSERT OR REPLACE INTO pages (url, hash, etag, last_modified, fetched_at, last_access) "
+                "VALUES (?, ?, ?, ?, ?, ?)", (url, content_hash, etag, last_modified, now, now))
+            if old is not None and old[0] != content_hash:
+                self._drop_blob_if_unused(old[0])  # the page changed, its previous text may now be orphaned
+            self._conn.commit()
+            self._evict()
+
+    def touch(self, url):
+        """Mark a page as fresh again after the server answered 304 Not Modified"""
+        now = time.time()
+        with self._lock:
+            self._conn.execute("UPDATE pages SET fetched_at = ?, last_access = ? WHERE url = ?", (now, now, url))
+            self._conn.commit()
+
+    def size(self):
+        """Total compressed size of the stored texts in bytes"""
+        return self._total
+
+    def _evict(self):
+        # caller holds the lock
+        if self._total <= self.max_bytes:
+            return
+        # drop least recently used pages until we are back under 90% of the limit
+        target = self.max_bytes * 0.9
+        for (url,) in self._conn.execute("SELECT url FROM pages ORDER BY last_access").fetchall():
+            if self._total <= target:
+                break
+            content_hash = self._conn.execute("SELECT hash FROM pages WHERE url = ?", (url,)).fetchone()[0]
+            self._conn.execute("DELETE FROM pages WHERE url = ?", (url,))
+            self._drop_blob_if_unused(content_hash)
+        self._conn.commit()
+
+    def _drop_blob_if_unused(self, content_hash):
+        # caller holds the lock
+        if self._conn.execute("SELECT 1 FROM pages WHERE hash = ? LIMIT 1", (content_hash,)).fetchone() is not None:
+            return
+        row = self._conn.execute("SELECT size FROM blobs WHERE hash = ?", (content_hash,)).fetchone()
+        if row is not None:
+            self._conn.execute("DELETE FROM blobs WHERE hash = ?", (content_hash,))
+            self._total -= row[0]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,218 @@
+"""
+Batched LLM validation: several articles of the same county and date window in one request.
+
+The single-article prompt pays for the system prompt and the four questions on
+every link. Here up to BATCH_MAX_ARTICLES articles (and at most BATCH_MAX_CHARS
+characters of article text) are packed into one request, and the model answers
+the same four questions for every article as one JSON object, each article in
+the llm_verdict schema. An article is accepted only if all four answers are
+yes, the same rule analyze_with_chatgpt applies.
+
+Articles the model leaves out of its answer, or answers in a form that cannot be
+parsed, come back as None so the caller can fall back to the single-article prompt.
+
+For large runs the same requests can be sent through the OpenAI batch API
+(half price, results within 24 hours) instead of live calls:
+
+    job = OfflineBatch("llm_batches")
+    job.add(texts, state, location, start, end, contexts)   # one json-serialisable context per text
+    job.submit(api_key)
+    ...
+    for context, verdict in job.collect(api_key):   # once job.status(api_key) is "completed"
+        ...
+    job.mark_collected()   # the next job starts with empty files
+"""
+import json
+import os
+import shutil
+import threading
+
+import requests
+
+import llm_verdict
+
+BATCH_MAX_ARTICLES = 5
+BATCH_MAX_CHARS = 40000  # about 10k tokens, leaves room for the answer in a 16k context
+OPENAI_API_URL = "https://api.openai.com/v1"
+
+BATCH_QUESTION = "The messages above are {count} numbered articles. For every article answer these four questions.\
+        \n1. Does this text mention {location} or {state}?\
+        \n2. Is the text related to immigration raids/arrests?\
+        \n3. Does this text mention the date and is the date of this immigration raid between {start} and {end}?\
+        \n4. Does this text confirm that the raid was conducted by Immigration and Customs Enforcement?\
+        \nReply with only a JSON object {{\"articles\": [...]}} holding one object per article, with \"article\": the article number\
+        and the fields of this form:\n" + llm_verdict.VERDICT_FORMAT
+
+
+# helper function to split article texts into packs that fit in one request
+# returns lists of indexes into texts, so every text keeps track of where it came from
+def pack_articles(texts, max_articles=BATCH_MAX_ARTICLES, max_chars=BATCH_MAX_CHARS):
+    packs = []
+    pack, size = [], 0
+    for i, text in enumerate(texts):
+        if pack and (len(pack) == max_articles or size + len(text) > max_chars):
+            packs.append(pack)
+            pack, size = [], 0
+        pack.append(i)
+        size += len(text)
+    if pack:
+        packs.append(pack)
+    return packs
+
+
+# helper function that builds the chat messages for one pack of article texts
+def batch_messages(system_prompt, texts, state, location, start, end):
+    messages = [{"role": "system", "content": system_prompt}]
+    for number, text in enumerate(texts, 1):
+        messages.append({"role": "user", "content": f"Article {number}:\n{text}"})
+    messages.append({"role": "user", "content": BATCH_QUESTION.format(
+        count=len(texts), location=location, state=state, start=start, end=end)})
+    return messages
+
+
+def parse_batch_answer(content, count):
+    """
+    Turn the model's answer for a pack of count articles into a list of
+    llm_verdict.Verdict, with None for every article that was not answered properly.
+    """
+    verdicts = [None] * count
+    answer = llm_verdict.json_object(content)
+    if not isinstance(answer, dict) or not isinstance(answer.get("articles"), list):
+        return verdicts
+    for entry in answer["articles"]:
+        if not isinstance(entry, dict):
+            continue
+        try:
+            number = int(entry.get("article"))
+        except (TypeError, ValueError):
+            continue
+        if 1 <= number <= count:
+            verdicts[number - 1] = llm_verdict.to_verdict(entry)
+    return verdicts
+
+
+class OfflineBatch:
+    """
+    Validation requests collected into a batch-API job and resolved later.
+
+    Everything lives in directory: requests.jsonl (the request file that is
+    uploaded), manifest.jsonl (the caller's context for every article of every
+    request) and job.json (the ids of the submitted job), so submit and collect
+    can run in different processes days apart. Once a job is collected the three
+    files are moved to collected/<job id>/, so a later job never sends (or
+    writes) the same requests again.
+    """
+
+    def __init__(self, directory, model="gpt-3.5-turbo", system_prompt=""):
+        self.directory = directory
+        self.model = model
+        self.system_prompt = system_prompt
+        os.makedirs(directory, exist_ok=True)
+        self.requests_path = os.path.join(directory, "requests.jsonl")
+        self.manifest_path = os.path.join(directory, "manifest.jsonl")
+        self.job_path = os.path.join(directory, "job.json")
+        self.count = 0
+        self._lock = threading.Lock()  # add is called from several pipeline workers
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path, encoding="utf-8") as f:
+                self.count = sum(1 for _ in f)
+
+    def add(self, texts, state, location, start, end, contexts):
+        """Queue validation of texts (one context per text), packed into as few requests as possible"""
+        packs = pack_articles(texts)
+        with self._lock, open(self.requests_path, "a", encoding="utf-8") as requests_file, \
+                open(self.manifest_path, "a", encoding="utf-8") as manifest_file:
+            for indexes in packs:
+                custom_id = f"pack-{self.count:07d}"
+                self.count += 1
+                body = {"model": self.model, "response_format": {"type": "json_object"}, "messages": batch_messages(
+                    self.system_prompt, [texts[i] for i in indexes], state, location, start, end)}
+                requests_file.write(json.dumps({"custom_id": custom_id, "method": "POST",
+                                                "url": "/v1/chat/completions", "body": body}) + "\n")
+                manifest_file.write(json.dumps({"custom_id": custom_id,
+                                                "contexts": [contexts[i] for i in indexes]}) + "\n")
+        return len(packs)
+
+    # --- batch api ---------------------------------------------------------
+
+    @staticmethod
+    def _headers(api_key):
+        return {"Authorization": f"Bearer {api_key}"}
+
+    def submitted_job(self):
+        """Id of the job submitted from this directory and not collected yet, or None"""
+        if not os.path.exists(self.job_path):
+            return None
+        with open(self.job_path, encoding="utf-8") as f:
+            return json.load(f)["id"]
+
+    def submit(self, api_key):
+        """Upload the request file and start the batch job, returns the job id"""
+        pending = self.submitted_job()
+        if pending is not None:
+            raise RuntimeError(f"batch job {pending} has not been collected yet")
+        with open(self.requests_path, "rb") as f:
+            upload = requests.post(f"{OPENAI_API_URL}/files", headers=self._headers(api_key),
+                                   data={"purpose": "batch"}, files={"file": f}, timeout=300)
+        upload.raise_for_status()
+        job = requests.post(f"{OPENAI_API_URL}/batches", headers=self._headers(api_key), timeout=60, json={
+            "input_file_id": upload.json()["id"],
+            "endpoint": "/v1/chat/completions",
+            "completion_window": "24h",
+        })
+        job.raise_for_status()
+        with open(self.job_path, "w", encoding="utf-8") as f:
+            json.dump(job.json(), f, indent=2)
+        return job.json()["id"]
+
+    def _job(self, api_key):
+        with open(self.job_path, encoding="utf-8") as f:
+            job_id = json.load(f)["id"]
+        response = requests.get(f"{OPENAI_API_URL}/batches/{job_id}", headers=self._headers(api_key), timeout=60)
+        response.raise_for_status()
+        job = response.json()
+        with open(self.job_path, "w", encoding="utf-8") as f:
+            json.dump(job, f, indent=2)
+        return job
+
+    def status(self, api_key):
+        """Status of the submitted job ("validating", "in_progress", "completed", "failed", ...)"""
+        return self._job(api_key)["status"]
+
+    def collect(self, api_key):
+        """
+        Download the results of a completed job and yield (context, verdict) for every
+        queued article, verdict is an llm_verdict.Verdict or None if there is no usable answer.
+        """
+        job = self._job(api_key)
+        if job["status"] != "completed":
+            raise RuntimeError(f"batch job {job['id']} is {job['status']}, not completed")
+        answers = {}
+        if job.get("output_file_id"):
+            response = requests.get(f"{OPENAI_API_URL}/files/{job['output_file_id']}/content",
+                                    headers=self._headers(api_key), timeout=300)
+            response.raise_for_status()
+            for line in response.text.splitlines():
+                if not line.strip():
+                    continue
+                output = json.loads(line)
+                try:
+                    answers[output["custom_id"]] = output["response"]["body"]["choices"][0]["message"]["content"]
+                except (KeyError, IndexError, TypeError):
+                    print(f"Batch request {output.get('custom_id')} failed: {output.get('error')}")
+
+        with open(self.manifest_path, encoding="utf-8") as f:
+            for line in f:
+                entry = json.loads(line)
+                contexts = entry["contexts"]
+                verdicts = parse_batch_answer(answers.get(entry["custom_id"]), len(contexts))
+                yield from zip(contexts, verdicts)
+
+    def mark_collected(self):
+        """Move the files of the collected job to collected/<job id>/, the directory is then ready for a new job"""
+        archive = os.path.join(self.directory, "collected", self.submitted_job())
+        os.makedirs(archive, exist_ok=True)
+        for path in (self.requests_path, self.manifest_path, self.job_path):
+            if os.path.exists(path):
+                shutil.move(path, os.path.join(archive, os.path.basename(path)))
+        self.count = 0
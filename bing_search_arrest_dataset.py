@@ -1,49 +1,72 @@
-import pandas as pd
-import requests
-from datetime import datetime, timedelta
-import time
+from datetime import datetime
 from tqdm import tqdm
 import json
 import os
 from collections import defaultdict
-import pickle
-from ratelimit import limits, sleep_and_retry
+from rate_limiter import limiter
+from search_journal import SearchJournal
+import row_source
+import parquet_sink
+import search_providers
+import url_index
+from query_planner import plan_queries
+from us_states import list_states
 
 # Constants
 CALLS_PER_SECOND = 250
-ONE_SECOND = 1
-CHECKPOINT_FILE = 'search_checkpoint.pkl'
-TEMP_RESULTS_FILE = 'temp_results.pkl'
+JOURNAL_FILE = 'search_journal.log'
 ERROR_LOG_FILE = 'error_log.txt'
+OUTPUT_FORMAT = 'csv'  # 'csv' or 'parquet' (typed dataset partitioned by state and arrest year)
+SEARCH_WINDOW = (1, 14)  # days before and after the arrest date that a search covers
+
+limiter.configure('bing', CALLS_PER_SECOND)
+
+# Canonical form of every url seen, shared with main.py so tracking / AMP / mobile variants get one url
+urls = url_index.UrlIndex()
+# Bing answers already paid for, its path is resolved here so sharded workers share it after they chdir
+search_cache = search_providers.SearchCache()
 
 class SearchState:
-    def __init__(self, total_rows):
-        self.processed_rows = set()
-        self.current_results = []
+    """Progress of a run, backed by an append-only journal so results never have to be held in memory"""
+    def __init__(self, total_rows, journal_file=JOURNAL_FILE):
         self.total_rows = total_rows
-        self.error_counts = defaultdict(int)
-        
+        self.journal = SearchJournal(journal_file)
+        self.pending_errors = defaultdict(int)
+    
+    @property
+    def processed_rows(self):
+        return self.journal.processed_rows
+    
+    @property
+    def error_counts(self):
+        counts = defaultdict(int, self.journal.error_counts)
+        for error, count in self.pending_errors.items():
+            counts[error] += count
+        return counts
+    
+    def record_error(self, error):
+        self.pending_errors[str(error)] += 1
+    
+    def record_row(self, row_id, results):
+        """Append a completed row and its results to the journal"""
+        self.journal.append_row(row_id, results)
+    
     def save_checkpoint(self):
-        with open(CHECKPOINT_FILE, 'wb') as f:
-            pickle.dump({
-                'processed_rows': self.processed_rows,
-                'error_counts': dict(self.error_counts)
-            }, f)
-        
-        with open(TEMP_RESULTS_FILE, 'wb') as f:
-            pickle.dump(self.current_results, f)
+        self.journal.append_errors(self.pending_errors)
+        self.pending_errors = defaultdict(int)
+        self.journal.checkpoint()
     
     def load_checkpoint(self):
-        if os.path.exists(CHECKPOINT_FILE) and os.path.exists(TEMP_RESULTS_FILE):
-            with open(CHECKPOINT_FILE, 'rb') as f:
-                checkpoint_data = pickle.load(f)
-                self.processed_rows = checkpoint_data['processed_rows']
-                self.error_counts = defaultdict(int, checkpoint_data['error_counts'])
-            
-            with open(TEMP_RESULTS_FILE, 'rb') as f:
-                self.current_results = pickle.load(f)
-            return True
-        return False
+        # the journal is replayed when it is opened
+        return len(self.journal.processed_rows) > 0
+
+def save_results(journal, name, output_format=OUTPUT_FORMAT):
+    """Stream the journaled results to name.csv, or to a partitioned parquet dataset in the directory name"""
+    if output_format == 'parquet':
+        journal.export_parquet(name, parquet_sink.BING_COLUMN_TYPES)
+        return name
+    journal.export_csv(f'{name}.csv')
+    return f'{name}.csv'
 
 def log_error(error_msg):
     """Log errors with timestamp"""
@@ -51,33 +74,10 @@ def log_error(error_msg):
     with open(ERROR_LOG_FILE, 'a') as f:
         f.write(f"{timestamp}: {error_msg}\n")
 
-@sleep_and_retry
-@limits(calls=CALLS_PER_SECOND, period=ONE_SECOND)
-def rate_limited_search(query, start_date, end_date, subscription_key, endpoint):
-    """Rate-limited version of the Bing search function"""
-    headers = {'Ocp-Apim-Subscription-Key': subscription_key}
-    params = {
-        'q': query,
-        'count': 20,
-        'freshness': f'{start_date}..{end_date}',
-        'responseFilter': 'Webpages'
-    }
-    
-    try:
-        response = requests.get(endpoint, headers=headers, params=params)
-        response.raise_for_status()
-        return response.json()
-    except requests.exceptions.RequestException as e:
-        if response.status_code == 429:  # Rate limit exceeded
-            retry_after = int(response.headers.get('Retry-After', 60))
-            time.sleep(retry_after)
-            return rate_limited_search(query, start_date, end_date, subscription_key, endpoint)
-        raise e
-
 def generate_search_queries(row):
     """Generate all search patterns for a given row"""
-    state = get_state_name(row['ST'])
-    county = row['CountyName']
+    state = get_state_name(row.st)
+    county = row_source.search_counties(row)  # all the counties of an operation plan row
     
     return {
         'pattern1': f"Immigration raid {county}, {state}",
@@ -87,84 +87,114 @@ def generate_search_queries(row):
     }
 
 def process_search_results(search_results, row_data, query, pattern):
-    """Process search results with error handling"""
+    """Process search results (search_providers.SearchResult) with error handling"""
     results = []
     try:
-        if search_results and 'webPages' in search_results and 'value' in search_results['webPages']:
-            for item in search_results['webPages']['value']:
+        if search_results:
+            for item in search_results:
                 results.append({
                     'query': query,
                     'search_pattern': pattern,
-                    'StateCountyFIPS': row_data['StateCountyFIPS'],
-                    'ST': row_data['ST'],
-                    'CountyName': row_data['CountyName'],
-                    'FIPSState': row_data['FIPSState'],
-                    'FIPSCounty': row_data['FIPSCounty'],
-                    'arrest_date': row_data['arrestdate'],
-                    'title': item.get('name', ''),
-                    'url': item.get('url', ''),
-                    'date_published': item.get('dateLastCrawled', '')
+                    'StateCountyFIPS': row_data.fips,
+                    'ST': row_data.st,
+                    'CountyName': row_data.county,
+                    'FIPSState': row_data.fips_state,
+                    'FIPSCounty': row_data.fips_county,
+                    'arrest_date': row_data.arrest_date.isoformat(),
+                    'title': item.title,
+                    'url': urls.add(item.link),
+                    'date_published': item.date
                 })
     except Exception as e:
         log_error(f"Error processing results: {str(e)}")
     return results
 
-def process_csv_and_search(csv_path, subscription_key, endpoint, batch_size=100):
-    """Process CSV in batches with error recovery"""
-    # Read CSV
-    df = pd.read_csv(csv_path)
+def results_in_window(search_results, start, end):
+    """The results dated between start and end, a merged state-level search covers more than one row's window"""
+    start, end = start.isoformat(), end.isoformat()
+    # undated results are kept, as the row's own search would have returned them too
+    return [item for item in search_results or [] if not item.published or start <= item.published <= end]
+
+def get_state_name(st):
+    """Full state name for a two letter state abbreviation"""
+    return list_states.get(st, st)
+
+def run_plan(plan, rows, state, provider, batch_size):
+    """Run planned searches and journal every row once all of its searches are done"""
+    # A row is done once every planned search serving it has run
+    remaining = defaultdict(int)
+    for planned in plan:
+        for row_id, _ in planned.targets:
+            remaining[row_id] += 1
+    row_results = defaultdict(list)
+    
+    for planned in tqdm(plan):
+        try:
+            search_results = provider.search(planned.query, planned.start, planned.end)
+        except Exception as e:
+            error_msg = f"Error in search {planned.query!r} for rows {[row_id for row_id, _ in planned.targets]}: {str(e)}"
+            log_error(error_msg)
+            state.record_error(e)
+            search_results = None
+        
+        # Fan the results out to every row and pattern this search serves
+        for row_id, pattern in planned.targets:
+            row = rows[row_id]
+            served = search_results
+            if (planned.start, planned.end) != (row.window_start, row.window_end):
+                served = results_in_window(search_results, row.window_start, row.window_end)
+            row_results[row_id].extend(process_search_results(served, row, planned.query, pattern))
+            remaining[row_id] -= 1
+            if remaining[row_id] > 0:
+                continue
+            
+            state.record_row(row_id, row_results.pop(row_id, []))
+            del rows[row_id]
+            
+            # Save checkpoint every batch_size rows
+            if len(state.processed_rows) % batch_size == 0:
+                state.save_checkpoint()
+                print(f"\nCheckpoint saved. Processed {len(state.processed_rows)} rows.")
+                print(f"Current error counts: {dict(state.error_counts)}")
+
+def process_csv_and_search(csv_path, subscription_key, endpoint, batch_size=100, output_format=OUTPUT_FORMAT,
+                           chunksize=row_source.DEFAULT_CHUNKSIZE, journal_file=JOURNAL_FILE,
+                           output_name='final_search_results', **shard_options):
+    """
+    Stream the CSV in chunks, plan (deduplicate) the searches of each chunk and run them with error recovery.
+    shard_options (start / stop or shard / num_shards) restrict the run to part of the input.
+    A delta of new abnormal days (anomaly_days --state) needs its own journal_file and output_name,
+    its row ids start over at 0.
+    """
+    provider = search_providers.BingProvider(subscription_key, endpoint, cache=search_cache)
     
     # Initialize or load state
-    state = SearchState(len(df))
+    state = SearchState(total_rows=None, journal_file=journal_file)
     if state.load_checkpoint():
         print(f"Resuming from checkpoint. {len(state.processed_rows)} rows already processed.")
     
     try:
-        # Process in batches
-        for start_idx in tqdm(range(0, len(df), batch_size)):
-            batch_df = df.iloc[start_idx:start_idx + batch_size]
-            
-            for _, row in batch_df.iterrows():
-                row_id = row.name
-                
+        for chunk in row_source.iter_chunks(csv_path, chunksize, window=SEARCH_WINDOW, **shard_options):
+            # Plan the searches of every remaining row in the chunk at once, so repeated queries are only sent once
+            rows = {}
+            planned_rows = []
+            for row in row_source.rows_of(chunk):
                 # Skip if already processed
-                if row_id in state.processed_rows:
+                if row.row_id in state.processed_rows:
+                    continue
+                if row.arrest_date is None:
+                    log_error(f"Error processing row {row.row_id}: invalid arrest date")
+                    state.record_error("invalid arrest date")
                     continue
                 
-                try:
-                    # Generate queries for all patterns
-                    queries = generate_search_queries(row)
-                    
-                    # Calculate date range
-                    start_date = format_date(pd.to_datetime(row['arrestdate']) + timedelta(days=-1))
-                    end_date = format_date(pd.to_datetime(row['arrestdate']) + timedelta(days=14))
-                    
-                    # Perform searches for each pattern
-                    for pattern, query in queries.items():
-                        try:
-                            search_results = rate_limited_search(
-                                query, start_date, end_date, 
-                                subscription_key, endpoint
-                            )
-                            results = process_search_results(search_results, row, query, pattern)
-                            state.current_results.extend(results)
-                        except Exception as e:
-                            error_msg = f"Error in search pattern {pattern} for row {row_id}: {str(e)}"
-                            log_error(error_msg)
-                            state.error_counts[str(e)] += 1
-                    
-                    state.processed_rows.add(row_id)
-                    
-                except Exception as e:
-                    error_msg = f"Error processing row {row_id}: {str(e)}"
-                    log_error(error_msg)
-                    state.error_counts[str(e)] += 1
-                
-                # Save checkpoint every 100 rows
-                if len(state.processed_rows) % 100 == 0:
-                    state.save_checkpoint()
-                    print(f"\nCheckpoint saved. Processed {len(state.processed_rows)} rows.")
-                    print(f"Current error counts: {dict(state.error_counts)}")
+                # Date range, computed for the whole chunk by row_source
+                planned_rows.append((row.row_id, generate_search_queries(row), row.window_start, row.window_end))
+                rows[row.row_id] = row
+            
+            plan = plan_queries(planned_rows)
+            print(f"{len(plan)} searches planned for {len(planned_rows)} rows "
+                  f"({sum(len(queries) for _, queries, _, _ in planned_rows)} without planning)")
+            run_plan(plan, rows, state, provider, batch_size)
     
     except KeyboardInterrupt:
         print("\nProcess interrupted by user. Saving progress...")
@@ -178,15 +208,17 @@ def process_csv_and_search(csv_path, subscription_key, endpoint, batch_size=100)
     
     finally:
         # Save final results
-        results_df = pd.DataFrame(state.current_results)
-        if not results_df.empty:
-            results_df.to_csv('final_search_results.csv', index=False)
+        state.save_checkpoint()
+        urls.save()
+        print(f"Searches: {search_providers.costs.summary()}")
+        if state.processed_rows:
+            save_results(state.journal, output_name, output_format)
         
         # Save error summary
         with open('error_summary.json', 'w') as f:
             json.dump(dict(state.error_counts), f, indent=2)
     
-    return results_df
+    return state.journal
 
 def main():
     # File paths and configuration
@@ -203,23 +235,21 @@ def main():
     
     try:
         # Process and search
-        results_df = process_csv_and_search(
+        journal = process_csv_and_search(
             full_dataset_path, 
             subscription_key, 
             endpoint,
             batch_size=100
         )
         
-        # Save final results
+        # Save final results, streamed out of the journal
         timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-        results_df.to_csv(f'search_results_all_patterns_{timestamp}.csv', index=False)
+        output_path = save_results(journal, f'search_results_all_patterns_{timestamp}')
         
-        # Clean up checkpoint files
-        for file in [CHECKPOINT_FILE, TEMP_RESULTS_FILE]:
-            if os.path.exists(file):
-                os.remove(file)
+        # Clean up the journal
+        journal.remove()
         
-        return results_df
+        return output_path
     
     except Exception as e:
         print(f"Error in main process: {str(e)}")
@@ -227,4 +257,4 @@ def main():
         return None
 
 if __name__ == "__main__":
-    results_df = main()
\ No newline at end of file
+    output_path = main()
\ No newline at end of file
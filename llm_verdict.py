@@ -0,0 +1,100 @@
+"""
+Schema of the gpt validation answer.
+
+The model answers the four validation questions as JSON, one boolean (plus
+its explanation) per question, together with the details it can pull out of
+the article. The answer is checked with pydantic, so a link is only rejected
+when the model actually answered no, never because "no" shows up somewhere in
+an explanation. Verdicts are stored as Verdict.record() in the verdict cache.
+
+An answer that does not match the schema parses to None; callers retry it or
+leave it out of the cache, so an unreadable answer is never remembered as a rejection.
+"""
+import json
+import re
+from typing import Optional
+
+from pydantic import BaseModel, ValidationError, field_validator
+
+QUESTIONS = ("mentions_location", "immigration_raid", "date_in_window", "conducted_by_ice")
+
+# appended to the questions, describes the JSON object we want back for one article (a str.format template like them)
+VERDICT_FORMAT = "{{\"mentions_location\": {{\"answer\": true or false, \"explanation\": \"...\"}},\
+        \n\"immigration_raid\": {{\"answer\": true or false, \"explanation\": \"...\"}},\
+        \n\"date_in_window\": {{\"answer\": true or false, \"explanation\": \"...\"}},\
+        \n\"conducted_by_ice\": {{\"answer\": true or false, \"explanation\": \"...\"}},\
+        \n\"arrests_in_county\": number of people arrested in {location} or null if not mentioned,\
+        \n\"total_arrests\": total number of people arrested in this raid or null if not mentioned,\
+        \n\"city\": city of the raid or null, \"raid_date\": date of the raid as YYYY-MM-DD or null}}"
+
+
+def parse_count(value):
+    """A count the model may have answered as text, "about 30" or "unknown" are no reason to throw away the answer"""
+    if isinstance(value, str):
+        match = re.search(r"\d[\d,]*", value)
+        return int(match.group(0).replace(",", "")) if match else None
+    return value
+
+
+class Answer(BaseModel):
+    answer: bool  # also accepts "yes" / "no"
+    explanation: str = ""
+
+
+class Verdict(BaseModel):
+    """The model's answer for one article"""
+    mentions_location: Answer
+    immigration_raid: Answer
+    date_in_window: Answer
+    conducted_by_ice: Answer
+    arrests_in_county: Optional[int] = None
+    total_arrests: Optional[int] = None
+    city: Optional[str] = None
+    raid_date: Optional[str] = None
+
+    @field_validator("arrests_in_county", "total_arrests", mode="before")
+    @classmethod
+    def _count(cls, value):
+        return parse_count(value)
+
+    @property
+    def valid(self):
+        """A link is valid only if all four questions were answered yes"""
+        return all(getattr(self, question).answer for question in QUESTIONS)
+
+    def explanation(self):
+        """The four answers as text, for the LLM_Analysis column"""
+        lines = []
+        for number, question in enumerate(QUESTIONS, 1):
+            answer = getattr(self, question)
+            lines.append(f"{number}. {'yes' if answer.answer else 'no'}, {answer.explanation}".rstrip(", "))
+        return "\n".join(lines)
+
+    def record(self):
+        return self.model_dump()
+
+
+# helper function to pull the json object out of the answer, models like to wrap it in ```json fences
+def json_object(content):
+    match = re.search(r"\{.*\}", content or "", re.DOTALL)
+    if match is None:
+        return None
+    try:
+        return json.loads(match.group(0))
+    except ValueError:
+        return None
+
+
+def to_verdict(value):
+    """Validate an already decoded answer, returns a Verdict or None"""
+    if not isinstance(value, dict):
+        return None
+    try:
+        return Verdict.model_validate(value)
+    except ValidationError:
+        return None
+
+
+def parse_verdict(content):
+    """Parse the model's answer for one article, returns a Verdict or None"""
+    return to_verdict(json_object(content))
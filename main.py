@@ -1,362 +1,508 @@
-from serpapi import GoogleSearch
-from bs4 import BeautifulSoup
 from dotenv import load_dotenv
 from datetime import datetime, timedelta
-import csv
 import os
-import requests
 import openai
-import threading
-
-list_states = {
-    "AK": "Alaska", "AL": "Alabama", "AR": "Arkansas", "AZ": "Arizona",
-    "CA": "California", "CO": "Colorado", "CT": "Connecticut",
-    "DE": "Delaware",
-    "FL": "Florida",
-    "GA": "Georgia",
-    "HI": "Hawaii",
-    "IA": "Iowa", "ID": "Idaho", "IL": "Illinois","IN": "Indiana",
-    "KS": "Kansas", "KY": "Kentucky",
-    "LA": "Louisiana",
-    "MA": "Massachusetts", "MD": "Maryland", "ME": "Maine", "MI": "Michigan", "MN": "Minnesota", "MO": "Missouri", "MS": "Mississippi", "MT": "Montana",
-    "NC": "North Carolina", "ND": "North Dakota", "NE": "Nebraska", "NH": "New Hampshire", "NJ": "New Jersey", "NM": "New Mexico", "NV": "Nevada", "NY": "New York",
-    "OH": "Ohio", "OK": "Oklahoma", "OR": "Oregon",
-    "PA": "Pennsylvania",
-    "RI": "Rhode Island",
-    "SC": "South Carolina",
-    "SD": "South Dakota",
-    "TN": "Tennessee", "TX": "Texas",
-    "UT": "Utah",
-    "VA": "Virginia", "VT": "Vermont",
-    "WA": "Washington", "WI": "Wisconsin", "WV": "West Virginia", "WY": "Wyoming",
-    "DC": "District of Columbia",
-    "AS": "American Samoa",
-    "GU": "Guam GU",
-    "MP": "Northern Mariana Islands",
-    "PR": "Puerto Rico PR",
-    "VI": "U.S. Virgin Islands",
-}
+import article_fetcher
+import batch_validator
+import llm_verdict
+import near_duplicates as near_duplicate_index
+import prefilter
+import search_providers
+import text_chunker
+import url_index
+import verdict_cache
+import result_sink
+import parquet_sink
+import row_source
+from us_states import list_states
+from rate_limiter import RateLimited, limiter
 
 # we hid the api keys, so we need to grab it from the env file
 load_dotenv("api_keys.env")
 api_key = os.getenv("SERPAPI_GOOGLE_SEARCH_KEY")
 open_ai_key = os.getenv("OPEN_AI_KEY")
 
+# calls per second allowed for each api, the limiter slows down further on its own when it gets throttled
+limiter.configure("serpapi", 5)
+limiter.configure("bing", 250)
+limiter.configure("gnews", 1)
+limiter.configure("openai", 50)
+
+SEARCH_PROVIDERS = ["serpapi"]  # search backends of search_providers, several are searched concurrently and merged
+SEARCH_WINDOW = (2, 14)  # days before and after the arrest date that the google search covers
+
 # helper function to help us calculate date params of the queries
 def calc_date(start_date):
     input_date = datetime.strptime(start_date, "%m/%d/%Y")
 
-    # calculations, 2 days before, 3 weeks after
-    two_days_before = input_date - timedelta(days=2)
-    two_weeks_after = input_date + timedelta(days=14)  
-    
+    # calculations, 2 days before, 2 weeks after
+    two_days_before = input_date - timedelta(days=SEARCH_WINDOW[0])
+    two_weeks_after = input_date + timedelta(days=SEARCH_WINDOW[1])
+
     return two_days_before.strftime("%m/%d/%Y"), two_weeks_after.strftime("%m/%d/%Y")
 
 
-def parse_csv(input_csv):
-    columns = ["arrestdate", "CountyName", "ST", "StateCountyFIPS", "FIPSState", "FIPSCounty"]  # columns where we want to select the data from
-    data = []
+# streams the input file as row_source.ArrestRow records (parsed arrest date, int FIPS codes)
+# the search window of every row is computed for whole chunks at once, see row_source.add_search_window
+# shard / num_shards and start / stop split the input between workers, see row_source.iter_chunks
+def parse_csv(input_csv, **shard_options):
+    return row_source.iter_rows(input_csv, window=SEARCH_WINDOW, **shard_options)
+
+
+GPT_MODEL = "gpt-3.5-turbo"  # change the gpt api version
+PREFILTER = True  # reject obvious negatives (no immigration terms, low relevance score) locally before they reach gpt
+NEAR_DUPLICATES = True  # validate only one article of every cluster of syndicated copies (near_duplicates)
+BATCH_VALIDATION = True  # check the articles of one search in batched gpt requests (batch_validator) instead of one request per link
+SYSTEM_PROMPT = "Analyze the provided text for specific information."
+# question we ask gpt to check, filled in with the location and date window of the search
+VALIDATION_QUESTION = "Here are four questions, please answer them all.\
+        \n1. Does this text mention {location} or {state}?\
+        \n2. Is the text related to immigration raids/arrests?\
+        \n3. Does this text mention the date and is the date of this immigration raid between {start} and {end}?\
+        \n4. Does this text confirm that the raid was conducted by Immigration and Customs Enforcement?\
+        \nReply with only a JSON object of this form:\n" + llm_verdict.VERDICT_FORMAT
+PROMPT_VERSION = verdict_cache.prompt_version(SYSTEM_PROMPT, VALIDATION_QUESTION)  # changes whenever the prompt does
+BATCH_PROMPT_VERSION = verdict_cache.prompt_version(SYSTEM_PROMPT, batch_validator.BATCH_QUESTION)
+
+# gpt verdicts, kept across runs and shared by all workers, and the links sent to manual check in this run
+verdicts = verdict_cache.VerdictCache()
+# optional classifier for the prefilter, trained with `python prefilter.py valid_results.csv invalid_results.csv`
+relevance_model = prefilter.load_classifier()
+# fingerprints of the articles seen so far, to find syndicated copies across searches and runs
+near_duplicates = near_duplicate_index.NearDuplicateIndex()
+# the search backend(s), answers are cached so no search is paid for twice
+search_provider = search_providers.make_provider(SEARCH_PROVIDERS, search_providers.SearchCache(), serpapi_key=api_key,
+                                                 bing_key=os.getenv("BING_SEARCH_KEY"))
+# canonical form of every link seen so far, so tracking / AMP / mobile variants of an article are handled as one link
+urls = url_index.UrlIndex()
+# article tokens scraped vs sent to gpt, for cost accounting
+token_meter = text_chunker.TokenMeter()
+
+# column layout of the three output files
+VALID_FIELDS = ["County", "State", "Arrest_Date", "Start_Date_Param", "End_Date_Param", "Article_Title", "Article_Link", "Article_Date", "LLM_Analysis", "StateCountyFIPS", "FIPSState", "FIPSCounty"]
+INVALID_FIELDS = ["County", "State", "Title", "Link", "Date", "LLM_Analysis"]
+MANUAL_FIELDS = ["County", "State", "Title", "Link", "Date"]
+
+
+# helper function to run one google search and return its organic results (as dicts, see search_providers.SearchResult)
+def search_google(query, start, end):
+    organic_results = canonical_results([result._asdict() for result in search_provider.search(query, start, end)])
+    print(f"Results found: {len(organic_results)}")  # debugging line
+    return organic_results
+
+
+# helper function that swaps every link for the first variant of it we have seen (url_index) and drops the
+# variants of a link that already came up in the same search, so each article is fetched and validated once
+def canonical_results(organic_results):
+    unique = []
+    seen = set()
+    for result in organic_results:
+        link = result.get("link")
+        if link:
+            canonical = url_index.canonical_url(link)
+            if canonical in seen:
+                continue
+            seen.add(canonical)
+            result["link"] = urls.add(link)
+        unique.append(result)
+    return unique
+
+
+NEEDS_GPT = "gpt"  # precheck_result bucket for results that still need a gpt verdict
+
+
+# helper function with the checks that run before any gpt call
+# returns (bucket, explanation) when the result is decided without gpt, (None, "") if the link was already sent to manual check,
+# or (NEEDS_GPT, passages) with the text_chunker.Passages of the lowered text that still have to be checked by gpt
+def precheck_result(result, text, county, state, start, end):
+    link = result.get("link", "N/A")
+    publish_date = result.get("date", "N/A")
+    published = result.get("published")  # "YYYY-MM-DD" whatever date format the search backend uses
+    publish_year = published[:4] if published else publish_date[-4:]  # grab the year
+
+    if verdicts.is_manual_check(link):
+        return None, ""
+
     try:
-        with open(input_csv, newline='') as csvfile:
-            csv_reader = csv.reader(csvfile)
-            header = next(csv_reader)
-            
-            column_indices = [header.index(col) for col in columns if col in header]
-            for row in csv_reader:  # each row with have 3 items: "arrestdate", "CountyName", "ST"
-                data.append([row[i] for i in column_indices])
-    
+        # Check if text is not None and its length, check if we need to cut down on the text due to gpt api limitations
+        if text == False or text is None or len(text) == 0:
+            if text == False:  # check if parsing is taking too long
+                print(f"Timeout or error occurred while scraping {link}")
+            else:
+                print(f"No text found at {link}")  # Log if no text was scraped
+            if publish_date != "N/A" and int(publish_year) > 2014:  # initial date validation
+                if not verdicts.mark_manual_check(link):
+                    return None, ""  # another worker already sent this link to manual check
+                return "manual", ""
+            return "invalid", ""
+        else:
+            text = text.lower()
     except Exception as e:
-        print(f"Error processing CSV file: {e}")  # if the input csv is not valid
-
-    return data
-
-
-link_attributes = {}  # store the information of duplicated links
-manual_check_link_attributes = {}  # store the information of duplicated links that need to be manually checked
-# helper function that will do all the searching and writing into the output csv file
-def helper(query, county, state, start, end, csv_path1, csv_path2, csv_path3, date, scFIPs, fipsS, fipsC):
-    params = {
-        "engine": "google",
-        "q": query,
-        "api_key": api_key,
-        "google_domain": "google.com",
-        "gl": "us",
-        "hl": "en",
-        "tbs": f"cdr:1,cd_min:{start},cd_max:{end}",
-        "num": 10,
-        "sort": "date"
+        print(f"Error processing text from {link}: {e}")
+        return "invalid", ""
+
+    if publish_date != "N/A" and int(publish_year) < 2014:  # initial date validation
+        return "invalid", ""
+    if (state.lower() not in text) and (list_states[state].lower() not in text):  # initial location check
+        return "invalid", ""
+    if PREFILTER:  # local relevance check, obvious negatives never reach gpt
+        relevance = prefilter.check(text, county, state, start, end, relevance_model)
+        if relevance.reject:
+            return "invalid", relevance.reason
+    return NEEDS_GPT, shorten_text(text, county, state, start, end)  # only the passages that matter go to gpt
+
+
+# helper function to look up a verdict built by either the single-article or the batched prompt
+# returns (valid, explanation, record) or None, record is the llm_verdict.Verdict fields
+def cached_verdict(link, text, location, start, end):
+    for version in (PROMPT_VERSION, BATCH_PROMPT_VERSION):
+        cached = verdicts.get(link, text, location, start, end, GPT_MODEL, version)
+        if cached is not None:
+            return cached
+    return None
+
+
+# helper function that decides which output file a single search result belongs to
+# returns ("valid" | "invalid" | "manual", gpt_explanation), or (None, "") if the link was already sent to manual check
+def classify_result(result, text, county, state, start, end, date):
+    link = result.get("link", "N/A")
+    location = f"{county}, {state}"
+    bucket, passages = precheck_result(result, text, county, state, start, end)
+    if bucket != NEEDS_GPT:
+        return bucket, passages  # the explanation here
+
+    # only pay for a gpt call if this exact text has not been checked for this location and date window
+    text = passages.text
+    cached = cached_verdict(link, text, location, start, end)
+    if cached is not None:
+        gpt_res, gpt_explanation, _ = cached
+    else:
+        token_meter.add(passages)
+        gpt_res, gpt_explanation, record = analyze_with_chatgpt(text, state, location, start, end)
+        if record is not None:  # an answer we could not read is not remembered as a rejection
+            verdicts.put(link, text, location, start, end, GPT_MODEL, PROMPT_VERSION, gpt_res, gpt_explanation, record)
+    return ("valid" if gpt_res == True else "invalid"), gpt_explanation
+
+
+# helper function that folds syndicated copies together, so only one article per near-duplicate cluster goes to gpt
+# copies of a story that already has a verdict for this search are decided right away
+# returns the pending (index, text) that still need gpt and, for each of them, the (index, text) of its copies
+def group_near_duplicates(organic_results, pending, location, start, end, decided):
+    leaders = []
+    copies = {}
+    leader_of_cluster = {}
+    for i, text in pending:
+        link = organic_results[i].get("link", "N/A")
+        cluster = near_duplicates.add(link, text)
+        if cluster in leader_of_cluster:
+            copies[leader_of_cluster[cluster]].append((i, text))
+            continue
+        others = [url for url in near_duplicates.members(cluster) if url != link]
+        cached = verdicts.get_for_urls(others, location, start, end, GPT_MODEL, (PROMPT_VERSION, BATCH_PROMPT_VERSION))
+        if cached is not None:
+            decided[i] = ("valid" if cached[0] else "invalid", f"Same story as {cluster}\n{cached[1]}")
+            continue
+        leader_of_cluster[cluster] = i
+        copies[i] = []
+        leaders.append((i, text))
+    return leaders, copies
+
+
+# helper function that classifies all the results of one search, with the gpt checks batched into as few requests as possible
+# with an offline_batch (batch_validator.OfflineBatch) the gpt checks are queued for the batch api instead,
+# those results are left out and written by collect_offline_batch once the job is done
+# returns a list of (bucket, output row)
+def validate_results(organic_results, texts, county, state, start, end, date, scFIPs, fipsS, fipsC, row_id=None,
+                     offline_batch=None):
+    location = f"{county}, {state}"
+    decided = {}  # result index -> (bucket, gpt_explanation)
+    pending = []  # (result index, text) still needing a gpt verdict
+    shortened = {}  # result index -> its text_chunker.Passages, metered once they are really sent
+    for i, (result, text) in enumerate(zip(organic_results, texts)):
+        try:
+            if not BATCH_VALIDATION and offline_batch is None:
+                decided[i] = classify_result(result, text, county, state, start, end, date)
+                continue
+            bucket, passages = precheck_result(result, text, county, state, start, end)
+            if bucket != NEEDS_GPT:
+                decided[i] = (bucket, passages)  # the explanation here
+                continue
+            cached = cached_verdict(result.get("link", "N/A"), passages.text, location, start, end)
+            if cached is not None:
+                decided[i] = ("valid" if cached[0] else "invalid", cached[1])
+            else:
+                pending.append((i, passages.text))
+                shortened[i] = passages
+        except Exception as e:
+            print(f"Error validating {result.get('link', 'N/A')}: {e}")
+
+    copies = {i: [] for i, _ in pending}
+    if pending and NEAR_DUPLICATES:
+        pending, copies = group_near_duplicates(organic_results, pending, location, start, end, decided)
+    for i, _ in pending:  # only the articles that really go to gpt count in token_meter
+        token_meter.add(shortened[i])
+
+    if pending and offline_batch is not None:
+        def context(i, text):
+            return {"row_id": row_id, "result": {key: organic_results[i].get(key, "N/A") for key in ("title", "link", "date")},
+                    "county": county, "state": state, "start": start, "end": end, "date": date,
+                    "scFIPs": scFIPs, "fipsS": fipsS, "fipsC": fipsC, "text_hash": verdict_cache.content_hash(text)}
+        contexts = [dict(context(i, text), copies=[context(j, copy_text) for j, copy_text in copies[i]])
+                    for i, text in pending]
+        offline_batch.add([text for _, text in pending], state, location, start, end, contexts)
+    elif pending:
+        try:
+            answers = analyze_batch_with_chatgpt([text for _, text in pending], state, location, start, end)
+        except Exception as e:
+            print(f"Error validating {len(pending)} results for {location}: {e}")
+            answers = []
+        for (i, text), (gpt_res, gpt_explanation, record, version) in zip(pending, answers):
+            link = organic_results[i].get("link", "N/A")
+            if record is not None:
+                verdicts.put(link, text, location, start, end, GPT_MODEL, version, gpt_res, gpt_explanation, record)
+            decided[i] = ("valid" if gpt_res == True else "invalid", gpt_explanation)
+            for j, copy_text in copies[i]:  # syndicated copies share the verdict, each keeps its own link
+                decided[j] = (decided[i][0], f"Same story as {link}\n{gpt_explanation}")
+
+    rows = []
+    for i, result in enumerate(organic_results):  # keep the order of the search results
+        bucket, gpt_explanation = decided.get(i, (None, ""))
+        if bucket is not None:
+            rows.append((bucket, result_row(bucket, result, county, state, start, end, date, gpt_explanation, scFIPs, fipsS, fipsC)))
+    return rows
+
+
+# helper function that builds the output row for a classified search result
+def result_row(bucket, result, county, state, start, end, date, gpt_explanation, scFIPs, fipsS, fipsC):
+    if bucket == "valid":
+        return {
+            "County": county,
+            "State": state,
+            "Arrest_Date": date,
+            "Start_Date_Param": start,
+            "End_Date_Param": end,
+            "Article_Title": result.get("title", "N/A"),
+            "Article_Link": result.get("link", "N/A"),
+            "Article_Date": result.get("date", "N/A"),
+            "LLM_Analysis": gpt_explanation,
+            "StateCountyFIPS": scFIPs,
+            "FIPSState": fipsS,
+            "FIPSCounty": fipsC
+        }
+    row = {
+        "Title": result.get("title", "N/A"),
+        "Link": result.get("link", "N/A"),
+        "Date": result.get("date", "N/A"),
+        "County": county,
+        "State": state
     }
+    if bucket == "invalid":
+        row["LLM_Analysis"] = gpt_explanation
+    return row
+
+
+# helper function that will do all the searching and writing into the output csv files
+def helper(query, county, state, start, end, sinks, date, scFIPs, fipsS, fipsC, row_id=None, offline_batch=None):
     try:
-        search = GoogleSearch(params)
-        # print(search)  # for testing
-        results = search.get_dict()
-        # print(results)  # for testing
-        organic_results = results.get("organic_results", [])
-        print(f"Results found: {len(organic_results)}")  # debugging line
-        location = f"{county}, {state}"
-
-        for result in organic_results:
-            link = result.get("link", "N/A")
-            # print(link)
-            text = scrape_article_text(link)  # scrape the text of link
-            # print(text)
-
-            publish_date = result.get("date", "N/A") 
-            publish_year = publish_date[-4:] # grab the year
-            # print(list_states[state])
-            # print(state)
-            # print(link_attributes)
-
-            valid_results = []  # stores the links that passes the chatgpt analysis
-            invalid_results = []  # stores the links that does not pass the chatgpt analysis
-            manual_check_results = []  # stores the links that needs to be manually checked since paywalls, popups, or other reasons that prevent parsing
+        organic_results = search_google(query, start, end)
+        texts = scrape_article_texts([result.get("link", "N/A") for result in organic_results])  # scrape the text of every link
 
-            try:
-                # Check if text is not None and its length, check if we need to cut down on the text due to gpt api limitations
-                if link in manual_check_link_attributes:
-                    break
-                else:
-                    if text == False:  # check if parsing is taking too long
-                        print(f"Timeout or error occurred while scraping {link}")
-                        if (publish_date != "N/A" and int(publish_year) > 2014) or \
-                        (state.lower() in text) or (list_states[state].lower() in text):  # initial date validation and location check
-                            manual_check_results.append(result)
-                            manual_check_link_attributes[link] = 1
-
-                    elif text is None or len(text) == 0:
-                        # Log if no text was scraped
-                        print(f"No text found at {link}")
-                        text = ""  # Set text to an empty string to handle further processing safely
-                        if (publish_date != "N/A" and int(publish_year) > 2014) or \
-                        (state.lower() in text) or (list_states[state].lower() in text):  # initial date validation and location check
-                            manual_check_results.append(result)
-                            manual_check_link_attributes[link] = 1
-                    
-                    elif text is not None and len(text) > 5000:
-                        text = text.lower()
-                        text = shorten_text(text)
-
-                    else:
-                        text = text.lower()
-
-
-            except Exception as e:
-                print(f"Error processing text from {link}: {e}")
-                text = ""  # Set text to an empty string to ensure the remaining code can execute
-                invalid_results.append(result)
-
-            gpt_explanation = ""
-            if result not in manual_check_results:
-                if publish_date != "N/A" and int(publish_year) < 2014:  # initial date validation
-                    invalid_results.append(result)
-                elif (state.lower() not in text) and (list_states[state].lower() not in text):  # initial location check
-                    invalid_results.append(result)
-                else:
-                    if link not in link_attributes:  # check if link has already been seen, not seen create new entry in dictionary
-                        gpt_res, gpt_explanation = analyze_with_chatgpt(text, state, location, start, end)
-                        link_attributes[link] = [location, end, gpt_explanation, gpt_res]  # add new link to the dictionary
-                        # print(link_attributes)  # for testing
-                        if gpt_res == True:
-                            valid_results.append(result)
-                        else:
-                            invalid_results.append(result)     
-                    else:
-                        if location.lower() != link_attributes[link][0].lower() or date > link_attributes[link][1]:  # different location or later than current end date
-                            gpt_res, gpt_explanation = analyze_with_chatgpt(text, state, location, start, end)
-                            link_attributes[link] = [location, end, gpt_explanation, gpt_res]  # update dictionary contents
-                            if gpt_res == True:
-                                valid_results.append(result)   
-                        else:
-                            gpt_explanation = link_attributes[link][2]
-                            if link_attributes[link][3] == True:
-                                valid_results.append(result)
-                    
-            # write the contents of the valid results file
-            with open(csv_path1, 'a', newline='', encoding='utf-8') as file:
-                writer = csv.DictWriter(file, fieldnames=["County", "State", "Arrest_Date", "Start_Date_Param", "End_Date_Param", "Article_Title", "Article_Link", "Article_Date", "LLM_Analysis", "StateCountyFIPS", "FIPSState", "FIPSCounty"])
-                for result in valid_results:
-                    writer.writerow({
-                        # "Query": query,
-                        "County": county,
-                        "State": state,
-                        "Arrest_Date": date,
-                        "Start_Date_Param": start,
-                        "End_Date_Param": end,
-                        "Article_Title": result.get("title", "N/A"),
-                        "Article_Link": result.get("link", "N/A"),
-                        "Article_Date": result.get("date", "N/A"),
-                        "LLM_Analysis": gpt_explanation,
-                        "StateCountyFIPS": scFIPs,
-                        "FIPSState": fipsS,
-                        "FIPSCounty": fipsC
-                    })
-            # write the contents of the invalid results file
-            with open(csv_path2, 'a', newline='', encoding='utf-8') as file:
-                writer = csv.DictWriter(file, fieldnames=["County", "State", "Title", "Link", "Date", "LLM_Analysis"])
-                for result in invalid_results:
-                    writer.writerow({
-                        # "Query": query,
-                        "Title": result.get("title", "N/A"),
-                        "Link": result.get("link", "N/A"),
-                        "Date": result.get("date", "N/A"),
-                        "County": county,
-                        "State": state,
-                        "LLM_Analysis": gpt_explanation
-                    })
-            # write the contents of the manual check results file
-            with open(csv_path3, 'a', newline='', encoding='utf-8') as file:
-                writer = csv.DictWriter(file, fieldnames=["County", "State", "Title", "Link", "Date"])
-                for result in manual_check_results:
-                    writer.writerow({
-                        # "Query": query,
-                        "Title": result.get("title", "N/A"),
-                        "Link": result.get("link", "N/A"),
-                        "Date": result.get("date", "N/A"),
-                        "County": county,
-                        "State": state
-                    })
+        for bucket, row in validate_results(organic_results, texts, county, state, start, end, date, scFIPs, fipsS, fipsC,
+                                            row_id, offline_batch):
+            sinks.write(bucket, row, row_id)
     except Exception as e:
         print(f"Error during search or file writing: {e}")
 
 
-# helper function to reduce text from scraped results
-def shorten_text(text):
-    new_text = text[:12288] # 88888 for gpt-4-turbo
-    return new_text
+# helper function to reduce text from scraped results to the passages most relevant to the search
+# that fit in the token budget of GPT_MODEL (see text_chunker)
+# returns the text_chunker.Passages, the callers add them to token_meter when they are really sent to gpt
+def shorten_text(text, county=None, state=None, start=None, end=None):
+    return text_chunker.select_passages(text, county, state, start, end,
+                                        text_chunker.token_budget(GPT_MODEL), GPT_MODEL)
 
 
 # helper function to scrape text of links from google search api results
-def scrape_article_text(url, timeout=8):  # puts a timer of 15 seconds total
-    class ContentFetcher(threading.Thread):
-        def __init__(self, url):
-            super().__init__()
-            self.url = url
-            self.result = None
-
-        def run(self):
-            try:
-                response = requests.get(self.url, timeout=6)  # ensures the request itself also respects a timeout
-                if response.status_code == 200:
-                    soup = BeautifulSoup(response.text, 'html.parser')
-                    self.result = soup.get_text(separator=' ', strip=True)
-            except Exception as e:
-                print(f"Error scraping {self.url}: {e}")
-                self.result = None
+def scrape_article_text(url, timeout=8):
+    return article_fetcher.fetch_article_text(url, timeout)  # checks the local article store first, returns scraped text if success, None if error with scraping, or False if over time limit
+
 
-    fetcher = ContentFetcher(url)
-    fetcher.start()
-    fetcher.join(timeout)
-    if fetcher.is_alive():
-        fetcher.result = False  # indicate a timeout happened
-        fetcher.join()  # ensure the thread finishes
+# helper function to scrape all the links of one search concurrently, texts come back in the same order as the links
+def scrape_article_texts(links, timeout=8):
+    return article_fetcher.fetch_article_texts(links, timeout)
 
-    return fetcher.result  # returns scraped text if success, None if error with scraping, or False if over time limit
+
+# helper function that sends one chat completion, 429s are raised as RateLimited so the limiter can back off
+def _chat_completion(messages):
+    try:
+        return openai.ChatCompletion.create(model=GPT_MODEL, messages=messages, response_format={"type": "json_object"})
+    except openai.error.RateLimitError as e:
+        headers = e.headers or {}
+        raise RateLimited(headers.get("retry-after"), str(e))
 
 
 # helper function to check validity of the links
+# returns (valid, explanation, record), record is None if gpt twice answered something that does not fit the schema
 def analyze_with_chatgpt(text, state, location, start, end):
     openai.api_key = open_ai_key
-    # print(date, location)
-
-    # questions we ask gpt to check
-    questions = [
-        f"Here are four questions, please answer them all.\
-        \n1. Does this text mention {location} or {state}? Explicitly say yes or no in the first word of your response along with your explanation.\
-        \n2. Is the text related to immigration raids/arrests? Explicitly say yes or no in the first word of your response along with your explanation.\
-        \n3. Does this text mention the date and is the date of this immigration raid between {start} and {end}? Explicitly say yes or no in the first word of your response along with your explanation.\
-        \n4. Does this text confirm that the raid was conducted by Immigration and Customs Enforcement? Explicitly say yes or no in the first word of your response along with your explanation."
-
-
-        # number of arrests that occured in this specific {county} if mention
-        # total arrests of this immigration raid if mention
-        # list the city in this immigration raid
-        # list the county name
-        # target 12345
-        # how many of them have previous conviction
-        # how many female if mention
-        # what are the nationality of those people in this specific {county}
-    ]
-        
-    # res = []
-    for question in questions:
-        response = openai.ChatCompletion.create(
-            model="gpt-3.5-turbo", # change the gpt api version
-            messages=[
-                {"role": "system", "content": "Analyze the provided text for specific information."},
-                {"role": "user", "content": text},
-                {"role": "user", "content": question}
-            ]
-        )
-        # print(question + ":")
-        answer = response['choices'][0]['message']['content'].strip().lower() # grab the response from gpt for the question
-        # words = answer.split()  # Split the response into words
-        # print(answer + "\n")  # for debugging
-        if "no." in answer or "no," in answer or "no " in answer or "no*" in answer:
-            return False, answer
-    
-    # no longer need this since we only have one question
-    # for item in res:
-    #     if item == False:  # mark link as invalid if any of the gpt questions did not pass
-    #         return False
-    return True, answer
-
-
-def search_and_export(data):
-    # Get the path to the desktop directory
-    desktop_path = os.path.join(os.path.expanduser("~"), "Desktop")
-    # Define the full path to the CSV files on the desktop
-    output_csv1 = os.path.join(desktop_path, "valid_results.csv")
-    output_csv2 = os.path.join(desktop_path, "invalid_results.csv")
-    output_csv3 = os.path.join(desktop_path, "manual_check_results.csv")
-
-    # check if the files exists, otherwise create and write the header
-    if not os.path.exists(output_csv1):  # valid_results
-        with open(output_csv1, 'w', newline='', encoding='utf-8') as file:
-            writer = csv.DictWriter(file, ["County", "State", "Arrest_Date", "Start_Date_Param", "End_Date_Param", "Article_Title", "Article_Link", "Article_Date", "LLM_Analysis", "StateCountyFIPS", "FIPSState", "FIPSCounty"])
-            writer.writeheader()
-    if not os.path.exists(output_csv2):  # invalid_results
-        with open(output_csv2, 'w', newline='', encoding='utf-8') as file:
-            writer = csv.DictWriter(file, fieldnames=["County", "State", "Title", "Link", "Date"])
-            writer.writeheader()
-    if not os.path.exists(output_csv3):  # manual_check_results
-        with open(output_csv2, 'w', newline='', encoding='utf-8') as file:
-            writer = csv.DictWriter(file, fieldnames=["County", "State", "Title", "Link", "Date"])
-            writer.writeheader()
-
-    # Process each query and append results to the CSV
-    # i = 0  # limit counter for testing
-    for arrestdate, county, state, scFIPs, fipsS, fipsC in data:
-        # if i == 20: break  # limit counter for testing
-        # print(arrestdate)  # for debugging
-
-        # since the dates provided in csv are m/dd/yy we need to fix the format year
-        # year = arrestdate[-2:]
-        # no_year = arrestdate[:-2]
-        # year = "20" + year
-        arrestdate = arrestdate[:-2] + "20" + arrestdate[-2:]
-        # print(arrestdate)  # for testing
-
+    question = VALIDATION_QUESTION.format(location=location, state=state, start=start, end=end)
+
+    answer = ""
+    for attempt in range(2):  # ask once more if the answer does not parse
+        response = limiter.call("openai", _chat_completion, [
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "user", "content": text},
+            {"role": "user", "content": question}
+        ])
+        answer = response['choices'][0]['message']['content'].strip()  # grab the response from gpt for the question
+        verdict = llm_verdict.parse_verdict(answer)
+        if verdict is not None:
+            return verdict.valid, verdict.explanation(), verdict.record()  # valid only if all four answers are yes
+        print(f"Could not read the gpt answer for {location}: {answer[:200]}")
+    return False, answer, None
+
+
+# helper function to check several articles of the same search in as few gpt requests as possible
+# returns (valid, explanation, record, prompt version) for every text, in order
+# articles the batched answer leaves out are checked again one by one with analyze_with_chatgpt
+def analyze_batch_with_chatgpt(texts, state, location, start, end):
+    openai.api_key = open_ai_key
+    answers = [None] * len(texts)
+    for indexes in batch_validator.pack_articles(texts):
+        if len(indexes) > 1:
+            response = limiter.call("openai", _chat_completion, batch_validator.batch_messages(
+                SYSTEM_PROMPT, [texts[i] for i in indexes], state, location, start, end))
+            pack_verdicts = batch_validator.parse_batch_answer(response['choices'][0]['message']['content'], len(indexes))
+            for i, verdict in zip(indexes, pack_verdicts):
+                if verdict is not None:
+                    answers[i] = (verdict.valid, verdict.explanation(), verdict.record(), BATCH_PROMPT_VERSION)
+        for i in indexes:
+            if answers[i] is None:
+                answers[i] = analyze_with_chatgpt(texts[i], state, location, start, end) + (PROMPT_VERSION,)
+    return answers
+
+
+# helper function that opens the three output files, creating each one with its header if it does not exist
+# backend="parquet" writes typed parquet datasets partitioned by state (and arrest year for the valid results) instead
+# extra_fields are added to every file (the sharded runner uses this to tag rows with their input row)
+def open_output_sinks(output_dir=None, backend="csv", extra_fields=()):
+    if output_dir is None:
+        output_dir = os.path.join(os.path.expanduser("~"), "Desktop")  # Get the path to the desktop directory
+    if backend == "parquet":
+        return result_sink.ResultSinks({
+            "valid": parquet_sink.ParquetSink(os.path.join(output_dir, "valid_results"), VALID_FIELDS + list(extra_fields),
+                                              parquet_sink.MAIN_COLUMN_TYPES, ("State", "year"), year_from="Arrest_Date"),
+            "invalid": parquet_sink.ParquetSink(os.path.join(output_dir, "invalid_results"), INVALID_FIELDS + list(extra_fields),
+                                                parquet_sink.MAIN_COLUMN_TYPES, ("State",)),
+            "manual": parquet_sink.ParquetSink(os.path.join(output_dir, "manual_check_results"), MANUAL_FIELDS + list(extra_fields),
+                                               parquet_sink.MAIN_COLUMN_TYPES, ("State",)),
+        })
+    return result_sink.ResultSinks({
+        "valid": result_sink.CsvSink(os.path.join(output_dir, "valid_results.csv"), VALID_FIELDS + list(extra_fields)),
+        "invalid": result_sink.CsvSink(os.path.join(output_dir, "invalid_results.csv"), INVALID_FIELDS + list(extra_fields)),
+        "manual": result_sink.CsvSink(os.path.join(output_dir, "manual_check_results.csv"), MANUAL_FIELDS + list(extra_fields)),
+    })
+
+
+# helper function that turns one input row into the query and date params used for searching
+def prepare_row(row):
+    if row.arrest_date is None:
+        raise ValueError(f"row {row.row_id} has no valid arrest date")
+    arrestdate = row.arrest_date.strftime("%m/%d/%Y")
+    if row.window_start is not None:
+        start_date, end_date = row.window_start.strftime("%m/%d/%Y"), row.window_end.strftime("%m/%d/%Y")
+    else:
         start_date, end_date = calc_date(arrestdate)
-        arrestdate = datetime.strptime(arrestdate, "%m/%d/%Y")
-        arrestdate = arrestdate.strftime("%m/%d/%Y")
-        # start_date, end_date = calc_date("2/10/2017")
-        # print(start_date, end_date, county, state)  # for testing
-
-        query = f"Immigration Raid/Arrest, {county}, {state}"  # the query sent to the helper function
-        # query = f"Immigration Raid/Arrest, {"Terrebonne"}, {"LA"}"  # for testing
-        # print(query)  # for testing
-        helper(query, county, state, start_date, end_date, output_csv1, output_csv2, output_csv3, arrestdate, scFIPs, fipsS, fipsC)
-        # helper(query, "Terrebonne", "LA", start_date, end_date, output_csv1, output_csv2, arrestdate)  # for testing
-        
-        # i += 1 # limit counter for testing
+
+    # the query sent to the helper function, naming every county of an operation (row_source.search_counties)
+    query = f"Immigration Raid/Arrest, {row_source.search_counties(row)}, {row.st}"
+    return query, start_date, end_date, arrestdate
+
+
+CHECKPOINT_EVERY = 100  # rows between two fsyncs of the output files
+
+
+# offline_batch (a batch_validator.OfflineBatch) queues the gpt checks for the batch api instead of calling gpt,
+# see submit_offline_batch and collect_offline_batch
+def search_and_export(data, output_dir=None, backend="csv", sinks=None, offline_batch=None):
+    with (sinks or open_output_sinks(output_dir, backend)) as sinks:
+        # Process each query and append results to the CSV
+        for i, row in enumerate(data, 1):
+            try:
+                query, start_date, end_date, arrestdate = prepare_row(row)
+            except ValueError as e:
+                print(f"Skipping row: {e}")
+                continue
+            helper(query, row.county, row.st, start_date, end_date, sinks, arrestdate, row.fips, row.fips_state, row.fips_county,
+                   row.row_id, offline_batch)
+            sinks.row_done(row.row_id)
+            if i % CHECKPOINT_EVERY == 0:
+                sinks.checkpoint()
+
+# runs the search and scraping for data, writes every result that needs no gpt check and
+# submits the rest as one batch api job (half the price of live calls, done within 24 hours)
+def submit_offline_batch(data, batch_dir="llm_batches", output_dir=None, backend="csv"):
+    job = batch_validator.OfflineBatch(batch_dir, GPT_MODEL, SYSTEM_PROMPT)
+    if job.submitted_job() is not None:  # its requests are still in batch_dir, collect them first
+        print(f"Batch job {job.submitted_job()} has not been collected yet, run collect_offline_batch first")
+        return None
+    search_and_export(data, output_dir, backend, offline_batch=job)
+    if job.count == 0:
+        print("Nothing left for gpt to check")
+        return None
+    job_id = job.submit(open_ai_key)
+    print(f"Submitted {job.count} gpt requests as batch job {job_id}")
+    return job_id
+
+
+# helper function that stores one offline batch verdict and writes its output row
+def write_collected_result(sinks, context, verdict):
+    result = context["result"]
+    location = f"{context['county']}, {context['state']}"
+    gpt_explanation = ""
+    if verdict is None:
+        if not verdicts.mark_manual_check(result["link"]):
+            return
+        bucket = "manual"
+    else:
+        gpt_explanation = verdict.explanation()
+        verdicts.put(result["link"], None, location, context["start"], context["end"], GPT_MODEL,
+                     BATCH_PROMPT_VERSION, verdict.valid, gpt_explanation, verdict.record(),
+                     text_hash=context["text_hash"])
+        bucket = "valid" if verdict.valid else "invalid"
+    sinks.write(bucket, result_row(bucket, result, context["county"], context["state"], context["start"],
+                                   context["end"], context["date"], gpt_explanation, context["scFIPs"],
+                                   context["fipsS"], context["fipsC"]), context["row_id"])
+
+
+# once the batch job is completed, stores its verdicts in the verdict cache and writes the remaining results
+# results the batch could not answer go to the manual check file
+def collect_offline_batch(batch_dir="llm_batches", output_dir=None, backend="csv"):
+    job = batch_validator.OfflineBatch(batch_dir, GPT_MODEL, SYSTEM_PROMPT)
+    status = job.status(open_ai_key)
+    if status != "completed":
+        print(f"Batch job is {status}, try again later")
+        return False
+    with open_output_sinks(output_dir, backend) as sinks:
+        for leader, verdict in job.collect(open_ai_key):
+            for context in [leader] + leader.get("copies", []):  # syndicated copies share the leader's verdict
+                write_collected_result(sinks, context, verdict)
+    job.mark_collected()  # written, a later job must not send or write these requests again
+    return True
+
 
 def main():
     desktop_path = os.path.join(os.path.expanduser("~"), "Desktop")
     input_csv = os.path.join(desktop_path, "abnormal_arrest_dates.csv")
     data = parse_csv(input_csv)
     search_and_export(data)
+    print(f"Article text sent to gpt: {token_meter.summary()}")
+    print(f"Links swapped for an earlier variant of the same article: {urls.variants_merged}")
+    print(f"Searches: {search_providers.costs.summary()}")
+    urls.save()
     print(f"Organic search results have been exported to {os.path.join(desktop_path, 'valid_results.csv')}")
     print(f"Organic search results have been exported to {os.path.join(desktop_path, 'invalid_results.csv')}")
     print(f"Organic search results have been exported to {os.path.join(desktop_path, 'manual_check_results.csv')}")
 
-main()
\ No newline at end of file
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+"""
+Near-duplicate index of scraped articles, so syndicated copies are only validated once.
+
+Wire stories and ICE press releases are republished by dozens of local outlets
+under different URLs. Every article gets a 64 bit SimHash of its word
+shingles. Two articles whose fingerprints differ in at most max_distance bits
+are the same story. Fingerprints are split into four 16 bit bands and indexed
+per band, so by the pigeonhole principle any fingerprint within 3 bits shares
+at least one band with its match and is found with an indexed lookup.
+
+Every article joins the cluster of the closest earlier article, or starts its
+own. The cluster is named after its first article (the representative), whose
+verdict is reused for the other members.
+
+The index lives in sqlite like the verdict cache, so it grows across runs
+without growing memory, and the least recently used fingerprints are evicted
+beyond max_entries.
+"""
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+NEAR_DUPLICATES_FILE = 'near_duplicates.sqlite3'
+DEFAULT_MAX_ENTRIES = 2_000_000
+DEFAULT_MAX_DISTANCE = 3  # bits, must stay below the number of bands for the band lookup to be exact
+SHINGLE_WORDS = 3
+BANDS = 4
+EVICTION_CHECK_EVERY = 1000
+
+_WORD_RE = re.compile(r"\w+")
+
+
+def simhash(text, shingle_words=SHINGLE_WORDS):
+    """64 bit SimHash of the word shingles of text, as a python int"""
+    words = _WORD_RE.findall(text.lower())
+    if len(words) < shingle_words:
+        shingles = [" ".join(words)]
+    else:
+        shingles = [" ".join(words[i:i + shingle_words]) for i in range(len(words) - shingle_words + 1)]
+    hashes = np.frombuffer(b"".join(hashlib.blake2b(s.encode("utf-8"), digest_size=8).digest() for s in shingles),
+                           dtype=np.uint8).reshape(len(shingles), 8)
+    bits = np.unpackbits(hashes, axis=1)  # one row of 64 bits per shingle
+    votes = bits.sum(axis=0, dtype=np.int64) * 2 - len(shingles)
+    return int.from_bytes(np.packbits(votes > 0).tobytes(), "big")
+
+
+def hamming(a, b):
+    return bin(a ^ b).count("1")
+
+
+def _signed(value):
+    # sqlite integers are signed 64 bit
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+
+def _bands(fingerprint):
+    return [(fingerprint >> (16 * band)) & 0xFFFF for band in range(BANDS)]
+
+
+class NearDuplicateIndex:
+    """sqlite backed SimHash index that can be shared by threads and processes"""
+
+    def __init__(self, path=NEAR_DUPLICATES_FILE, max_entries=DEFAULT_MAX_ENTRIES, max_distance=DEFAULT_MAX_DISTANCE):
+        self.path = os.path.abspath(path)
+        self.max_entries = max_entries
+        self.max_distance = max_distance
+        self._local = threading.local()
+        self._adds = 0
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=60)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS fingerprints (
+                    url TEXT PRIMARY KEY,
+                    simhash INTEGER NOT NULL,
+                    band0 INTEGER NOT NULL,
+                    band1 INTEGER NOT NULL,
+                    band2 INTEGER NOT NULL,
+                    band3 INTEGER NOT NULL,
+                    cluster TEXT NOT NULL,
+                    last_used REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS fingerprints_band0 ON fingerprints(band0);
+                CREATE INDEX IF NOT EXISTS fingerprints_band1 ON fingerprints(band1);
+                CREATE INDEX IF NOT EXISTS fingerprints_band2 ON fingerprints(band2);
+                CREATE INDEX IF NOT EXISTS fingerprints_band3 ON fingerprints(band3);
+                CREATE INDEX IF NOT EXISTS fingerprints_cluster ON fingerprints(cluster);
+                CREATE INDEX IF NOT EXISTS fingerprints_last_used ON fingerprints(last_used);
+            """)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def nearest(self, fingerprint):
+        """(url, cluster, distance) of the closest indexed article within max_distance, or None"""
+        bands = _bands(fingerprint)
+        rows = self._connection().execute(
+            "SELECT url, simhash, cluster FROM fingerprints WHERE band0 = ? OR band1 = ? OR band2 = ? OR band3 = ?",
+            bands).fetchall()
+        best = None
+        for url, other, cluster in rows:
+            distance = hamming(fingerprint, other & ((1 << 64) - 1))
+            if distance <= self.max_distance and (best is None or distance < best[2]):
+                best = (url, cluster, distance)
+        return best
+
+    def add(self, url, text):
+        """Index the article at url and return the representative url of its cluster (url itself if it is new)"""
+        conn = self._connection()
+        now = time.time()
+        row = conn.execute("SELECT cluster FROM fingerprints WHERE url = ?", (url,)).fetchone()
+        if row is not None:
+            with conn:
+                conn.execute("UPDATE fingerprints SET last_used = ? WHERE url = ?", (now, url))
+            return row[0]
+
+        fingerprint = simhash(text)
+        nearest = self.nearest(fingerprint)
+        cluster = nearest[1] if nearest is not None else url
+        with conn:
+            conn.execute("INSERT OR IGNORE INTO fingerprints (url, simhash, band0, band1, band2, band3, cluster, last_used) "
+                         "VALUES (?, ?, ?, ?, ?, ?, ?, ?)", [url, _signed(fingerprint)] + _bands(fingerprint) + [cluster, now])
+            conn.execute("UPDATE fingerprints SET last_used = ? WHERE cluster = ? AND url = ?", (now, cluster, cluster))
+        self._adds += 1
+        if self._adds % EVICTION_CHECK_EVERY == 0:
+            self.evict()
+        return cluster
+
+    def members(self, cluster):
+        """Every indexed url of a cluster, the representative first"""
+        rows = self._connection().execute("SELECT url FROM fingerprints WHERE cluster = ? ORDER BY url = ? DESC, url",
+                                          (cluster, cluster)).fetchall()
+        return [url for (url,) in rows]
+
+    def evict(self, max_entries=None):
+        """Drop the least recently used fingerprints beyond max_entries"""
+        max_entries = self.max_entries if max_entries is None else max_entries
+        conn = self._connection()
+        count = conn.execute("SELECT COUNT(*) FROM fingerprints").fetchone()[0]
+        if count <= max_entries:
+            return 0
+        with conn:
+            conn.execute("DELETE FROM fingerprints WHERE url IN "
+                         "(SELECT url FROM fingerprints ORDER BY last_used LIMIT ?)", (count - max_entries,))
+        return count - max_entries
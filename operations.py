@@ -0,0 +1,261 @@
+"""
+Linking of abnormal arrest days across neighbouring counties and days into
+candidate multi-county operations, before anything is searched.
+
+Large operations show up as abnormal days in several neighbouring counties
+over several days, and each of those county-days used to be searched and
+validated on its own, finding the same articles again and again. Here the
+abnormal days are linked into operations first:
+
+- two counties are neighbours when they share a border (Census county
+  adjacency file) or their centroids (Census Gazetteer counties file) are at
+  most radius_km apart. The neighbour lists are computed once, with the
+  haversine distances of all centroids in blocks;
+- sweeping the days in date order, a day joins the operation of the latest
+  abnormal day of its own county or any neighbour at most max_gap_days
+  earlier (single linkage, through a union-find), as long as the operation
+  then spans at most max_span_days, so a busy region does not chain into one
+  endless operation.
+
+The plan holds one row per operation: the day of its lead county (the most
+arrests) with the first and last day of the whole operation as
+operation_start / operation_end, so the scrapers search the whole span once
+(see row_source.add_search_window), and the names of all its counties as
+county_names, so the query names every county of the operation and not only
+the lead one (see row_source.search_counties). After validation, merge_operations folds
+the valid results of every county-day of an operation into one record.
+
+    python operations.py link abnormal_days.csv --gazetteer 2023_Gaz_counties_national.txt \\
+        --adjacency county_adjacency2023.txt --plan operation_plan.csv
+    python main.py  # with operation_plan.csv as its input
+    python operations.py merge ~/Desktop/valid_results.csv linked_days.csv operations.csv
+"""
+import argparse
+import math
+
+import numpy as np
+import pandas as pd
+
+import raid_groups
+import row_source
+
+RADIUS_KM = 60  # centroids at most this far apart are neighbours, about one county over in the east
+MAX_GAP_DAYS = 3  # days between two linked abnormal days
+MAX_SPAN_DAYS = 14  # longest operation, first to last abnormal day
+EARTH_RADIUS_KM = 6371.0
+DISTANCE_BLOCK = 512  # centroids per block of the distance matrix
+
+PLAN_COLUMNS = (row_source.INPUT_COLUMNS + ["operation_id"] + row_source.SPAN_COLUMNS
+                + [row_source.COUNTY_NAMES_COLUMN, "counties", "days", "arrests"])
+
+
+def load_centroids(path):
+    """County centroids of a Census Gazetteer counties file, a frame of fips, lat, lon"""
+    gazetteer = pd.read_csv(path, sep="\t", dtype="string", encoding="latin-1")
+    gazetteer.columns = gazetteer.columns.str.strip()
+    return pd.DataFrame({
+        "fips": pd.to_numeric(gazetteer["GEOID"], errors="coerce").astype("Int64"),
+        "lat": pd.to_numeric(gazetteer["INTPTLAT"].str.strip(), errors="coerce"),
+        "lon": pd.to_numeric(gazetteer["INTPTLONG"].str.strip(), errors="coerce"),
+    }).dropna()
+
+
+def load_adjacency(path):
+    """Border sharing county pairs of a Census county adjacency file (the pipe separated 2023 one or the older tab one)"""
+    with open(path, encoding="latin-1") as f:
+        first_line = f.readline()
+    if "|" in first_line:
+        pairs = pd.read_csv(path, sep="|", dtype="string", encoding="latin-1")
+        pairs = pairs[["County GEOID", "Neighbor GEOID"]]
+    else:
+        # the county is only written on the first line of its block of neighbours
+        pairs = pd.read_csv(path, sep="\t", header=None, dtype="string", encoding="latin-1",
+                            names=["county", "County GEOID", "neighbor", "Neighbor GEOID"])
+        pairs = pairs[["County GEOID", "Neighbor GEOID"]].ffill()
+    pairs = pairs.apply(lambda col: pd.to_numeric(col, errors="coerce")).dropna().astype("int64")
+    return pairs.to_numpy()
+
+
+def centroid_pairs(centroids, radius_km=RADIUS_KM):
+    """County pairs whose centroids are at most radius_km apart, as an array of (fips, fips)"""
+    fips = centroids["fips"].to_numpy(dtype=np.int64)
+    lat = np.radians(centroids["lat"].to_numpy(dtype=np.float64))
+    lon = np.radians(centroids["lon"].to_numpy(dtype=np.float64))
+    # haversine, compared as the squared half chord so there is no arcsin per pair
+    limit = math.sin(radius_km / EARTH_RADIUS_KM / 2) ** 2
+    pairs = []
+    for block in range(0, len(fips), DISTANCE_BLOCK):
+        rows = slice(block, block + DISTANCE_BLOCK)
+        half_chord = (np.sin((lat[rows, None] - lat[None, :]) / 2) ** 2
+                      + np.cos(lat[rows, None]) * np.cos(lat[None, :]) * np.sin((lon[rows, None] - lon[None, :]) / 2) ** 2)
+        i, j = np.nonzero(half_chord <= limit)
+        pairs.append(np.column_stack([fips[rows][i], fips[j]]))
+    return np.concatenate(pairs) if pairs else np.zeros((0, 2), dtype=np.int64)
+
+
+def neighbours(centroids=None, adjacency=None, radius_km=RADIUS_KM):
+    """fips -> array of the neighbouring fips (itself excluded), from centroid distances and / or shared borders"""
+    pairs = [np.zeros((0, 2), dtype=np.int64)]
+    if centroids is not None:
+        pairs.append(centroid_pairs(centroids, radius_km))
+    if adjacency is not None:
+        pairs.append(adjacency)
+    pairs = np.concatenate(pairs)
+    pairs = np.concatenate([pairs, pairs[:, ::-1]])  # both directions, the adjacency file is not always symmetric
+    pairs = np.unique(pairs[pairs[:, 0] != pairs[:, 1]], axis=0)
+    starts = np.flatnonzero(np.r_[True, pairs[1:, 0] != pairs[:-1, 0]]) if len(pairs) else []
+    return {int(pairs[start, 0]): group[:, 1] for start, group in zip(starts, np.split(pairs, starts[1:]))}
+
+
+def load_days(path):
+    """Abnormal days written by anomaly_days.py (or the original abnormal_arrest_dates.csv), typed"""
+    days = pd.read_csv(path, dtype="string", keep_default_na=False, na_values=[""])
+    days = row_source.typed_columns(days)
+    if "arrests" in days:
+        days["arrests"] = pd.to_numeric(days["arrests"], errors="coerce").astype("Int64")
+    return days
+
+
+def _find(parent, i):
+    while parent[i] != i:
+        parent[i] = parent[parent[i]]
+        i = parent[i]
+    return i
+
+
+def link_days(days, neighbour_lists, max_gap_days=MAX_GAP_DAYS, max_span_days=MAX_SPAN_DAYS):
+    """
+    Operation id of every abnormal day (typed frame with arrestdate and StateCountyFIPS), numbered in date order.
+    Days without a date are left out (-1), days without a FIPS code are operations of their own.
+    """
+    day_numbers = days["arrestdate"].to_numpy(dtype="datetime64[D]")
+    usable = np.flatnonzero(~np.isnat(day_numbers))
+    day_numbers = day_numbers.astype(np.int64)
+    fips = days["StateCountyFIPS"].to_numpy(dtype="float64", na_value=np.nan)
+    order = usable[np.argsort(day_numbers[usable], kind="stable")]
+
+    parent = np.arange(len(days))
+    first_day = day_numbers.copy()  # first day of the operation, kept at its root
+    latest = {}  # fips -> latest day (row) seen of that county
+    no_neighbours = np.zeros(0, dtype=np.int64)
+    for row in order:
+        if np.isnan(fips[row]):
+            continue
+        county, day = int(fips[row]), day_numbers[row]
+        for other in (county, *neighbour_lists.get(county, no_neighbours)):
+            earlier = latest.get(int(other))
+            if earlier is None or day - day_numbers[earlier] > max_gap_days:
+                continue
+            root, other_root = _find(parent, row), _find(parent, earlier)
+            start = min(first_day[root], first_day[other_root])
+            if root != other_root and day - start <= max_span_days:
+                parent[other_root] = root
+                first_day[root] = start
+        latest[county] = row
+
+    operation_ids = np.full(len(days), -1, dtype=np.int64)
+    roots = np.array([_find(parent, row) for row in order], dtype=np.int64)
+    operation_ids[order] = pd.factorize(roots)[0]
+    return pd.Series(operation_ids, index=days.index, name="operation_id")
+
+
+def operation_plan(days, operation_ids):
+    """
+    One search row per operation: its lead county's day (most arrests, else the first), the operation
+    span and the names of its counties, in order of their arrests (the lead county first)
+    """
+    linked = days.assign(operation_id=operation_ids.to_numpy())
+    linked = linked[linked["operation_id"] >= 0]
+    arrests = linked["arrests"].fillna(0) if "arrests" in linked else pd.Series(0, index=linked.index)
+    spans = linked.groupby("operation_id").agg(
+        operation_start=("arrestdate", "min"), operation_end=("arrestdate", "max"),
+        counties=("StateCountyFIPS", "nunique"), days=("arrestdate", "size"))
+    spans["arrests"] = arrests.groupby(linked["operation_id"]).sum()
+    lead = linked.assign(_arrests=arrests).sort_values(["operation_id", "_arrests", "arrestdate"],
+                                                        ascending=[True, False, True], kind="stable")
+    county_arrests = lead.groupby(["operation_id", "CountyName"], sort=False)["_arrests"].sum().reset_index()
+    lead_names = lead.groupby("operation_id")["CountyName"].first()
+    county_arrests["_lead"] = county_arrests["CountyName"] == county_arrests["operation_id"].map(lead_names)
+    county_arrests = county_arrests.sort_values(["operation_id", "_lead", "_arrests"], ascending=[True, False, False],
+                                                kind="stable")
+    spans[row_source.COUNTY_NAMES_COLUMN] = county_arrests.groupby("operation_id")["CountyName"].agg(
+        row_source.COUNTY_NAMES_SEP.join)
+    plan = lead.drop_duplicates("operation_id")[row_source.INPUT_COLUMNS + ["operation_id"]]
+    plan = plan.join(spans, on="operation_id").sort_values(["operation_start", "operation_id"])
+    for col in ["arrestdate"] + row_source.SPAN_COLUMNS:
+        plan[col] = plan[col].dt.strftime("%m/%d/%Y")
+    return plan[PLAN_COLUMNS].reset_index(drop=True)
+
+
+def merge_operations(valid_results, linked_days, max_sources=raid_groups.MAX_SOURCES):
+    """
+    One record per operation out of the valid results of its county-days: counties, span and the
+    distinct articles. Results are matched to their operation on county and arrest date, so both a
+    run over the plan and one over every abnormal day can be merged.
+    """
+    columns = raid_groups.columns_of(valid_results)
+    result_keys = pd.DataFrame({
+        "fips": pd.to_numeric(valid_results[columns["fips"]], errors="coerce").astype("Int64"),
+        "date": row_source.parse_dates(valid_results[columns["date"]]),
+    })
+    day_keys = pd.DataFrame({"fips": linked_days["StateCountyFIPS"], "date": linked_days["arrestdate"],
+                             "operation_id": linked_days["operation_id"]}).drop_duplicates(["fips", "date"])
+    groups = result_keys.merge(day_keys, on=["fips", "date"], how="left")["operation_id"].fillna(-1)
+
+    linked = linked_days[linked_days["operation_id"] >= 0]
+    operations = linked.groupby("operation_id").agg(
+        start_date=("arrestdate", "min"), end_date=("arrestdate", "max"), days=("arrestdate", "size"),
+        counties=("StateCountyFIPS", "nunique"),
+        fips=("StateCountyFIPS", lambda col: ";".join(str(fips) for fips in sorted(col.dropna().unique()))),
+        states=("ST", lambda col: ";".join(sorted(col.dropna().unique()))))
+    if "arrests" in linked:
+        operations["arrests"] = linked.groupby("operation_id")["arrests"].sum()
+    n_operations = int(linked["operation_id"].max()) + 1 if len(linked) else 0
+    operations = operations.reindex(range(n_operations))
+    operations["results"] = np.bincount(groups[groups >= 0].astype(np.int64), minlength=n_operations)
+    sources = raid_groups.source_columns(valid_results, groups.to_numpy(dtype=np.int64), n_operations, columns,
+                                         max_sources)
+    operations = pd.concat([operations.reset_index(drop=True), sources], axis=1)
+    operations.insert(0, "operation_id", range(n_operations))
+    return operations[operations["results"] > 0].reset_index(drop=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Link abnormal days into multi-county operations")
+    commands = parser.add_subparsers(dest="command", required=True)
+    link = commands.add_parser("link", help="link abnormal days and write the search plan")
+    link.add_argument("days_csv", help="abnormal days, as written by anomaly_days.py")
+    link.add_argument("--gazetteer", help="Census Gazetteer counties file, for the centroids")
+    link.add_argument("--adjacency", help="Census county adjacency file")
+    link.add_argument("--radius-km", type=float, default=RADIUS_KM)
+    link.add_argument("--max-gap", type=int, default=MAX_GAP_DAYS)
+    link.add_argument("--max-span", type=int, default=MAX_SPAN_DAYS)
+    link.add_argument("--plan", default="operation_plan.csv", help="one search row per operation")
+    link.add_argument("--linked", default="linked_days.csv", help="the abnormal days with their operation_id")
+    merge = commands.add_parser("merge", help="merge the valid results of every operation")
+    merge.add_argument("valid_results", help="valid_results.csv of main.py or search results of the Bing scraper")
+    merge.add_argument("linked_csv", help="linked days written by link")
+    merge.add_argument("output_csv", nargs="?", default="operations.csv")
+    merge.add_argument("--max-sources", type=int, default=raid_groups.MAX_SOURCES)
+    args = parser.parse_args()
+
+    if args.command == "link":
+        if args.gazetteer is None and args.adjacency is None:
+            print("No --gazetteer or --adjacency given, only days of the same county are linked")
+        centroids = load_centroids(args.gazetteer) if args.gazetteer else None
+        adjacency = load_adjacency(args.adjacency) if args.adjacency else None
+        days = load_days(args.days_csv)
+        operation_ids = link_days(days, neighbours(centroids, adjacency, args.radius_km), args.max_gap, args.max_span)
+        plan = operation_plan(days, operation_ids)
+        linked = days.assign(operation_id=operation_ids)
+        linked["arrestdate"] = linked["arrestdate"].dt.strftime("%m/%d/%Y")
+        linked.to_csv(args.linked, index=False)
+        plan.to_csv(args.plan, index=False)
+        print(f"{len(days)} abnormal days linked into {len(plan)} operations "
+              f"({int((plan['counties'] > 1).sum())} across counties), plan written to {args.plan}")
+    else:
+        linked = load_days(args.linked_csv)
+        linked["operation_id"] = pd.to_numeric(linked["operation_id"]).astype("int64")
+        operations = merge_operations(raid_groups.load_results(args.valid_results), linked, args.max_sources)
+        operations.to_csv(args.output_csv, index=False)
+        print(f"{len(operations)} operations with valid results written to {args.output_csv}")
@@ -0,0 +1,198 @@
+"""
+Parquet output backend for the search and validation results.
+
+Rows are written to a hive-partitioned dataset (e.g. State=TX/year=2018/part-...parquet)
+with real types: dates are stored as timestamps and FIPS codes / state
+abbreviations are dictionary encoded, so pandas reads them back as datetime64
+and category columns without any parsing. Every flush appends a new file (one row group) per
+partition, so a dataset can keep growing across runs. checkpoint() flushes and
+fsyncs the new files and their directories, like the csv sink.
+
+ParquetSink has the same interface as result_sink.CsvSink and can be dropped
+into result_sink.ResultSinks. pyarrow is only needed when this backend is used.
+
+Reading only the needed columns back:
+    pd.read_parquet("valid_results", columns=["StateCountyFIPS", "Arrest_Date"])
+"""
+import os
+import threading
+import time
+import uuid
+from datetime import date, datetime
+
+DEFAULT_FLUSH_ROWS = 5000
+DEFAULT_FLUSH_SECONDS = 60.0
+DATE_FORMATS = ("%m/%d/%Y", "%Y-%m-%d", "%m/%d/%y", "%Y-%m-%dT%H:%M:%S")
+
+# column types of the three files written by main.py, anything not listed is a plain string
+MAIN_COLUMN_TYPES = {
+    "State": "category",
+    "Arrest_Date": "date",
+    "Start_Date_Param": "date",
+    "End_Date_Param": "date",
+    "StateCountyFIPS": "category",
+    "FIPSState": "category",
+    "FIPSCounty": "category",
+}
+# column types of the bing scraper results
+BING_COLUMN_TYPES = {
+    "search_pattern": "category",
+    "StateCountyFIPS": "category",
+    "ST": "category",
+    "FIPSState": "category",
+    "FIPSCounty": "category",
+    "arrest_date": "date",
+}
+
+
+def _require_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError as e:
+        raise ImportError("the parquet output backend needs pyarrow: pip install pyarrow") from e
+    return pyarrow, pyarrow.parquet
+
+
+# helper function to turn the date strings used across the scrapers into datetimes at midnight
+def parse_date(value):
+    if value is None or isinstance(value, datetime):
+        return value
+    if isinstance(value, date):
+        return datetime(value.year, value.month, value.day)
+    value = str(value).strip()
+    for fmt in DATE_FORMATS:
+        try:
+            return datetime.strptime(value, fmt)
+        except ValueError:
+            pass
+    return None
+
+
+def _arrow_type(pa, kind):
+    if kind == "date":
+        return pa.timestamp("s")
+    if kind == "category":
+        return pa.dictionary(pa.int32(), pa.string())
+    return pa.string()
+
+
+def _fsync_path(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _partition_value(value):
+    return "__HIVE_DEFAULT_PARTITION__" if value in (None, "") else str(value).replace("/", "_")
+
+
+class ParquetSink:
+    """
+    Buffered writer for a partitioned parquet dataset.
+
+    partition_by lists the columns used as directories, the special name "year"
+    is taken from the year of year_from (a date column).
+    """
+
+    def __init__(self, root_dir, fieldnames, column_types=None, partition_by=("State", "year"),
+                 year_from=None, flush_rows=DEFAULT_FLUSH_ROWS, flush_seconds=DEFAULT_FLUSH_SECONDS):
+        self.pa, self.pq = _require_pyarrow()
+        self.path = root_dir
+        self.fieldnames = list(fieldnames)
+        self.column_types = {name: (column_types or {}).get(name, "string") for name in self.fieldnames}
+        self.partition_by = [col for col in partition_by if col in self.fieldnames or (col == "year" and year_from)]
+        self.year_from = year_from
+        self.flush_rows = flush_rows
+        self.flush_seconds = flush_seconds
+        self.schema = self.pa.schema([(name, _arrow_type(self.pa, self.column_types[name]))
+                                      for name in self.fieldnames if name not in self.partition_by])
+        self._lock = threading.Lock()
+        self._buffer = []
+        self._unsynced = []  # files written since the last checkpoint
+        self._last_flush = time.monotonic()
+        os.makedirs(root_dir, exist_ok=True)
+
+    def write(self, row):
+        self.write_rows([row])
+
+    def write_rows(self, rows):
+        with self._lock:
+            self._buffer.extend(rows)
+            if len(self._buffer) >= self.flush_rows or time.monotonic() - self._last_flush >= self.flush_seconds:
+                self._flush()
+
+    def _typed(self, row):
+        typed = {}
+        for name in self.fieldnames:
+            value = row.get(name)
+            if isinstance(value, float) and value != value:  # pandas NaN
+                value = None
+            if self.column_types[name] == "date":
+                value = parse_date(value)
+            elif value is not None:
+                value = str(value)
+            typed[name] = value
+        return typed
+
+    def _partition_key(self, row):
+        key = []
+        for col in self.partition_by:
+            if col == "year":
+                day = row.get(self.year_from)
+                key.append(day.year if day else None)
+            else:
+                key.append(row.get(col))
+        return tuple(key)
+
+    def _flush(self):
+        # caller holds the lock
+        if self._buffer:
+            partitions = {}
+            for row in self._buffer:
+                row = self._typed(row)
+                partitions.setdefault(self._partition_key(row), []).append(row)
+            for key, rows in partitions.items():
+                self._write_partition(key, rows)
+            self._buffer = []
+        self._last_flush = time.monotonic()
+
+    def _write_partition(self, key, rows):
+        directory = os.path.join(self.path, *(f"{col}={_partition_value(value)}"
+                                              for col, value in zip(self.partition_by, key)))
+        os.makedirs(directory, exist_ok=True)
+        columns = {field.name: [row[field.name] for row in rows] for field in self.schema}
+        table = self.pa.Table.from_pydict(columns, schema=self.schema)
+        # write under a temporary name first so readers never see a half written file
+        name = f"part-{int(time.time() * 1000)}-{uuid.uuid4().hex[:8]}.parquet"
+        tmp_path = os.path.join(directory, "." + name)
+        self.pq.write_table(table, tmp_path, compression="zstd")
+        os.replace(tmp_path, os.path.join(directory, name))
+        self._unsynced.append(os.path.join(directory, name))
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def checkpoint(self):
+        """Flush the buffer and force the new files, and their directory entries, to disk"""
+        with self._lock:
+            self._flush()
+            for path in self._unsynced:
+                _fsync_path(path)
+            for directory in {os.path.dirname(path) for path in self._unsynced}:
+                _fsync_path(directory)
+            self._unsynced = []
+
+    def close(self):
+        self.checkpoint()
+
+
+def write_dataframe(df, root_dir, column_types=None, partition_by=("ST", "year"), year_from="arrest_date"):
+    """Append a whole pandas DataFrame (e.g. the bing scraper results) to a partitioned parquet dataset"""
+    sink = ParquetSink(root_dir, list(df.columns), column_types, partition_by, year_from, flush_rows=len(df) + 1)
+    sink.write_rows(df.to_dict("records"))
+    sink.close()
+    return root_dir
@@ -0,0 +1,207 @@
+"""
+Pipelined version of main.search_and_export.
+
+Each input row flows through four stages (search -> fetch -> validate -> write).
+Every stage has its own pool of worker threads and is connected to the next
+one by a bounded queue, so a slow stage makes the earlier ones wait instead of
+piling up work in memory. The writer re-orders finished rows by their input
+position, so the output files come out in the same order as a serial run.
+
+Usage:
+    python pipeline.py
+"""
+import heapq
+import os
+import queue
+import threading
+
+import main
+
+_DONE = object()  # sentinel passed down the queues once a stage has finished
+
+
+class PipelineItem:
+    """One input row and everything the stages have produced for it so far"""
+    __slots__ = ("seq", "row_id", "county", "state", "query", "start", "end", "date",
+                 "scFIPs", "fipsS", "fipsC", "organic_results", "texts", "rows")
+
+    def __init__(self, seq, row_id, county, state, query, start, end, date, scFIPs, fipsS, fipsC):
+        self.seq = seq
+        self.row_id = row_id
+        self.county = county
+        self.state = state
+        self.query = query
+        self.start = start
+        self.end = end
+        self.date = date
+        self.scFIPs = scFIPs
+        self.fipsS = fipsS
+        self.fipsC = fipsC
+        self.organic_results = []
+        self.texts = []
+        self.rows = []  # list of (bucket, row dict) ready to be written
+
+
+class _FanOut:
+    """Queue wrapper that turns one _DONE sentinel into one per downstream worker"""
+
+    def __init__(self, q, copies):
+        self.q = q
+        self.copies = copies
+
+    def put(self, item):
+        if item is _DONE:
+            for _ in range(self.copies):
+                self.q.put(_DONE)
+        else:
+            self.q.put(item)
+
+
+class _Stage:
+    """A pool of worker threads that reads from in_q, applies func and writes to out_q"""
+
+    def __init__(self, name, func, workers, in_q, out_q):
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.in_q = in_q
+        self.out_q = out_q
+        self._remaining = workers
+        self._lock = threading.Lock()
+        self.threads = [threading.Thread(target=self._run, name=f"{name}-{i}", daemon=True)
+                        for i in range(workers)]
+
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+
+    def _run(self):
+        while True:
+            item = self.in_q.get()
+            if item is _DONE:
+                break
+            try:
+                self.func(item)
+            except Exception as e:
+                # an item must never be dropped, otherwise the writer waits for it forever
+                print(f"Error in {self.name} stage for row {item.seq}: {e}")
+            self.out_q.put(item)
+
+        with self._lock:
+            self._remaining -= 1
+            last = self._remaining == 0
+        if last:
+            self.out_q.put(_DONE)
+
+
+class SearchPipeline:
+    """
+    Runs search_and_export with bounded, concurrent stages.
+
+    search_workers, fetch_workers and validate_workers set the concurrency of each
+    stage, queue_size bounds every inter-stage queue and max_in_flight bounds the
+    number of rows that have been read but not yet written. offline_batch
+    queues the gpt checks for the batch api, see main.submit_offline_batch.
+    """
+
+    def __init__(self, search_workers=4, fetch_workers=8, validate_workers=4,
+                 queue_size=32, max_in_flight=64, offline_batch=None):
+        self.search_workers = search_workers
+        self.fetch_workers = fetch_workers
+        self.validate_workers = validate_workers
+        self.queue_size = queue_size
+        self.max_in_flight = max_in_flight
+        self.offline_batch = offline_batch
+
+    # --- stage functions -------------------------------------------------
+
+    def search(self, item):
+        item.organic_results = main.search_google(item.query, item.start, item.end)
+
+    def fetch(self, item):
+        item.texts = main.scrape_article_texts([result.get("link", "N/A") for result in item.organic_results])
+
+    def validate(self, item):
+        item.rows = main.validate_results(
+            item.organic_results, item.texts, item.county, item.state, item.start, item.end, item.date,
+            item.scFIPs, item.fipsS, item.fipsC, item.row_id, self.offline_batch)
+        item.texts = []  # the article text is no longer needed, free it before the write queue
+
+    # --- driver ----------------------------------------------------------
+
+    def _feed(self, data, out_q, in_flight):
+        seq = 0
+        try:
+            for row in data:
+                try:
+                    query, start, end, date = main.prepare_row(row)
+                except Exception as e:
+                    print(f"Skipping row: {e}")
+                    continue
+                in_flight.acquire()  # backpressure: wait until the writer has caught up
+                out_q.put(PipelineItem(seq, row.row_id, row.county, row.st, query, start, end, date,
+                                       row.fips, row.fips_state, row.fips_county))
+                seq += 1
+        finally:
+            for _ in range(self.search_workers):
+                out_q.put(_DONE)
+
+    def _write(self, write_q, sinks, in_flight):
+        pending = []  # min-heap of finished rows keyed by their input position
+        next_seq = 0
+        written = 0
+        while True:
+            item = write_q.get()
+            if item is _DONE:
+                break
+            heapq.heappush(pending, (item.seq, item))
+            while pending and pending[0][0] == next_seq:
+                _, ready = heapq.heappop(pending)
+                for bucket, row in ready.rows:
+                    sinks.write(bucket, row, ready.row_id)
+                sinks.row_done(ready.row_id)
+                written += 1
+                next_seq += 1
+                in_flight.release()
+                if written % main.CHECKPOINT_EVERY == 0:
+                    sinks.checkpoint()
+        return written
+
+    def run(self, data, sinks):
+        """Process data (rows as returned by main.parse_csv) and write the results to sinks (a result_sink.ResultSinks)"""
+        search_q = queue.Queue(self.queue_size)
+        fetch_q = queue.Queue(self.queue_size)
+        validate_q = queue.Queue(self.queue_size)
+        write_q = queue.Queue(self.queue_size)
+        in_flight = threading.BoundedSemaphore(self.max_in_flight)
+
+        stages = [
+            _Stage("search", self.search, self.search_workers, search_q, _FanOut(fetch_q, self.fetch_workers)),
+            _Stage("fetch", self.fetch, self.fetch_workers, fetch_q, _FanOut(validate_q, self.validate_workers)),
+            _Stage("validate", self.validate, self.validate_workers, validate_q, write_q),
+        ]
+        for stage in stages:
+            stage.start()
+
+        feeder = threading.Thread(target=self._feed, args=(data, search_q, in_flight), name="feeder", daemon=True)
+        feeder.start()
+        written = self._write(write_q, sinks, in_flight)
+        feeder.join()
+        return written
+
+
+def search_and_export_pipelined(data, output_dir=None, backend="csv", sinks=None, **pipeline_options):
+    """Drop-in replacement for main.search_and_export that runs the stages concurrently"""
+    with (sinks or main.open_output_sinks(output_dir, backend)) as sinks:
+        return SearchPipeline(**pipeline_options).run(data, sinks)
+
+
+if __name__ == "__main__":
+    desktop_path = os.path.join(os.path.expanduser("~"), "Desktop")
+    input_csv = os.path.join(desktop_path, "abnormal_arrest_dates.csv")
+    rows = search_and_export_pipelined(main.parse_csv(input_csv))
+    print(f"{rows} rows processed, results have been exported to {desktop_path}")
+    print(f"Article text sent to gpt: {main.token_meter.summary()}")
+    print(f"Links swapped for an earlier variant of the same article: {main.urls.variants_merged}")
+    print(f"Searches: {main.search_providers.costs.summary()}")
+    main.urls.save()
@@ -0,0 +1,230 @@
+"""
+Cheap local relevance check that runs on the scraped text before any gpt call.
+
+Most links a search returns have nothing to do with an immigration raid. The
+check looks for immigration enforcement terms (English and Spanish), whether
+the county is named and whether the text mentions a date inside the search
+window, and adds them up into a score. An article without a single immigration
+term, or scoring below MIN_SCORE (an immigration story that names neither the
+county nor a date of the window and hardly mentions any enforcement), is
+rejected on the spot. Everything else goes on to gpt, which still makes the
+final call.
+
+A small naive Bayes classifier can be trained on the links we already
+validated (valid_results.csv / invalid_results.csv, with the article text
+taken from the article store, results rejected without gpt are left out so the
+model never learns from the prefilter's own decisions):
+
+    python prefilter.py ~/Desktop/valid_results.csv ~/Desktop/invalid_results.csv
+
+When the trained model file exists it also rejects articles it is very sure
+about, unless they mention a date inside the search window.
+"""
+import csv
+import json
+import math
+import os
+import re
+from collections import Counter, namedtuple
+from datetime import date, datetime
+
+RELEVANCE_MODEL_FILE = "relevance_model.json"
+REJECT_BELOW = 0.02  # classifier probability under which an article is rejected without gpt
+MIN_SCORE = 3.0  # relevance score under which an article is rejected without gpt
+REASON_PREFIX = "prefilter:"  # start of the LLM_Analysis of every result rejected here
+MIN_TRAINING_ARTICLES = 50  # per class, below this the classifier is not trusted
+
+# immigration terms, any one of them is enough to send the article on to gpt
+IMMIGRATION_TERMS = [
+    r"\bimmigra", r"\binmigra", r"\bmigrant", r"\bdeport", r"\bundocumented", r"\bindocumentad",
+    r"\billegal alien", r"\billegal immigrant", r"\bice\b", r"\bero\b", r"\bcustoms enforcement",
+    r"\benforcement and removal", r"\bhomeland security", r"\bdhs\b", r"\bborder patrol",
+    r"\bla migra\b", r"\bredadas?\b", r"\bsanctuary", r"\basylum", r"\basilo\b", r"\bvisa\b",
+]
+# terms that point at an enforcement operation in particular, they raise the score
+ENFORCEMENT_TERMS = [
+    r"\bimmigration and customs enforcement", r"\bice agents?\b", r"\bice officers?\b", r"\bero\b",
+    r"\benforcement and removal operations", r"\bfugitive operations?\b", r"\bimmigration raids?\b",
+    r"\bimmigration arrests?\b", r"\bimmigration sweeps?\b", r"\bworksite enforcement", r"\bdetainers?\b",
+    r"\bdetained\b", r"\barrested\b", r"\bagentes de (?:ice|inmigraci[oó]n)", r"\bredadas?\b",
+    r"\bdetenid[oa]s\b", r"\barrestad[oa]s\b", r"\boperativos?\b",
+]
+IMMIGRATION_RE = re.compile("|".join(IMMIGRATION_TERMS))
+ENFORCEMENT_RE = re.compile("|".join(ENFORCEMENT_TERMS))
+
+MONTHS = {
+    "january": 1, "jan": 1, "february": 2, "feb": 2, "march": 3, "mar": 3, "april": 4, "apr": 4, "may": 5,
+    "june": 6, "jun": 6, "july": 7, "jul": 7, "august": 8, "aug": 8, "september": 9, "sept": 9, "sep": 9,
+    "october": 10, "oct": 10, "november": 11, "nov": 11, "december": 12, "dec": 12,
+    "enero": 1, "febrero": 2, "marzo": 3, "abril": 4, "mayo": 5, "junio": 6, "julio": 7, "agosto": 8,
+    "septiembre": 9, "setiembre": 9, "octubre": 10, "noviembre": 11, "diciembre": 12,
+}
+_MONTH = "|".join(sorted(MONTHS, key=len, reverse=True))
+_DATE_PATTERNS = [
+    # january 5, 2018 / jan. 5 / jan 5th 2018
+    (re.compile(rf"\b({_MONTH})\.?\s+(\d{{1,2}})(?:st|nd|rd|th)?(?:,?\s+(\d{{4}}))?\b"), ("month", "day", "year")),
+    # 5 de enero de 2018 / 5 january 2018
+    (re.compile(rf"\b(\d{{1,2}})\s+(?:de\s+)?({_MONTH})\.?(?:,?\s+(?:de(?:l)?\s+)?(\d{{4}}))?\b"), ("day", "month", "year")),
+    # 1/5/2018 / 1/5/18
+    (re.compile(r"\b(\d{1,2})/(\d{1,2})/(\d{4}|\d{2})\b"), ("month", "day", "year")),
+    # 2018-01-05
+    (re.compile(r"\b(\d{4})-(\d{2})-(\d{2})\b"), ("year", "month", "day")),
+]
+
+PrefilterResult = namedtuple("PrefilterResult", ["reject", "score", "reason"])
+
+
+# helper function to turn the matched pieces of a date into a date, None if they do not make one
+def _make_date(parts, window_years):
+    month = parts["month"]
+    month = MONTHS.get(month.rstrip(".")) if not month.isdigit() else int(month)
+    day = int(parts["day"])
+    years = window_years
+    if parts.get("year"):
+        year = int(parts["year"])
+        years = [year + 2000 if year < 100 else year]
+    dates = []
+    for year in years:
+        try:
+            dates.append(date(year, month, day))
+        except (TypeError, ValueError):
+            pass
+    return dates
+
+
+def mentioned_dates(text, start, end):
+    """Every date the (lowercased) text mentions, dates without a year are read in the years of start..end"""
+    window_years = sorted({start.year, end.year})
+    found = []
+    for pattern, names in _DATE_PATTERNS:
+        for match in pattern.finditer(text):
+            found.extend(_make_date(dict(zip(names, match.groups())), window_years))
+    return found
+
+
+# helper function to read a date param of the search ("%m/%d/%Y" like calc_date writes them)
+def window_date(value):
+    if isinstance(value, date):
+        return value
+    return datetime.strptime(value, "%m/%d/%Y").date()
+
+
+def check(text, county, state, start, end, classifier=None):
+    """
+    Score the lowercased article text for the search of county, state between start and end.
+    Returns a PrefilterResult, reject is True only for obvious negatives.
+    """
+    if not IMMIGRATION_RE.search(text):
+        return PrefilterResult(True, 0.0, f"{REASON_PREFIX} no immigration terms in the text")
+
+    start, end = window_date(start), window_date(end)
+    enforcement_hits = len(ENFORCEMENT_RE.findall(text))
+    county_hit = bool(county) and county.lower() in text
+    date_hit = any(start <= day <= end for day in mentioned_dates(text, start, end))
+    score = 1.0 + min(enforcement_hits, 5) + (2.0 if county_hit else 0.0) + (2.0 if date_hit else 0.0)
+    if score < MIN_SCORE:
+        return PrefilterResult(True, score, f"{REASON_PREFIX} relevance score {score:.0f} below {MIN_SCORE:.0f}")
+
+    if classifier is not None and not date_hit:
+        probability = classifier.probability(text)
+        if probability < REJECT_BELOW:
+            return PrefilterResult(True, score, f"{REASON_PREFIX} classifier probability {probability:.3f}")
+    return PrefilterResult(False, score, "")
+
+
+# --- optional classifier -------------------------------------------------------
+
+_TOKEN_RE = re.compile(r"[a-záéíóúñü]{3,}")
+
+
+def tokens(text):
+    return _TOKEN_RE.findall(text.lower())
+
+
+class NaiveBayes:
+    """Multinomial naive Bayes over word counts, relevant (1) vs irrelevant (0)"""
+
+    def __init__(self, word_counts=None, doc_counts=None, vocabulary_size=0):
+        self.word_counts = word_counts or {"0": {}, "1": {}}
+        self.doc_counts = doc_counts or {"0": 0, "1": 0}
+        self.vocabulary_size = vocabulary_size
+        self._totals = {label: sum(counts.values()) for label, counts in self.word_counts.items()}
+
+    @classmethod
+    def train(cls, documents):
+        """documents is an iterable of (text, label) with label 1 for relevant articles"""
+        word_counts = {"0": Counter(), "1": Counter()}
+        doc_counts = {"0": 0, "1": 0}
+        for text, label in documents:
+            label = "1" if label else "0"
+            doc_counts[label] += 1
+            word_counts[label].update(set(tokens(text)))  # count each word once per article
+        vocabulary = set(word_counts["0"]) | set(word_counts["1"])
+        return cls({label: dict(counts) for label, counts in word_counts.items()}, doc_counts, len(vocabulary))
+
+    def trusted(self):
+        return min(self.doc_counts.values()) >= MIN_TRAINING_ARTICLES
+
+    def probability(self, text):
+        """Probability that text is a relevant article"""
+        total_docs = sum(self.doc_counts.values())
+        log_odds = math.log((self.doc_counts["1"] + 1) / (total_docs + 2)) - \
+            math.log((self.doc_counts["0"] + 1) / (total_docs + 2))
+        for word in set(tokens(text)):
+            for label, sign in (("1", 1), ("0", -1)):
+                count = self.word_counts[label].get(word, 0)
+                log_odds += sign * math.log((count + 1) / (self._totals[label] + self.vocabulary_size))
+        log_odds = max(-50.0, min(50.0, log_odds))
+        return 1 / (1 + math.exp(-log_odds))
+
+    def save(self, path=RELEVANCE_MODEL_FILE):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"word_counts": self.word_counts, "doc_counts": self.doc_counts,
+                       "vocabulary_size": self.vocabulary_size}, f)
+
+    @classmethod
+    def load(cls, path=RELEVANCE_MODEL_FILE):
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+        return cls(data["word_counts"], data["doc_counts"], data["vocabulary_size"])
+
+
+def load_classifier(path=RELEVANCE_MODEL_FILE):
+    """The trained classifier, or None if there is none or it saw too few articles to be trusted"""
+    if not os.path.exists(path):
+        return None
+    classifier = NaiveBayes.load(path)
+    return classifier if classifier.trusted() else None
+
+
+# helper function that reads the links of one result file with the text we stored for them
+# only results gpt decided are used, the ones rejected by the prefilter or the date / state checks
+# (no LLM_Analysis) would teach the model its own rules
+def _labelled_texts(path, link_field, title_field, label, store):
+    with open(path, newline="", encoding="utf-8") as f:
+        for row in csv.DictReader(f):
+            analysis = row.get("LLM_Analysis", "")
+            if not analysis or analysis.startswith(REASON_PREFIX):
+                continue
+            cached = store.get(row.get(link_field, "")) if store is not None else None
+            text = cached.text if cached is not None and cached.text else row.get(title_field, "")
+            if text:
+                yield text.lower(), label
+
+
+def train_classifier(valid_csv, invalid_csv, store=None, path=RELEVANCE_MODEL_FILE):
+    """Train on the valid and invalid result files, article texts come from store (an article_store.ArticleStore)"""
+    documents = list(_labelled_texts(valid_csv, "Article_Link", "Article_Title", 1, store))
+    documents += list(_labelled_texts(invalid_csv, "Link", "Title", 0, store))
+    classifier = NaiveBayes.train(documents)
+    classifier.save(path)
+    return classifier
+
+
+if __name__ == "__main__":
+    import sys
+    from article_store import ArticleStore
+
+    classifier = train_classifier(sys.argv[1], sys.argv[2], ArticleStore())
+    print(f"Trained on {classifier.doc_counts['1']} valid and {classifier.doc_counts['0']} invalid articles, "
+          f"saved to {RELEVANCE_MODEL_FILE}" + ("" if classifier.trusted() else " (too few to be used yet)"))
@@ -0,0 +1,81 @@
+"""
+Query planner for the Bing scraper.
+
+Without planning every input row issues all four search patterns for its own
+date window, so the state-level patterns ("Immigration arrest {state}",
+"Immigration raid {state}") are sent again for every county of that state whose
+window overlaps. The planner:
+
+  * collapses identical (query, freshness window) pairs across all rows and patterns,
+  * merges overlapping windows of the same state-level query into one wider
+    request (capped at max_window_days so Bing's 20 results are not spread too thin),
+
+and remembers for every planned request which (row, pattern) pairs it serves, so
+the results can be fanned back out to each of them. A merged window is wider
+than the windows of the rows it serves, so each row only gets the results dated
+inside its own window (bing_search_arrest_dataset.results_in_window).
+"""
+from collections import defaultdict
+from datetime import timedelta
+
+STATE_LEVEL_PATTERNS = ('pattern3', 'pattern4')
+MAX_WINDOW_DAYS = 45
+
+
+class PlannedQuery:
+    """One request to send: the query, its freshness window and the (row_id, pattern) pairs it serves"""
+    __slots__ = ("query", "start", "end", "targets", "order")
+
+    def __init__(self, query, start, end, order):
+        self.query = query
+        self.start = start
+        self.end = end
+        self.targets = []
+        self.order = order  # position of the first row served, used to run the plan in input order
+
+    def __repr__(self):
+        return f"PlannedQuery({self.query!r}, {self.start}..{self.end}, {len(self.targets)} targets)"
+
+
+def _merge_windows(windows, max_window_days, merge_gap_days):
+    """Greedy merge of (start, end, order, row_id, pattern) windows sorted by start"""
+    merged = []
+    for start, end, order, row_id, pattern in sorted(windows, key=lambda w: (w[0], w[1])):
+        current = merged[-1] if merged else None
+        if (current is not None
+                and start <= current[1] + timedelta(days=merge_gap_days)
+                and (max(current[1], end) - current[0]).days <= max_window_days):
+            current[1] = max(current[1], end)
+            current[2] = min(current[2], order)
+            current[3].append((row_id, pattern))
+        else:
+            merged.append([start, end, order, [(row_id, pattern)]])
+    return merged
+
+
+def plan_queries(rows, state_level_patterns=STATE_LEVEL_PATTERNS, max_window_days=MAX_WINDOW_DAYS,
+                 merge_gap_days=0):
+    """
+    Plan the searches for rows, an iterable of (row_id, {pattern: query}, start, end)
+    where start and end are dates. Returns a list of PlannedQuery in input order.
+    """
+    exact = {}
+    state_level = defaultdict(list)
+    for order, (row_id, queries, start, end) in enumerate(rows):
+        for pattern, query in queries.items():
+            if pattern in state_level_patterns:
+                state_level[query].append((start, end, order, row_id, pattern))
+                continue
+            key = (query, start, end)
+            if key not in exact:
+                exact[key] = PlannedQuery(query, start, end, order)
+            exact[key].targets.append((row_id, pattern))
+
+    plan = list(exact.values())
+    for query, windows in state_level.items():
+        for start, end, order, targets in _merge_windows(windows, max_window_days, merge_gap_days):
+            planned = PlannedQuery(query, start, end, order)
+            planned.targets = targets
+            plan.append(planned)
+    plan.sort(key=lambda planned: planned.order)
+    return plan
@@ -0,0 +1,468 @@
+"""
+Structured extraction of the raid attributes from validated articles.
+
+DS701_cell_population.ipynb pulled the arrest date out of every article with
+two serial gpt calls (is the date there? then what is it?), and the other
+columns of the raid dataset (arrest counts, city, target, previous
+convictions, women arrested, nationalities) were only ever commented-out
+questions in main.py. Here a single request fills them all, for one article or
+for a pack of up to batch_validator.BATCH_MAX_ARTICLES articles of the same
+county, and the answer is checked with pydantic (RaidAttributes) like the
+validation verdicts. An article the packed answer leaves out is asked again
+on its own.
+
+Extractions are stored in the verdict cache under their own prompt version,
+article texts come from the article store through article_fetcher, and the
+counties of a result file are extracted concurrently by a pool of threads
+sharing the "openai" quota of the rate limiter. Tokens and dollars are added
+up per model, and the accuracy against the hand-labelled rows of the notebook
+(HAND_LABELS) can be measured for any model or prompt change:
+
+    python raid_attributes.py extract ~/Desktop/valid_results.csv raid_attributes.csv --short raids.csv
+    python raid_attributes.py evaluate question_answering_experiement/ --model gpt-4o
+    python raid_attributes.py evaluate question_answering_experiement/ --locations labelled_rows.csv
+
+The long format has one row per validated article and county, the short
+format one row per raid (raid_groups.group_raids) with the attributes of its
+articles combined.
+"""
+import argparse
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import List, Optional
+
+import openai
+import pandas as pd
+from dotenv import load_dotenv
+from pydantic import BaseModel, ValidationError, field_validator
+
+import article_fetcher
+import batch_validator
+import llm_verdict
+import raid_groups
+import row_source
+import text_chunker
+import verdict_cache
+from rate_limiter import RateLimited, limiter
+
+load_dotenv("api_keys.env")
+open_ai_key = os.getenv("OPEN_AI_KEY")
+
+GPT_MODEL = "gpt-4o-mini"
+WORKERS = 8  # counties extracted at the same time
+SYSTEM_PROMPT = "Extract the details of the immigration raid described in the provided text."
+
+# the JSON object we want back for one article (a str.format template)
+ATTRIBUTE_FORMAT = "{{\"arrest_date\": first day of the ICE operation as YYYY-MM-DD or null,\
+        \n\"end_date\": last day of the operation as YYYY-MM-DD or null,\
+        \n\"arrests_in_county\": number of people arrested in {location} or null,\
+        \n\"total_arrests\": total number of people arrested in this operation or null,\
+        \n\"city\": city of the raid or null, \"county\": county of the raid or null,\
+        \n\"target\": who or what the operation targeted (e.g. \"convicted criminals\", \"a meat packing plant\") or null,\
+        \n\"previous_convictions\": number of the people arrested who had previous convictions or null,\
+        \n\"female_arrests\": number of women arrested or null,\
+        \n\"nationalities\": list of the nationalities of the people arrested in {location}, [] if not mentioned}}"
+EXTRACTION_QUESTION = "The text is an article about an immigration raid in {location}. Answer from the article only,\
+        use null where it does not say and do not guess. Dates may be given relative to the publication date\
+        (\"yesterday\", \"last week\").\nReply with only a JSON object of this form:\n" + ATTRIBUTE_FORMAT
+BATCH_EXTRACTION_QUESTION = "The messages above are {count} numbered articles about immigration raids in {location}.\
+        Answer from each article only, use null where it does not say and do not guess. Dates may be given relative to\
+        the publication date (\"yesterday\", \"last week\").\
+        \nReply with only a JSON object {{\"articles\": [...]}} holding one object per article, with \"article\": the\
+        article number and the fields of this form:\n" + ATTRIBUTE_FORMAT
+PROMPT_VERSION = verdict_cache.prompt_version(SYSTEM_PROMPT, EXTRACTION_QUESTION)
+BATCH_PROMPT_VERSION = verdict_cache.prompt_version(SYSTEM_PROMPT, BATCH_EXTRACTION_QUESTION)
+
+ATTRIBUTES = ["arrest_date", "end_date", "arrests_in_county", "total_arrests", "city", "county", "target",
+              "previous_convictions", "female_arrests", "nationalities"]
+COUNTS = ["arrests_in_county", "total_arrests", "previous_convictions", "female_arrests"]
+PUBLISHED_COLUMNS = ("Article_Date", "date_published")  # publication date column of main.py / the Bing scraper
+
+# dollars per million prompt and completion tokens
+PRICES = {
+    "gpt-3.5-turbo": (0.5, 1.5),
+    "gpt-4o-mini": (0.15, 0.6),
+    "gpt-4o": (2.5, 10.0),
+    "gpt-4-turbo": (10.0, 30.0),
+}
+
+# start and end dates of the test articles of DS701_cell_population.ipynb, by row of Raids_Data, labelled by hand
+# (None where the article does not give the date)
+HAND_LABELS = {
+    28: {"arrest_date": "2015-05-18", "end_date": "2015-06-13"},
+    63: {"arrest_date": None, "end_date": None},
+    124: {"arrest_date": "2016-02-09", "end_date": "2016-02-23"},
+    126: {"arrest_date": None, "end_date": None},
+    127: {"arrest_date": None, "end_date": None},
+    201: {"arrest_date": "2016-06-09", "end_date": "2016-06-16"},
+    202: {"arrest_date": "2016-07-17", "end_date": "2016-07-20"},
+    208: {"arrest_date": "2016-08-08", "end_date": "2016-08-08"},
+    209: {"arrest_date": "2016-09-06", "end_date": "2016-09-06"},
+    267: {"arrest_date": "2017-03-07", "end_date": "2017-03-10"},
+    452: {"arrest_date": "2018-04-09", "end_date": "2018-04-24"},
+    463: {"arrest_date": "2018-04-16", "end_date": "2018-04-20"},
+}
+
+
+def iso_date(value):
+    """A date answered as YYYY-MM-DD, m/d/yy or m/d/yyyy as YYYY-MM-DD, None for anything else"""
+    if not isinstance(value, str):
+        return None
+    for fmt in ("%Y-%m-%d",) + row_source.DATE_FORMATS:
+        try:
+            return datetime.strptime(value.strip(), fmt).date().isoformat()
+        except ValueError:
+            continue
+    return None
+
+
+class RaidAttributes(BaseModel):
+    """The details the model found in one article, None (or no nationalities) where the article does not say"""
+    arrest_date: Optional[str] = None
+    end_date: Optional[str] = None
+    arrests_in_county: Optional[int] = None
+    total_arrests: Optional[int] = None
+    city: Optional[str] = None
+    county: Optional[str] = None
+    target: Optional[str] = None
+    previous_convictions: Optional[int] = None
+    female_arrests: Optional[int] = None
+    nationalities: List[str] = []
+
+    @field_validator("arrest_date", "end_date", mode="before")
+    @classmethod
+    def _date(cls, value):
+        return iso_date(value)
+
+    @field_validator("arrests_in_county", "total_arrests", "previous_convictions", "female_arrests", mode="before")
+    @classmethod
+    def _count(cls, value):
+        return llm_verdict.parse_count(value)
+
+    @field_validator("city", "county", "target", mode="before")
+    @classmethod
+    def _text(cls, value):
+        # models write "null" or "unknown" as often as null
+        if not isinstance(value, str) or value.strip().lower() in ("", "null", "none", "unknown", "n/a"):
+            return None
+        return value.strip()
+
+    @field_validator("nationalities", mode="before")
+    @classmethod
+    def _nationalities(cls, value):
+        if isinstance(value, str):
+            value = value.split(",")
+        if not isinstance(value, list):
+            return []
+        return [str(item).strip() for item in value if item and str(item).strip().lower() not in ("null", "unknown")]
+
+    def record(self):
+        return self.model_dump()
+
+
+def to_attributes(value):
+    """Validate an already decoded answer, returns RaidAttributes or None"""
+    if not isinstance(value, dict):
+        return None
+    try:
+        return RaidAttributes.model_validate(value)
+    except ValidationError:
+        return None
+
+
+def parse_batch_attributes(content, count):
+    """The answer for a pack of count articles as a list of RaidAttributes, None for every article not answered properly"""
+    attributes = [None] * count
+    answer = llm_verdict.json_object(content)
+    if not isinstance(answer, dict) or not isinstance(answer.get("articles"), list):
+        return attributes
+    for entry in answer["articles"]:
+        if not isinstance(entry, dict):
+            continue
+        try:
+            number = int(entry.get("article"))
+        except (TypeError, ValueError):
+            continue
+        if 1 <= number <= count:
+            attributes[number - 1] = to_attributes(entry)
+    return attributes
+
+
+class CostMeter:
+    """
+    Thread-safe count of the gpt requests, tokens and dollars per model, of the extractions found in
+    the cache and of the answers that could not be read
+    """
+
+    def __init__(self):
+        self.requests = {}
+        self.tokens = {}
+        self.dollars = {}
+        self.cached = 0
+        self.unreadable = 0
+        self._lock = threading.Lock()
+
+    def add_request(self, model, usage):
+        prompt_tokens, completion_tokens = usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0)
+        prompt_price, completion_price = PRICES.get(model, (0.0, 0.0))
+        with self._lock:
+            self.requests[model] = self.requests.get(model, 0) + 1
+            self.tokens[model] = self.tokens.get(model, 0) + prompt_tokens + completion_tokens
+            self.dollars[model] = (self.dollars.get(model, 0.0)
+                                   + (prompt_tokens * prompt_price + completion_tokens * completion_price) / 1e6)
+
+    def add_cached(self, count=1):
+        with self._lock:
+            self.cached += count
+
+    def add_unreadable(self, count=1):
+        with self._lock:
+            self.unreadable += count
+
+    def total(self):
+        with self._lock:
+            return sum(self.dollars.values())
+
+    def summary(self):
+        with self._lock:
+            parts = [f"{model}: {self.requests[model]} requests, {self.tokens[model]} tokens (${self.dollars[model]:.4f})"
+                     for model in sorted(self.requests)]
+            parts.append(f"{self.cached} articles from cache")
+            parts.append(f"{self.unreadable} unreadable answers")
+            return "; ".join(parts)
+
+
+# helper function that sends one chat completion, 429s are raised as RateLimited so the limiter can back off
+def _chat_completion(model, messages):
+    try:
+        return openai.ChatCompletion.create(model=model, messages=messages, response_format={"type": "json_object"})
+    except openai.error.RateLimitError as e:
+        headers = e.headers or {}
+        raise RateLimited(headers.get("retry-after"), str(e))
+
+
+def _article_message(text, published=None):
+    return f"Published: {published}\n{text}" if published else text
+
+
+class AttributeExtractor:
+    """
+    Extracts RaidAttributes from article texts, through the verdict cache, in packs of articles
+    of the same location (batch=True) or one request per article.
+    """
+
+    def __init__(self, model=GPT_MODEL, cache=None, batch=True, api_key=None):
+        self.model = model
+        self.cache = cache or verdict_cache.VerdictCache()
+        self.batch = batch
+        self.costs = CostMeter()
+        self.token_meter = text_chunker.TokenMeter()
+        openai.api_key = api_key or open_ai_key
+
+    def _complete(self, messages):
+        response = limiter.call("openai", _chat_completion, self.model, messages)
+        self.costs.add_request(self.model, response.get("usage") or {})
+        return response['choices'][0]['message']['content']
+
+    def shorten(self, text, county=None, state=None):
+        """The passages of text most likely to hold the attributes, within the model's token budget"""
+        passages = text_chunker.select_passages(text, county, state, budget=text_chunker.token_budget(self.model),
+                                                model=self.model)
+        self.token_meter.add(passages)
+        return passages.text
+
+    def extract_one(self, text, location, published=None):
+        """RaidAttributes of one article, None if the model twice answered something that does not fit the schema"""
+        for attempt in range(2):  # ask once more if the answer does not parse
+            answer = self._complete([
+                {"role": "system", "content": SYSTEM_PROMPT},
+                {"role": "user", "content": _article_message(text, published)},
+                {"role": "user", "content": EXTRACTION_QUESTION.format(location=location)},
+            ])
+            attributes = to_attributes(llm_verdict.json_object(answer))
+            if attributes is not None:
+                return attributes
+            self.costs.add_unreadable()
+        return None
+
+    def _extract_pack(self, texts, published, location):
+        messages = [{"role": "system", "content": SYSTEM_PROMPT}]
+        for number, (text, date) in enumerate(zip(texts, published), 1):
+            messages.append({"role": "user", "content": f"Article {number}:\n{_article_message(text, date)}"})
+        messages.append({"role": "user", "content": BATCH_EXTRACTION_QUESTION.format(count=len(texts), location=location)})
+        return parse_batch_attributes(self._complete(messages), len(texts))
+
+    def extract(self, links, texts, county, state, published=None):
+        """
+        RaidAttributes of every article of one county (None where there is no text or no usable answer), in order.
+        Cached extractions are reused, the others are asked in packs and stored in the verdict cache.
+        """
+        location = f"{county}, {state}"
+        published = published or [None] * len(links)
+        found = [None] * len(links)
+        pending = []
+        for i, (link, text) in enumerate(zip(links, texts)):
+            if not text:
+                continue
+            text = self.shorten(text, county, state)
+            for version in (PROMPT_VERSION, BATCH_PROMPT_VERSION):
+                cached = self.cache.get(link, text, location, "", "", self.model, version)
+                if cached is not None and cached[2] is not None:
+                    found[i] = to_attributes(cached[2])
+                    self.costs.add_cached()
+                    break
+            else:
+                pending.append((i, text))
+
+        pending_texts = [text for _, text in pending]
+        packs = batch_validator.pack_articles(pending_texts) if self.batch else [[j] for j in range(len(pending))]
+        for pack in packs:
+            answers = [None] * len(pack)
+            if len(pack) > 1:
+                answers = self._extract_pack([pending_texts[j] for j in pack], [published[pending[j][0]] for j in pack],
+                                             location)
+            for j, attributes in zip(pack, answers):
+                i, text = pending[j]
+                version = BATCH_PROMPT_VERSION
+                if attributes is None:
+                    attributes, version = self.extract_one(text, location, published[i]), PROMPT_VERSION
+                if attributes is not None:
+                    self.cache.put(links[i], text, location, "", "", self.model, version, True, "", attributes.record())
+                found[i] = attributes
+        return found
+
+
+def _published_column(results):
+    return next((column for column in PUBLISHED_COLUMNS if column in results), None)
+
+
+def extract_results(results, extractor, workers=WORKERS):
+    """
+    Long format: the result rows (main.py's valid results or the Bing scraper's search results) with the
+    extracted attributes added. The counties are fetched and extracted concurrently.
+    """
+    columns = raid_groups.columns_of(results)
+    published_column = _published_column(results)
+    groups = list(results.groupby([columns["county"], columns["state"]], sort=False, dropna=False).indices.items())
+
+    def extract_group(group):
+        (county, state), positions = group
+        rows = results.iloc[positions]
+        links = rows[columns["link"]].tolist()
+        published = rows[published_column].tolist() if published_column else None
+        try:
+            texts = article_fetcher.fetch_article_texts(links)
+            return positions, extractor.extract(links, texts, county, state, published)
+        except Exception as e:
+            print(f"Error extracting the articles of {county}, {state}: {e}")
+            return positions, [None] * len(positions)
+
+    extracted = [None] * len(results)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for positions, attributes in pool.map(extract_group, groups):
+            for position, found in zip(positions, attributes):
+                extracted[position] = found
+
+    records = [(found or RaidAttributes()).record() for found in extracted]
+    attributes = pd.DataFrame(records, columns=ATTRIBUTES, index=results.index)
+    attributes[COUNTS] = attributes[COUNTS].astype("Int64")
+    attributes["nationalities"] = attributes["nationalities"].map("; ".join)
+    attributes["extracted"] = [found is not None for found in extracted]
+    return pd.concat([results, attributes], axis=1)
+
+
+def short_format(long_results, max_gap_days=raid_groups.MAX_GAP_DAYS, max_sources=raid_groups.MAX_SOURCES):
+    """
+    One row per raid (raid_groups.group_raids) with the attributes of its articles combined, the operation
+    dates the articles report are reported_start / reported_end next to the abnormal days' start_date / end_date
+    """
+    events, raid_ids = raid_groups.group_raids(long_results, max_gap_days=max_gap_days, max_sources=max_sources)
+    attributes = long_results[ATTRIBUTES].assign(raid_id=raid_ids.to_numpy())
+    attributes = attributes[attributes["raid_id"] >= 0]
+    combined = attributes.groupby("raid_id").agg(
+        reported_start=("arrest_date", "min"), reported_end=("end_date", "max"),
+        arrests_in_county=("arrests_in_county", "max"), total_arrests=("total_arrests", "max"),
+        city=("city", "first"), county=("county", "first"), target=("target", "first"),
+        previous_convictions=("previous_convictions", "max"), female_arrests=("female_arrests", "max"))
+    nationalities = attributes.assign(nationalities=attributes["nationalities"].str.split("; ")).explode("nationalities")
+    nationalities = nationalities[nationalities["nationalities"].fillna("") != ""]
+    combined["nationalities"] = nationalities.groupby("raid_id")["nationalities"].agg(
+        lambda values: "; ".join(sorted(set(values))))
+    return events.join(combined, on="raid_id")
+
+
+def accuracy(predictions, labels=HAND_LABELS):
+    """
+    Share of the labelled articles whose extracted value equals the label, per labelled field.
+    predictions maps the row to its RaidAttributes (or None); "not mentioned" is an answer like any other.
+    """
+    scores = {}
+    rows = [row for row in labels if row in predictions]
+    for field in sorted({field for row in rows for field in labels[row]}):
+        labelled = [row for row in rows if field in labels[row]]
+        hits = sum(getattr(predictions[row] or RaidAttributes(), field) == labels[row][field] for row in labelled)
+        scores[field] = hits / len(labelled) if labelled else None
+    return scores
+
+
+def evaluate(directory, extractor, prefix="", locations=None, location="the county of the raid"):
+    """
+    Extract the hand-labelled articles saved as {prefix}row{N}_article_text.txt in directory, returns accuracy().
+    locations maps a row to its (county, state), used to pick the passages and in the question like extract does.
+    The hand labels carry no location, so rows missing from it are scored location-agnostic: passages are
+    picked without county or state terms and the question names the generic location.
+    """
+    locations = locations or {}
+    predictions = {}
+    for row in HAND_LABELS:
+        path = os.path.join(directory, f"{prefix}row{row}_article_text.txt")
+        if not os.path.exists(path):
+            print(f"No article text for row {row} ({path})")
+            continue
+        with open(path, encoding="utf-8") as f:
+            text = f.read()
+        county, state = locations.get(row, (None, None))
+        row_location = f"{county}, {state}" if county and state else location
+        predictions[row] = extractor.extract_one(extractor.shorten(text, county, state), row_location)
+    return accuracy(predictions)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Extract the raid attributes of validated articles")
+    parser.add_argument("--model", default=GPT_MODEL)
+    parser.add_argument("--no-batch", action="store_true", help="one gpt request per article")
+    commands = parser.add_subparsers(dest="command", required=True)
+    extract = commands.add_parser("extract", help="extract the attributes of a result file")
+    extract.add_argument("results", help="valid_results.csv of main.py, search results of the Bing scraper, or a parquet dataset")
+    extract.add_argument("output_csv", nargs="?", default="raid_attributes.csv", help="long format, one row per article")
+    extract.add_argument("--short", help="also write the short format, one row per raid, to this csv")
+    extract.add_argument("--workers", type=int, default=WORKERS)
+    check = commands.add_parser("evaluate", help="accuracy on the hand-labelled articles of the notebook")
+    check.add_argument("directory", help="directory of the row{N}_article_text.txt files")
+    check.add_argument("--prefix", default="", help="file name prefix, pred_ for the scraped texts")
+    check.add_argument("--locations", help="csv of row, county, state of the labelled articles, "
+                                           "without it the articles are scored location-agnostic")
+    args = parser.parse_args()
+
+    limiter.configure("openai", 50)
+    extractor = AttributeExtractor(args.model, batch=not args.no_batch)
+    if args.command == "extract":
+        long_results = extract_results(raid_groups.load_results(args.results), extractor, args.workers)
+        long_results.to_csv(args.output_csv, index=False)
+        print(f"Attributes of {int(long_results['extracted'].sum())} of {len(long_results)} articles written to {args.output_csv}")
+        if args.short:
+            raids = short_format(long_results)
+            raids.to_csv(args.short, index=False)
+            print(f"{len(raids)} raids written to {args.short}")
+    else:
+        locations = None
+        if args.locations:
+            labelled = pd.read_csv(args.locations, dtype="string", keep_default_na=False)
+            locations = {int(row): (county, state) for row, county, state in
+                         zip(labelled["row"], labelled["county"], labelled["state"])}
+        for field, score in evaluate(args.directory, extractor, args.prefix, locations).items():
+            print(f"Accuracy of {args.model} for {field}: {score:.3f}" if score is not None else f"No labels for {field}")
+    print(f"Article text sent to gpt: {extractor.token_meter.summary()}")
+    print(f"Extraction cost: {extractor.costs.summary()}")
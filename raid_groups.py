@@ -0,0 +1,168 @@
+"""
+Grouping of validated search results into raid events, replacing the groupby /
+lambda aggregation of CombiningSources.ipynb.
+
+The notebook cut every county's dates into fixed 15 day buckets counted from
+its first date, then aggregated on the bucket number alone, so the same bucket
+of different counties was merged into one "raid". Here the results of each
+county (StateCountyFIPS, or state and county name where the code is missing)
+are sorted by arrest date and a new raid starts wherever the gap to the
+previous arrest date of the same county is more than max_gap_days. A run of
+abnormal days a few days apart is one raid however long it lasts.
+
+Everything after one sort is NumPy over the whole table (factorized links,
+reduceat per raid, one scatter into the URL_i / Title_i columns), so millions
+of result rows take seconds. Both scrapers' outputs can be grouped directly:
+
+    python raid_groups.py ~/Desktop/valid_results.csv raid_events.csv
+    python raid_groups.py final_search_results.csv raid_events.csv --max-gap 15
+"""
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+
+import row_source
+
+MAX_GAP_DAYS = 15  # arrest dates of one county at most this many days apart belong to the same raid
+MAX_SOURCES = 10  # URL_i / Title_i columns per raid
+
+# column names of the two scrapers' outputs, by role
+MAIN_COLUMNS = {"fips": "StateCountyFIPS", "county": "County", "state": "State", "date": "Arrest_Date",
+                "link": "Article_Link", "title": "Article_Title"}
+BING_COLUMNS = {"fips": "StateCountyFIPS", "county": "CountyName", "state": "ST", "date": "arrest_date",
+                "link": "url", "title": "title"}
+
+
+def columns_of(results):
+    """The column mapping of a result table, main.py's valid results or the Bing scraper's search results"""
+    for columns in (MAIN_COLUMNS, BING_COLUMNS):
+        if columns["link"] in results and columns["date"] in results:
+            return columns
+    raise ValueError("not a result table of main.py or bing_search_arrest_dataset.py")
+
+
+def load_results(path):
+    """Read a result csv, or a partitioned parquet dataset directory (parquet_sink)"""
+    if os.path.isdir(path):
+        return pd.read_parquet(path)
+    return pd.read_csv(path, dtype="string", keep_default_na=False, na_values=[""])
+
+
+def _factorized(values, convert):
+    # convert only the distinct values of a column, millions of rows usually hold a few thousand
+    codes, uniques = pd.factorize(values)
+    return codes, convert(pd.Series(uniques, dtype="string"))
+
+
+def source_columns(results, groups, n_groups, columns=None, max_sources=MAX_SOURCES):
+    """
+    The distinct links of every group of result rows, in order of first appearance:
+    a frame of n_groups rows with sources (count of distinct links), URL_1.. and Title_1..
+    groups is the group number of every row of results, -1 for rows left out.
+    """
+    columns = columns or columns_of(results)
+    groups = np.asarray(groups, dtype=np.int64)
+    order = np.flatnonzero(groups >= 0)
+    order = order[np.argsort(groups[order], kind="stable")]
+    group_sorted = groups[order]
+
+    link_codes, link_values = pd.factorize(results[columns["link"]])
+    link_codes = link_codes[order]
+    usable = link_codes >= 0
+    usable[usable] = ~np.isin(np.asarray(link_values, dtype=object), ["", "N/A"])[link_codes[usable]]
+    positions = np.flatnonzero(usable)
+    pairs = group_sorted[positions] * (len(link_values) + 1) + link_codes[positions]
+    _, first = np.unique(pairs, return_index=True)
+    first = positions[np.sort(first)]
+    source_groups = group_sorted[first]
+    rank = np.arange(len(first)) - np.searchsorted(source_groups, source_groups)
+    kept, kept_rank = first[rank < max_sources], rank[rank < max_sources]
+
+    sources = {"sources": np.bincount(source_groups, minlength=n_groups)}
+    wide_columns = {"URL": columns["link"]}
+    if columns["title"] in results:
+        wide_columns["Title"] = columns["title"]
+    # the n-th source of every group as a row number, filled in with one take per column
+    for name, column in wide_columns.items():
+        values = results[column].array
+        for i in range(max_sources):
+            source_rows = np.full(n_groups, -1, dtype=np.int64)
+            nth = kept[kept_rank == i]
+            source_rows[group_sorted[nth]] = order[nth]
+            sources[f"{name}_{i + 1}"] = values.take(source_rows, allow_fill=True)
+    return pd.DataFrame(sources)
+
+
+def group_raids(results, columns=None, max_gap_days=MAX_GAP_DAYS, max_sources=MAX_SOURCES):
+    """
+    Cluster result rows into raid events.
+    Returns (events, raid_ids): one row per raid (raid_id, StateCountyFIPS, CountyName, ST,
+    start_date, end_date, arrest_days, results, sources, URL_1.., Title_1..) and the raid_id
+    of every input row (-1 for rows without a readable arrest date).
+    """
+    columns = columns or columns_of(results)
+    date_codes, unique_dates = _factorized(results[columns["date"]], row_source.parse_dates)
+    unique_days = unique_dates.to_numpy(dtype="datetime64[D]")
+    readable = np.append(~np.isnat(unique_days), False)  # code -1 (empty) indexes the last entry
+    unique_days = unique_days.astype(np.int64)
+    fips_codes, unique_fips = _factorized(results[columns["fips"]],
+                                          lambda u: pd.to_numeric(u, errors="coerce").astype("Int64"))
+    fips = unique_fips.to_numpy(dtype="float64", na_value=np.nan)[fips_codes]
+    fips[fips_codes < 0] = np.nan
+    county_codes, unique_counties = _factorized(results[columns["county"]], lambda u: u.str.strip())
+    state_codes, unique_states = _factorized(results[columns["state"]], lambda u: u.str.strip())
+
+    # a county is its FIPS code, or its state and name where the code is missing
+    named = np.isnan(fips)
+    key_codes = np.where(named, -1, fips).astype(np.int64)
+    key_codes[named] = -2 - pd.factorize(pd.MultiIndex.from_arrays(
+        [unique_states.to_numpy()[state_codes[named]], unique_counties.to_numpy()[county_codes[named]]]))[0]
+
+    rows = np.flatnonzero(readable[date_codes])
+    days = unique_days[date_codes[rows]]
+    sort = np.lexsort((days, key_codes[rows]))
+    order, sorted_days = rows[sort], days[sort]
+    sorted_keys = key_codes[order]
+    n = len(order)
+    new_raid = np.ones(n, dtype=bool)
+    new_raid[1:] = (sorted_keys[1:] != sorted_keys[:-1]) | (np.diff(sorted_days) > max_gap_days)
+    raid_sorted = np.cumsum(new_raid) - 1
+    raid_ids = np.full(len(results), -1, dtype=np.int64)
+    raid_ids[order] = raid_sorted
+    starts = np.flatnonzero(new_raid)
+    n_raids = len(starts)
+    ends = np.append(starts[1:], n)[:n_raids] - 1
+
+    new_day = np.ones(n, dtype=bool)
+    new_day[1:] = new_raid[1:] | (sorted_days[1:] != sorted_days[:-1])
+    first_rows = order[starts]
+    events = {
+        "raid_id": np.arange(n_raids),
+        "StateCountyFIPS": pd.array(fips[first_rows], dtype="Int64"),
+        "CountyName": unique_counties.to_numpy()[county_codes[first_rows]],
+        "ST": unique_states.to_numpy()[state_codes[first_rows]],
+        "start_date": sorted_days[starts].astype("datetime64[D]"),
+        "end_date": sorted_days[ends].astype("datetime64[D]"),
+        "arrest_days": np.add.reduceat(new_day, starts) if n_raids else np.zeros(0, dtype=np.int64),
+        "results": ends - starts + 1,
+    }
+
+    events = pd.DataFrame(events)
+    sources = source_columns(results, raid_ids, n_raids, columns, max_sources)
+    events = pd.concat([events, sources], axis=1)
+    return events, pd.Series(raid_ids, index=results.index, name="raid_id")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Group scraper results into raid events")
+    parser.add_argument("results", help="valid_results.csv of main.py, search results of the Bing scraper, or a parquet dataset")
+    parser.add_argument("output_csv", nargs="?", default="raid_events.csv")
+    parser.add_argument("--max-gap", type=int, default=MAX_GAP_DAYS, help="days between arrest dates of one raid")
+    parser.add_argument("--max-sources", type=int, default=MAX_SOURCES, help="URL / title columns per raid")
+    args = parser.parse_args()
+
+    events, _ = group_raids(load_results(args.results), max_gap_days=args.max_gap, max_sources=args.max_sources)
+    events.to_csv(args.output_csv, index=False)
+    print(f"{len(events)} raids in {events['StateCountyFIPS'].nunique()} counties written to {args.output_csv}")
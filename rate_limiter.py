@@ -0,0 +1,223 @@
+"""
+Adaptive rate control shared by every external API call (Bing, SerpAPI, OpenAI).
+
+Each API key gets its own token bucket. The bucket slows down multiplicatively
+when the API answers 429 (and stops entirely until Retry-After has passed) and
+speeds back up additively after successful calls, so we settle just under the
+rate the service actually accepts. A global concurrency ceiling caps the number
+of calls in flight across all keys.
+
+Retries use jittered exponential backoff in a loop, never recursion. The same
+limiter works from threads (call) and from asyncio tasks (acall).
+
+Callers signal throttling by raising RateLimited, optionally with the value of
+the Retry-After header:
+
+    def _request():
+        response = requests.get(...)
+        if response.status_code == 429:
+            raise RateLimited(response.headers.get('Retry-After'))
+        return response.json()
+
+    data = limiter.call('bing', _request)
+"""
+import asyncio
+import random
+import threading
+import time
+
+DEFAULT_MAX_CONCURRENCY = 64
+DEFAULT_MAX_RETRIES = 8
+BACKOFF_BASE = 1.0  # seconds
+BACKOFF_CAP = 120.0  # seconds
+
+
+class RateLimited(Exception):
+    """Raised by a wrapped call when the service answered 429 / too many requests"""
+
+    def __init__(self, retry_after=None, message="rate limited"):
+        super().__init__(message)
+        try:
+            self.retry_after = float(retry_after) if retry_after is not None else None
+        except (TypeError, ValueError):
+            self.retry_after = None
+
+
+# helper function for "full jitter" exponential backoff
+def backoff_delay(attempt, base=BACKOFF_BASE, cap=BACKOFF_CAP):
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+class AdaptiveTokenBucket:
+    """
+    Token bucket whose refill rate adapts to throttling.
+
+    rate starts at max_rate tokens per second, is multiplied by decrease on
+    every 429 (never below min_rate) and grows by increase tokens per second
+    after every successful call (never above max_rate).
+    """
+
+    def __init__(self, max_rate, burst=None, min_rate=None, decrease=0.5, increase=None):
+        self.max_rate = float(max_rate)
+        self.min_rate = float(min_rate) if min_rate is not None else self.max_rate / 100
+        self.rate = self.max_rate
+        self.capacity = float(burst) if burst is not None else max(1.0, self.max_rate)
+        self.decrease = decrease
+        self.increase = increase if increase is not None else self.max_rate / 50
+        self.tokens = self.capacity
+        self.blocked_until = 0.0  # set from Retry-After
+        self.throttled = 0
+        self.calls = 0
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def reserve(self):
+        """Take a token and return 0, or return how long to wait before trying again"""
+        with self._lock:
+            now = time.monotonic()
+            if now < self.blocked_until:
+                return self.blocked_until - now
+            self._refill(now)
+            if self.tokens >= 1:
+                self.tokens -= 1
+                self.calls += 1
+                return 0.0
+            return (1 - self.tokens) / self.rate
+
+    def on_success(self):
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.increase)
+
+    def on_throttle(self, retry_after=None):
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            self.throttled += 1
+            self.rate = max(self.min_rate, self.rate * self.decrease)
+            self.tokens = min(self.tokens, 0.0)
+            if retry_after:
+                self.blocked_until = max(self.blocked_until, now + retry_after)
+
+    def throttle_rate(self):
+        """Share of calls that came back throttled"""
+        return self.throttled / self.calls if self.calls else 0.0
+
+
+class RateLimiter:
+    """Per-key adaptive buckets plus a global ceiling on concurrent calls"""
+
+    def __init__(self, max_concurrency=DEFAULT_MAX_CONCURRENCY, max_retries=DEFAULT_MAX_RETRIES):
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.buckets = {}
+        self._in_flight = 0
+        self._condition = threading.Condition()
+
+    def configure(self, key, max_rate, burst=None, min_rate=None):
+        """Set the quota of one key, in calls per second"""
+        self.buckets[key] = AdaptiveTokenBucket(max_rate, burst, min_rate)
+        return self.buckets[key]
+
+    def bucket(self, key):
+        if key not in self.buckets:
+            self.configure(key, 1.0)  # unknown keys get a careful default of one call per second
+        return self.buckets[key]
+
+    # --- concurrency ceiling ----------------------------------------------
+
+    def _try_enter(self):
+        with self._condition:
+            if self._in_flight < self.max_concurrency:
+                self._in_flight += 1
+                return True
+            return False
+
+    def _enter(self):
+        with self._condition:
+            while self._in_flight >= self.max_concurrency:
+                self._condition.wait()
+            self._in_flight += 1
+
+    def _leave(self):
+        with self._condition:
+            self._in_flight -= 1
+            self._condition.notify()
+
+    # --- blocking api -------------------------------------------------------
+
+    def acquire(self, key):
+        """Block until key may make one more call"""
+        bucket = self.bucket(key)
+        while True:
+            wait = bucket.reserve()
+            if wait <= 0:
+                return
+            time.sleep(wait)
+
+    def call(self, key, func, *args, **kwargs):
+        """Call func under key's quota, retrying RateLimited with backoff"""
+        bucket = self.bucket(key)
+        for attempt in range(self.max_retries + 1):
+            self.acquire(key)
+            self._enter()
+            try:
+                result = func(*args, **kwargs)
+            except RateLimited as e:
+                bucket.on_throttle(e.retry_after)
+                if attempt == self.max_retries:
+                    raise
+                time.sleep(e.retry_after if e.retry_after else backoff_delay(attempt))
+                continue
+            finally:
+                self._leave()
+            bucket.on_success()
+            return result
+
+    # --- asyncio api ----------------------------------------------------------
+
+    async def aacquire(self, key):
+        bucket = self.bucket(key)
+        while True:
+            wait = bucket.reserve()
+            if wait <= 0:
+                return
+            await asyncio.sleep(wait)
+
+    async def _aenter(self):
+        delay = 0.005
+        while not self._try_enter():
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 0.25)
+
+    async def acall(self, key, func, *args, **kwargs):
+        """Async version of call, func is a coroutine function"""
+        bucket = self.bucket(key)
+        for attempt in range(self.max_retries + 1):
+            await self.aacquire(key)
+            await self._aenter()
+            try:
+                result = await func(*args, **kwargs)
+            except RateLimited as e:
+                bucket.on_throttle(e.retry_after)
+                if attempt == self.max_retries:
+                    raise
+                await asyncio.sleep(e.retry_after if e.retry_after else backoff_delay(attempt))
+                continue
+            finally:
+                self._leave()
+            bucket.on_success()
+            return result
+
+    def stats(self):
+        """Current rate and throttle share of every key"""
+        return {key: {"rate": round(bucket.rate, 3), "calls": bucket.calls, "throttled": bucket.throttled,
+                      "throttle_rate": round(bucket.throttle_rate(), 4)}
+                for key, bucket in self.buckets.items()}
+
+
+# shared limiter used by all the scrapers, each script configures the keys it uses
+limiter = RateLimiter()
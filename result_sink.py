@@ -0,0 +1,139 @@
+"""
+Buffered output sinks for the valid / invalid / manual check result files.
+
+A CsvSink keeps its file open for the whole run and buffers rows in memory,
+flushing them once flush_rows rows are waiting or flush_seconds have passed since
+the last flush. checkpoint() flushes and fsyncs, so everything written before a
+checkpoint survives a crash. All methods take a lock, so one sink can be shared
+by concurrent workers.
+"""
+import csv
+import os
+import threading
+import time
+
+DEFAULT_FLUSH_ROWS = 500
+DEFAULT_FLUSH_SECONDS = 5.0
+
+
+# helper function that returns the columns of an existing output file, making sure it holds every one of fieldnames
+# a file written with fewer columns is widened, extra columns (e.g. the sharded runner's _row_id) are kept as they are
+# returns None for an empty file
+def _fix_header(path, fieldnames):
+    with open(path, newline='', encoding='utf-8') as file:
+        reader = csv.reader(file)
+        header = next(reader, None)
+        if header is None or header == fieldnames:
+            return header
+        rows = list(reader)
+
+    if set(header) & set(fieldnames):
+        if set(fieldnames) <= set(header):
+            return header  # every column is there, in another order or with extra ones
+        # file written with an older header (e.g. invalid results without LLM_Analysis), widen it
+        columns = fieldnames + [name for name in header if name not in fieldnames]
+        records = [dict(zip(header, row)) for row in rows]
+    else:
+        # file written without a header, its first line is already a data row
+        columns = fieldnames
+        records = [dict(zip(fieldnames, row)) for row in [header] + rows]
+
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w', newline='', encoding='utf-8') as file:
+        writer = csv.DictWriter(file, fieldnames=columns, restval="")
+        writer.writeheader()
+        writer.writerows(records)
+    os.replace(tmp_path, path)
+    print(f"Rewrote {path} with header {columns}")
+    return columns
+
+
+class CsvSink:
+    """Append-only csv file with an in-memory row buffer"""
+
+    def __init__(self, path, fieldnames, flush_rows=DEFAULT_FLUSH_ROWS, flush_seconds=DEFAULT_FLUSH_SECONDS):
+        self.path = path
+        self.fieldnames = fieldnames
+        self.flush_rows = flush_rows
+        self.flush_seconds = flush_seconds
+        self._lock = threading.Lock()
+        self._buffer = []
+        self._last_flush = time.monotonic()
+
+        header = _fix_header(path, fieldnames) if os.path.exists(path) and os.path.getsize(path) > 0 else None
+        self._file = open(path, 'a', newline='', encoding='utf-8')
+        # rows are written in the file's own column order, columns they lack are left empty
+        self._writer = csv.DictWriter(self._file, fieldnames=header or fieldnames, restval="")
+        if header is None:
+            self._writer.writeheader()
+            self._file.flush()
+
+    def write(self, row):
+        self.write_rows([row])
+
+    def write_rows(self, rows):
+        with self._lock:
+            self._buffer.extend(rows)
+            if len(self._buffer) >= self.flush_rows or time.monotonic() - self._last_flush >= self.flush_seconds:
+                self._flush()
+
+    def _flush(self):
+        # caller holds the lock
+        if self._buffer:
+            self._writer.writerows(self._buffer)
+            self._buffer = []
+        self._file.flush()
+        self._last_flush = time.monotonic()
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def checkpoint(self):
+        """Flush the buffer and force it to disk"""
+        with self._lock:
+            self._flush()
+            os.fsync(self._file.fileno())
+
+    def close(self):
+        with self._lock:
+            if self._file.closed:
+                return
+            self._flush()
+            os.fsync(self._file.fileno())
+            self._file.close()
+
+
+class ResultSinks:
+    """The three output files of a search run, addressed by bucket ("valid", "invalid", "manual")"""
+
+    def __init__(self, sinks):
+        self.sinks = sinks
+
+    def write(self, bucket, row, row_id=None):
+        """Write one result row, row_id is the input row it came from"""
+        self.sinks[bucket].write(row)
+
+    def write_rows(self, bucket, rows, row_id=None):
+        if rows:
+            self.sinks[bucket].write_rows(rows)
+
+    def row_done(self, row_id):
+        """Called once every result of input row row_id has been written"""
+
+    def paths(self):
+        return {bucket: sink.path for bucket, sink in self.sinks.items()}
+
+    def checkpoint(self):
+        for sink in self.sinks.values():
+            sink.checkpoint()
+
+    def close(self):
+        for sink in self.sinks.values():
+            sink.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,151 @@
+"""
+Streaming reader for the abnormal arrest days input file.
+
+The file is read in chunks with pandas, so memory stays flat however many
+county-days it holds. Rows come out as ArrestRow namedtuples with a parsed
+arrest date and integer FIPS codes. iter_chunks yields the typed DataFrame
+chunks themselves for code that works on whole columns at once.
+
+The input can be split between worker processes, either by row range
+(start / stop) or by hashing the county or state FIPS code into num_shards
+shards. Row ids are always the row's position in the full file, whatever the
+sharding, so checkpoints and journals stay comparable between runs.
+
+Given a window of (days_before, days_after), the search date window of every
+row is computed for the whole chunk at once and carried as the datetime64
+columns window_start / window_end (ArrestRow.window_start / window_end).
+Rows of an operation plan (operations.py) carry the first and last abnormal
+day of their whole operation as operation_start / operation_end, and their
+window then covers the whole span. They also carry the names of all the
+counties of the operation (county_names), which search_counties puts in the query.
+"""
+from collections import namedtuple
+
+import pandas as pd
+
+INPUT_COLUMNS = ["arrestdate", "CountyName", "ST", "StateCountyFIPS", "FIPSState", "FIPSCounty"]
+SPAN_COLUMNS = ["operation_start", "operation_end"]  # optional, see operations.py
+COUNTY_NAMES_COLUMN = "county_names"  # optional, the member counties of an operation separated by COUNTY_NAMES_SEP
+COUNTY_NAMES_SEP = "; "
+MAX_QUERY_COUNTIES = 5  # counties named in one search query, the ones with the most arrests come first
+DATE_FORMATS = ("%m/%d/%y", "%m/%d/%Y", "%Y-%m-%d")
+DEFAULT_CHUNKSIZE = 5000
+
+ArrestRow = namedtuple("ArrestRow", ["row_id", "arrest_date", "county", "st", "fips", "fips_state", "fips_county",
+                                     "window_start", "window_end", "county_names"], defaults=(None, None, None))
+
+
+def parse_dates(values):
+    """Parse a column of arrest dates written as m/d/yy, m/d/yyyy or yyyy-mm-dd"""
+    values = values.astype("string").str.strip()
+    parsed = pd.Series(pd.NaT, index=values.index, dtype="datetime64[ns]")
+    for fmt in DATE_FORMATS:
+        missing = parsed.isna()
+        if not missing.any():
+            break
+        parsed[missing] = pd.to_datetime(values[missing], format=fmt, errors="coerce")
+    return parsed
+
+
+def add_search_window(chunk, days_before, days_after):
+    """Add the window_start / window_end columns, days_before / days_after around the arrest date (or operation span)"""
+    first = chunk["operation_start"].fillna(chunk["arrestdate"]) if "operation_start" in chunk else chunk["arrestdate"]
+    last = chunk["operation_end"].fillna(chunk["arrestdate"]) if "operation_end" in chunk else chunk["arrestdate"]
+    chunk["window_start"] = first - pd.Timedelta(days=days_before)
+    chunk["window_end"] = last + pd.Timedelta(days=days_after)
+    return chunk
+
+
+def _stable_hash(values, num_shards):
+    # multiplicative (Knuth) hash, taking the high bits so neighbouring FIPS codes spread over the shards
+    return ((values * 2654435761) % (2 ** 32)) // (2 ** 16) % num_shards
+
+
+def shard_of(fips, num_shards):
+    """Shard a single FIPS code falls into, same hash as iter_chunks"""
+    return int(_stable_hash(int(fips), num_shards))
+
+
+def typed_columns(chunk):
+    """Parse the arrest dates and FIPS codes of a frame of input rows (a copy, the frame is left alone)"""
+    chunk = chunk.copy()
+    for col in ["arrestdate"] + [col for col in SPAN_COLUMNS if col in chunk]:
+        chunk[col] = parse_dates(chunk[col])
+    for col in ("StateCountyFIPS", "FIPSState", "FIPSCounty"):
+        chunk[col] = pd.to_numeric(chunk[col], errors="coerce").astype("Int64")
+    chunk["CountyName"] = chunk["CountyName"].astype("string").str.strip()
+    chunk["ST"] = chunk["ST"].astype("string").str.strip()
+    if COUNTY_NAMES_COLUMN in chunk:
+        chunk[COUNTY_NAMES_COLUMN] = chunk[COUNTY_NAMES_COLUMN].astype("string").str.strip()
+    return chunk
+
+
+def iter_chunks(path, chunksize=DEFAULT_CHUNKSIZE, start=0, stop=None, shard=None, num_shards=1, shard_key="fips",
+                window=None):
+    """
+    Yield typed DataFrame chunks of the input, indexed by row id.
+
+    start / stop select a row range, shard / num_shards keep only the rows whose
+    shard_key ("fips" for StateCountyFIPS or "state" for FIPSState) hashes to shard.
+    window = (days_before, days_after) adds the search window columns.
+    """
+    skip = range(1, start + 1) if start else None
+    nrows = None if stop is None else max(0, stop - start)
+    position = start
+    reader = pd.read_csv(path, usecols=lambda col: col in INPUT_COLUMNS or col in SPAN_COLUMNS or col == COUNTY_NAMES_COLUMN,
+                         dtype="string", skiprows=skip, nrows=nrows,
+                         chunksize=chunksize, keep_default_na=False, na_values=[""])
+    with reader:
+        for chunk in reader:
+            chunk.index = pd.RangeIndex(position, position + len(chunk))
+            position += len(chunk)
+            chunk = typed_columns(chunk)
+            if shard is not None and num_shards > 1:
+                key = chunk["StateCountyFIPS"] if shard_key == "fips" else chunk["FIPSState"]
+                chunk = chunk[_stable_hash(key.fillna(0).astype("int64"), num_shards) == shard]
+            if window is not None:
+                chunk = add_search_window(chunk, *window)
+            if len(chunk):
+                yield chunk
+
+
+def _int_or_none(value):
+    return None if pd.isna(value) else int(value)
+
+
+def _date_or_none(value):
+    return None if pd.isna(value) else value.date()
+
+
+def rows_of(chunk):
+    """Turn one typed chunk into ArrestRow records"""
+    no_window = [None] * len(chunk)
+    window_start = chunk["window_start"] if "window_start" in chunk else no_window
+    window_end = chunk["window_end"] if "window_end" in chunk else no_window
+    county_names = chunk[COUNTY_NAMES_COLUMN] if COUNTY_NAMES_COLUMN in chunk else no_window
+    for row_id, date, county, st, fips, fips_state, fips_county, start, end, names in zip(
+            chunk.index, chunk["arrestdate"], chunk["CountyName"], chunk["ST"],
+            chunk["StateCountyFIPS"], chunk["FIPSState"], chunk["FIPSCounty"], window_start, window_end, county_names):
+        yield ArrestRow(int(row_id), _date_or_none(date), county, st,
+                        _int_or_none(fips), _int_or_none(fips_state), _int_or_none(fips_county),
+                        None if start is None else _date_or_none(start), None if end is None else _date_or_none(end),
+                        None if names is None or pd.isna(names) else names)
+
+
+def search_counties(row, max_counties=MAX_QUERY_COUNTIES):
+    """
+    The county part of a search query for an ArrestRow: its county, or for an operation
+    plan row the names of its member counties (most arrests first) joined with OR.
+    """
+    names = [name for name in (row.county_names or "").split(COUNTY_NAMES_SEP.strip()) if name.strip()]
+    names = list(dict.fromkeys(name.strip() for name in names))[:max_counties]
+    if len(names) < 2:
+        return row.county
+    return " OR ".join(names)
+
+
+def iter_rows(path, chunksize=DEFAULT_CHUNKSIZE, start=0, stop=None, shard=None, num_shards=1, shard_key="fips",
+              window=None):
+    """Yield the input as ArrestRow records, see iter_chunks for the sharding and window options"""
+    for chunk in iter_chunks(path, chunksize, start, stop, shard, num_shards, shard_key, window):
+        yield from rows_of(chunk)
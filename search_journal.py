@@ -0,0 +1,216 @@
+"""
+Append-only journal of completed search rows (a small write-ahead log).
+
+Every completed input row is appended as one record holding its search results,
+so a checkpoint only costs the size of the rows finished since the last one,
+and a crash can at worst lose a half written last record. Each line is
+
+    <crc32 of the json>\\t<json>\\n
+
+On open the journal is replayed: only the processed row ids and error counts are
+kept in memory, and a torn or corrupt tail is cut off. Results stay on disk and
+are streamed out with iter_results / export_csv / export_parquet.
+
+compact() rewrites the journal keeping one record per row and a single error
+record, and is run automatically, on open and at every checkpoint(), once enough
+records have been superseded, so a long run does not keep every redone row.
+"""
+import csv
+import json
+import os
+import zlib
+from collections import defaultdict
+
+import parquet_sink
+
+JOURNAL_FILE = 'search_journal.log'
+COMPACT_MIN_SUPERSEDED = 1000  # compact on open or checkpoint once this many records are superseded...
+COMPACT_RATIO = 0.25  # ...and they make up at least this share of the journal
+
+
+def _json_default(value):
+    # numpy / pandas scalars coming from DataFrame rows
+    if hasattr(value, 'item'):
+        return value.item()
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    return str(value)
+
+
+def _encode(record):
+    payload = json.dumps(record, default=_json_default, separators=(',', ':'))
+    return f"{zlib.crc32(payload.encode('utf-8')):08x}\t{payload}\n"
+
+
+def _decode(line):
+    """Return the record stored on line, or None if the line is torn or corrupt"""
+    if not line.endswith('\n'):
+        return None
+    crc, sep, payload = line[:-1].partition('\t')
+    if not sep:
+        return None
+    try:
+        if int(crc, 16) != zlib.crc32(payload.encode('utf-8')):
+            return None
+        return json.loads(payload)
+    except ValueError:
+        return None
+
+
+class SearchJournal:
+    """Append-only record of completed rows, their results and the errors seen along the way"""
+
+    def __init__(self, path=JOURNAL_FILE):
+        self.path = path
+        self.processed_rows = set()
+        self.error_counts = defaultdict(int)
+        self.records = 0
+        self._file = None
+        self._replay()
+        if self._needs_compaction():
+            self.compact()
+        self._file = open(self.path, 'a', encoding='utf-8')
+
+    def _needs_compaction(self):
+        superseded = self.records - len(self.processed_rows)
+        return superseded >= COMPACT_MIN_SUPERSEDED and superseded >= COMPACT_RATIO * self.records
+
+    def _replay(self):
+        if not os.path.exists(self.path):
+            return
+        good_offset = 0
+        with open(self.path, 'r', encoding='utf-8', newline='') as f:
+            while True:
+                line = f.readline()
+                if not line:
+                    break
+                record = _decode(line)
+                if record is None:
+                    print(f"Journal {self.path} is damaged after {self.records} records, dropping the rest")
+                    break
+                self._apply(record)
+                good_offset = f.tell()
+        if good_offset != os.path.getsize(self.path):
+            with open(self.path, 'r+b') as f:
+                f.truncate(good_offset)
+
+    def _apply(self, record):
+        self.records += 1
+        if 'row' in record:
+            self.processed_rows.add(record['row'])
+        for error, count in record.get('errors', {}).items():
+            self.error_counts[error] += count
+
+    def _append(self, record):
+        self._file.write(_encode(record))
+        self._file.flush()
+        self._apply(record)
+
+    def append_row(self, row_id, results):
+        """Record row_id as completed together with all of its results"""
+        self._append({'row': row_id, 'results': results})
+
+    def append_errors(self, errors):
+        """Record error counts that are not tied to a completed row"""
+        if errors:
+            self._append({'errors': dict(errors)})
+
+    def sync(self):
+        """Force everything appended so far to disk"""
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def checkpoint(self):
+        """sync(), then compact the journal if enough of its records have been superseded"""
+        self.sync()
+        if self._needs_compaction():
+            self.compact()
+
+    def _iter_records(self):
+        if self._file is not None:
+            self._file.flush()
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'r', encoding='utf-8', newline='') as f:
+            for line in f:
+                record = _decode(line)
+                if record is None:
+                    break
+                yield record
+
+    def iter_rows(self):
+        """Stream (row_id, results) of every completed row, the latest record of a row wins"""
+        last_record = {}
+        for i, record in enumerate(self._iter_records()):
+            if 'row' in record:
+                last_record[record['row']] = i
+        for i, record in enumerate(self._iter_records()):
+            if 'row' in record and last_record[record['row']] == i:
+                yield record['row'], record['results']
+
+    def iter_results(self):
+        """Stream every result of every completed row"""
+        for _, results in self.iter_rows():
+            yield from results
+
+    def compact(self):
+        """Rewrite the journal with one record per row and a single error record"""
+        tmp_path = self.path + '.compact'
+        last_record = {}
+        for i, record in enumerate(self._iter_records()):
+            if 'row' in record:
+                last_record[record['row']] = i
+        errors = defaultdict(int)
+        with open(tmp_path, 'w', encoding='utf-8') as out:
+            for i, record in enumerate(self._iter_records()):
+                for error, count in record.get('errors', {}).items():
+                    errors[error] += count
+                if 'row' in record and last_record[record['row']] == i:
+                    out.write(_encode({'row': record['row'], 'results': record['results']}))
+            if errors:
+                out.write(_encode({'errors': dict(errors)}))
+            out.flush()
+            os.fsync(out.fileno())
+        if self._file is not None:
+            self._file.close()
+        os.replace(tmp_path, self.path)
+        self.records = len(last_record) + (1 if errors else 0)
+        if self._file is not None:
+            self._file = open(self.path, 'a', encoding='utf-8')
+
+    def export_csv(self, path):
+        """Stream the results into a csv file, returns the number of rows written"""
+        written = 0
+        writer = None
+        with open(path, 'w', newline='', encoding='utf-8') as f:
+            for result in self.iter_results():
+                if writer is None:
+                    writer = csv.DictWriter(f, fieldnames=list(result.keys()), extrasaction='ignore')
+                    writer.writeheader()
+                writer.writerow(result)
+                written += 1
+        return written
+
+    def export_parquet(self, root_dir, column_types=None, partition_by=('ST', 'year'), year_from='arrest_date'):
+        """Stream the results into a partitioned parquet dataset, returns the number of rows written"""
+        sink = None
+        written = 0
+        for result in self.iter_results():
+            if sink is None:
+                sink = parquet_sink.ParquetSink(root_dir, list(result.keys()), column_types, partition_by, year_from)
+            sink.write(result)
+            written += 1
+        if sink is not None:
+            sink.close()
+        return written
+
+    def close(self):
+        if self._file is not None and not self._file.closed:
+            self.sync()
+            self._file.close()
+
+    def remove(self):
+        """Close and delete the journal once its results have been exported"""
+        self.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
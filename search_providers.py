@@ -0,0 +1,400 @@
+"""
+One interface over the search backends (SerpAPI, Bing, GNews), replacing the
+request code each scraper used to carry on its own.
+
+Every provider takes the query and the date window (dates, datetimes or the
+"%m/%d/%Y" strings main.calc_date writes) and returns a list of SearchResult:
+
+    title, link, date       as the backend shows them (date is e.g. "Jan 5, 2018" for SerpAPI)
+    published               the date parsed to "YYYY-MM-DD", None if it could not be read
+    snippet, provider
+
+Calls go through the shared rate limiter under the provider's name ("serpapi",
+"bing", "gnews"), so throttling and retries behave the same for every backend.
+Answers are kept in a sqlite SearchCache, so the same search is never paid
+for twice. Every call and cache hit is counted in a CostMeter.
+
+search() blocks, asearch() is the asyncio version. MultiProvider runs several
+providers concurrently and merges their results, one result per canonical url.
+FakeProvider returns made-up but repeatable results without any network, for
+benchmarking the pipeline offline:
+
+    main.search_provider = search_providers.FakeProvider(latency=0.5)
+"""
+import asyncio
+import hashlib
+import json
+import os
+import random
+import re
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+from datetime import date, datetime
+from email.utils import parsedate_to_datetime
+
+import requests
+
+import url_index
+from rate_limiter import RateLimited, limiter
+
+try:
+    from serpapi import GoogleSearch
+except ImportError:
+    GoogleSearch = None
+
+try:
+    from gnews import GNews
+except ImportError:
+    GNews = None
+
+SEARCH_CACHE_FILE = 'search_cache.sqlite3'
+DEFAULT_CACHE_TTL = 90 * 24 * 3600  # results for a past date window hardly change
+BING_ENDPOINT = "https://api.bing.microsoft.com/v7.0/search"
+
+# dollars per call at list price, pass cost_per_call to match your plan
+SERPAPI_COST = 0.015
+BING_COST = 0.007
+GNEWS_COST = 0.0
+SERPAPI_NO_RESULTS = "hasn't returned any results"  # the only SerpAPI error that is a real (empty) answer
+
+SearchResult = namedtuple("SearchResult", ["title", "link", "date", "published", "snippet", "provider"])
+
+
+# helper function to read a date param, as a date, a datetime or a "%m/%d/%Y" / "%Y-%m-%d" string
+def as_date(value):
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    for fmt in ("%m/%d/%Y", "%Y-%m-%d"):
+        try:
+            return datetime.strptime(value, fmt).date()
+        except ValueError:
+            pass
+    raise ValueError(f"unreadable date {value!r}")
+
+
+def parse_published(value):
+    """The publication date a backend shows ("Jan 5, 2018", ISO 8601, RFC 2822) as "YYYY-MM-DD", or None"""
+    value = (value or "").strip()
+    if not value:
+        return None
+    match = re.match(r"\d{4}-\d{2}-\d{2}", value)
+    if match:
+        return match.group(0)
+    for fmt in ("%b %d, %Y", "%B %d, %Y", "%m/%d/%Y"):
+        try:
+            return datetime.strptime(value, fmt).date().isoformat()
+        except ValueError:
+            pass
+    try:
+        return parsedate_to_datetime(value).date().isoformat()
+    except (TypeError, ValueError, IndexError):
+        return None
+
+
+class SearchCache:
+    """sqlite cache of normalized search results, can be shared by threads and processes"""
+
+    def __init__(self, path=SEARCH_CACHE_FILE, ttl=DEFAULT_CACHE_TTL):
+        self.path = os.path.abspath(path)  # resolved now, a sharded worker chdirs before the first search
+        self.ttl = ttl
+        self._local = threading.local()
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=60)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS searches (
+                    key TEXT PRIMARY KEY,
+                    provider TEXT NOT NULL,
+                    results TEXT NOT NULL,
+                    created_at REAL NOT NULL
+                )
+            """)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    @staticmethod
+    def make_key(provider, options, query, start, end):
+        raw = json.dumps([provider, options, query, start.isoformat(), end.isoformat()], sort_keys=True)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        """The cached results for key, None if there are none or they are older than the ttl"""
+        row = self._connection().execute("SELECT results, created_at FROM searches WHERE key = ?", (key,)).fetchone()
+        if row is None or (self.ttl is not None and time.time() - row[1] > self.ttl):
+            return None
+        return [SearchResult(*fields) for fields in json.loads(row[0])]
+
+    def put(self, key, provider, results):
+        conn = self._connection()
+        with conn:
+            conn.execute("INSERT OR REPLACE INTO searches (key, provider, results, created_at) VALUES (?, ?, ?, ?)",
+                         (key, provider, json.dumps([list(result) for result in results]), time.time()))
+
+
+class CostMeter:
+    """Thread-safe count of the calls, cache hits and dollars spent per provider"""
+
+    def __init__(self):
+        self.calls = {}
+        self.cached = {}
+        self.dollars = {}
+        self._lock = threading.Lock()
+
+    def add_call(self, provider, cost):
+        with self._lock:
+            self.calls[provider] = self.calls.get(provider, 0) + 1
+            self.dollars[provider] = self.dollars.get(provider, 0.0) + cost
+
+    def add_cached(self, provider):
+        with self._lock:
+            self.cached[provider] = self.cached.get(provider, 0) + 1
+
+    def total(self):
+        with self._lock:
+            return sum(self.dollars.values())
+
+    def summary(self):
+        with self._lock:
+            providers = sorted(set(self.calls) | set(self.cached))
+            parts = [f"{provider}: {self.calls.get(provider, 0)} calls (${self.dollars.get(provider, 0.0):.2f}), "
+                     f"{self.cached.get(provider, 0)} from cache" for provider in providers]
+            return "; ".join(parts) or "no searches"
+
+
+# shared by every provider unless one is given its own
+costs = CostMeter()
+
+
+class SearchError(Exception):
+    """The search api answered with an error (bad key, quota used up, ...), never cached"""
+
+
+class SearchProvider:
+    """
+    Base class of the backends. A backend sets name and cost_per_call and implements
+    _request (one raw api call, raising RateLimited when throttled) and _results
+    (the raw answer as a list of SearchResult). options are the backend settings
+    that change the answer, they are part of the cache key.
+    """
+    name = None
+    cost_per_call = 0.0
+
+    def __init__(self, cache=None, meter=None, cost_per_call=None):
+        self.cache = cache
+        self.meter = meter if meter is not None else costs
+        if cost_per_call is not None:
+            self.cost_per_call = cost_per_call
+        self.options = {}
+
+    def _request(self, query, start, end):
+        raise NotImplementedError
+
+    def _results(self, response):
+        raise NotImplementedError
+
+    def _cached(self, query, start, end):
+        if self.cache is None:
+            return None, None
+        key = SearchCache.make_key(self.name, self.options, query, start, end)
+        results = self.cache.get(key)
+        if results is not None:
+            self.meter.add_cached(self.name)
+        return key, results
+
+    def _store(self, key, response):
+        self.meter.add_call(self.name, self.cost_per_call)
+        results = self._results(response)
+        if key is not None:
+            self.cache.put(key, self.name, results)
+        return results
+
+    def search(self, query, start, end):
+        """Run one search, blocking, and return its list of SearchResult"""
+        start, end = as_date(start), as_date(end)
+        key, results = self._cached(query, start, end)
+        if results is not None:
+            return results
+        return self._store(key, limiter.call(self.name, self._request, query, start, end))
+
+    async def asearch(self, query, start, end):
+        """Async version of search, the blocking api call runs in a worker thread"""
+        start, end = as_date(start), as_date(end)
+        key, results = await asyncio.to_thread(self._cached, query, start, end)
+        if results is not None:
+            return results
+        response = await limiter.acall(self.name, asyncio.to_thread, self._request, query, start, end)
+        return await asyncio.to_thread(self._store, key, response)
+
+
+class SerpApiProvider(SearchProvider):
+    """Google search through SerpAPI, newest results first"""
+    name = "serpapi"
+    cost_per_call = SERPAPI_COST
+
+    def __init__(self, api_key, num=10, cache=None, meter=None, cost_per_call=None):
+        super().__init__(cache, meter, cost_per_call)
+        if GoogleSearch is None:
+            raise ImportError("the serpapi provider needs the google-search-results package")
+        self.api_key = api_key
+        self.options = {"num": num}
+
+    def _request(self, query, start, end):
+        params = {
+            "engine": "google",
+            "q": query,
+            "api_key": self.api_key,
+            "google_domain": "google.com",
+            "gl": "us",
+            "hl": "en",
+            "tbs": f"cdr:1,cd_min:{start.strftime('%m/%d/%Y')},cd_max:{end.strftime('%m/%d/%Y')}",
+            "num": self.options["num"],
+            "sort": "date"
+        }
+        results = GoogleSearch(params).get_dict()
+        error = results.get("error", "")
+        if "rate limit" in error.lower() or "too many requests" in error.lower():
+            raise RateLimited(message=error)
+        if error and SERPAPI_NO_RESULTS not in error:
+            raise SearchError(f"serpapi: {error}")  # out of searches, invalid key, ... must not be cached as no results
+        return results
+
+    def _results(self, response):
+        return [SearchResult(item.get("title", "N/A"), item.get("link", "N/A"), item.get("date", "N/A"),
+                             parse_published(item.get("date")), item.get("snippet", ""), self.name)
+                for item in response.get("organic_results", [])]
+
+
+class BingProvider(SearchProvider):
+    """Bing Web Search, web pages only"""
+    name = "bing"
+    cost_per_call = BING_COST
+
+    def __init__(self, subscription_key, endpoint=BING_ENDPOINT, count=20, cache=None, meter=None,
+                 cost_per_call=None):
+        super().__init__(cache, meter, cost_per_call)
+        self.subscription_key = subscription_key
+        self.endpoint = endpoint
+        self.options = {"count": count}
+
+    def _request(self, query, start, end):
+        headers = {'Ocp-Apim-Subscription-Key': self.subscription_key}
+        params = {
+            'q': query,
+            'count': self.options["count"],
+            'freshness': f'{start.isoformat()}..{end.isoformat()}',
+            'responseFilter': 'Webpages'
+        }
+        response = requests.get(self.endpoint, headers=headers, params=params)
+        if response.status_code == 429:  # Rate limit exceeded
+            raise RateLimited(response.headers.get('Retry-After'))
+        response.raise_for_status()
+        return response.json()
+
+    def _results(self, response):
+        pages = (response or {}).get("webPages", {}).get("value", [])
+        return [SearchResult(item.get("name", ""), item.get("url", ""), item.get("dateLastCrawled", ""),
+                             parse_published(item.get("dateLastCrawled")), item.get("snippet", ""), self.name)
+                for item in pages]
+
+
+class GNewsProvider(SearchProvider):
+    """Google News through the gnews package (the GNews Approach notebook)"""
+    name = "gnews"
+    cost_per_call = GNEWS_COST
+
+    def __init__(self, language="en", country="US", max_results=100, cache=None, meter=None, cost_per_call=None):
+        super().__init__(cache, meter, cost_per_call)
+        if GNews is None:
+            raise ImportError("the gnews provider needs the gnews package")
+        self.options = {"language": language, "country": country, "max_results": max_results}
+
+    def _request(self, query, start, end):
+        google_news = GNews(**self.options)  # one per call, the date window is set on the instance
+        google_news.start_date = (start.year, start.month, start.day)
+        google_news.end_date = (end.year, end.month, end.day)
+        return google_news.get_news(query)
+
+    def _results(self, response):
+        return [SearchResult(item.get("title", ""), item.get("url", ""), item.get("published date", ""),
+                             parse_published(item.get("published date")), item.get("description", ""), self.name)
+                for item in response or []]
+
+
+class FakeProvider(SearchProvider):
+    """Made-up results that only depend on the search, with an optional delay per call; nothing leaves the machine"""
+    name = "fake"
+
+    def __init__(self, results_per_search=10, latency=0.0, cache=None, meter=None, cost_per_call=None):
+        super().__init__(cache, meter, cost_per_call)
+        if self.name not in limiter.buckets:
+            limiter.configure(self.name, 1000)  # nothing to protect, don't let the limiter's default slow it down
+        self.latency = latency
+        self.options = {"results_per_search": results_per_search}
+
+    def _request(self, query, start, end):
+        if self.latency:
+            time.sleep(self.latency)
+        seed = hashlib.sha256(f"{query}|{start}|{end}".encode("utf-8")).hexdigest()
+        rng = random.Random(seed)
+        span = max((end - start).days, 0)
+        return [(f"{query} ({i + 1})", f"https://news.example/{seed[:12]}/{i + 1}",
+                 date.fromordinal(start.toordinal() + rng.randint(0, span))) for i in range(self.options["results_per_search"])]
+
+    def _results(self, response):
+        return [SearchResult(title, link, published.strftime("%b %d, %Y"), published.isoformat(), "", self.name)
+                for title, link, published in response]
+
+
+class MultiProvider:
+    """Several providers queried concurrently, their results merged in provider order, one per canonical url"""
+
+    def __init__(self, providers):
+        self.providers = list(providers)
+        self.name = "+".join(provider.name for provider in self.providers)
+
+    async def asearch(self, query, start, end):
+        answers = await asyncio.gather(*(provider.asearch(query, start, end) for provider in self.providers),
+                                       return_exceptions=True)
+        merged, seen = [], set()
+        for provider, answer in zip(self.providers, answers):
+            if isinstance(answer, Exception):
+                print(f"Error in {provider.name} search {query!r}: {answer}")
+                continue
+            for result in answer:
+                canonical = url_index.canonical_url(result.link)
+                if canonical not in seen:
+                    seen.add(canonical)
+                    merged.append(result)
+        return merged
+
+    def search(self, query, start, end):
+        """Blocking version, runs the providers on an event loop of its own (call it from threads, not from a loop)"""
+        return asyncio.run(self.asearch(query, start, end))
+
+
+def make_provider(names, cache=None, serpapi_key=None, bing_key=None, bing_endpoint=BING_ENDPOINT):
+    """A provider for one name ("serpapi", "bing", "gnews", "fake"), or a MultiProvider for a list of them"""
+    if isinstance(names, str):
+        names = [names]
+    providers = []
+    for name in names:
+        if name == "serpapi":
+            providers.append(SerpApiProvider(serpapi_key, cache=cache))
+        elif name == "bing":
+            providers.append(BingProvider(bing_key, bing_endpoint, cache=cache))
+        elif name == "gnews":
+            providers.append(GNewsProvider(cache=cache))
+        elif name == "fake":
+            providers.append(FakeProvider(cache=cache))
+        else:
+            raise ValueError(f"unknown search provider {name!r}")
+    return providers[0] if len(providers) == 1 else MultiProvider(providers)
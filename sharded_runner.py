@@ -0,0 +1,234 @@
+"""
+Multi-process runner for the search-and-validate workflow.
+
+The input is split into num_shards shards by a stable hash of the county
+(StateCountyFIPS) or state (FIPSState) code, see row_source.iter_chunks. Each
+shard runs in its own process with its own output directory and checkpoint
+journal, so shards can also be run on different machines and copied back.
+Afterwards merge_shards combines the shard outputs into the same
+valid / invalid / manual check files a single-process run writes: rows come
+out in input order and duplicates (e.g. rows redone after a crash) are dropped.
+A link sent to manual check by several shards is kept once, at its first input
+row, as a single-process run lists it.
+
+The Bing search scraper can be sharded the same way with run_bing_sharded; its
+shards are merged from their journals into one final_search_results.csv,
+deduplicated on (url, StateCountyFIPS, arrest_date).
+
+Usage:
+    python sharded_runner.py INPUT_CSV OUTPUT_DIR --shards 8
+    python sharded_runner.py INPUT_CSV OUTPUT_DIR --shards 8 --only-shard 3    # run one shard here
+    python sharded_runner.py INPUT_CSV OUTPUT_DIR --shards 8 --merge-only
+    python sharded_runner.py INPUT_CSV OUTPUT_DIR --shards 8 --bing            # Bing scraper instead
+"""
+import argparse
+import csv
+import glob
+import multiprocessing
+import os
+
+import pandas as pd
+
+import bing_search_arrest_dataset
+import main
+import pipeline
+from result_sink import ResultSinks
+from search_journal import SearchJournal
+
+ROW_ID_FIELD = "_row_id"  # extra column in the shard files, dropped by the merge
+OUTPUT_FILES = {
+    "valid": ("valid_results.csv", main.VALID_FIELDS),
+    "invalid": ("invalid_results.csv", main.INVALID_FIELDS),
+    "manual": ("manual_check_results.csv", main.MANUAL_FIELDS),
+}
+# a result is the same result if these columns match
+DEDUP_KEYS = {
+    "valid": ["Article_Link", "StateCountyFIPS", "Arrest_Date"],
+    "invalid": ["Link", "County", "State", ROW_ID_FIELD],
+    "manual": ["Link"],  # a single run sends a link to manual check once, whatever rows it turns up for
+}
+
+
+def shard_dir(output_dir, shard):
+    return os.path.join(output_dir, f"shard-{shard:03d}")
+
+
+class ShardSinks(ResultSinks):
+    """
+    Output files of one shard: every row is tagged with its input row id and
+    completed rows are journaled, but only after the outputs have been fsynced,
+    so a resumed shard may redo a row (the merge drops the duplicates) but never loses one.
+    Manual check rows are not lost either: run_shard starts a new verdict cache run, so the
+    links marked by an interrupted attempt, whose rows may never have been flushed, are written again.
+    """
+
+    def __init__(self, sinks, journal):
+        super().__init__(sinks.sinks)
+        self.journal = journal
+        self._done = []
+
+    def write(self, bucket, row, row_id=None):
+        super().write(bucket, dict(row, **{ROW_ID_FIELD: row_id}))
+
+    def row_done(self, row_id):
+        self._done.append(row_id)
+
+    def checkpoint(self):
+        super().checkpoint()
+        for row_id in self._done:
+            self.journal.append_row(row_id, [])
+        self._done = []
+        self.journal.checkpoint()
+
+    def close(self):
+        self.checkpoint()
+        super().close()
+        self.journal.close()
+
+
+def run_shard(input_csv, output_dir, shard, num_shards, shard_key="fips", pipelined=True, pipeline_options=None):
+    """Run one shard of the input, resuming from its journal if it was interrupted"""
+    directory = shard_dir(output_dir, shard)
+    os.makedirs(directory, exist_ok=True)
+    journal = SearchJournal(os.path.join(directory, "rows.journal"))
+    if journal.processed_rows:
+        print(f"Shard {shard}: resuming, {len(journal.processed_rows)} rows already processed")
+    main.verdicts.start_run()  # manual check links of an interrupted attempt are written again
+
+    rows = (row for row in main.parse_csv(input_csv, shard=shard, num_shards=num_shards, shard_key=shard_key)
+            if row.row_id not in journal.processed_rows)
+    sinks = ShardSinks(main.open_output_sinks(directory, extra_fields=[ROW_ID_FIELD]), journal)
+    if pipelined:
+        pipeline.search_and_export_pipelined(rows, sinks=sinks, **(pipeline_options or {}))
+    else:
+        main.search_and_export(rows, sinks=sinks)
+    main.urls.save()
+    return shard
+
+
+def _run_shard_task(args):
+    return run_shard(*args)
+
+
+def merge_shards(output_dir):
+    """Combine every shard's files into output_dir, in input order and without duplicates"""
+    merged = {}
+    for bucket, (filename, fieldnames) in OUTPUT_FILES.items():
+        frames = []
+        for path in sorted(glob.glob(os.path.join(output_dir, "shard-*", filename))):
+            frame = pd.read_csv(path, dtype=str, keep_default_na=False)
+            frame["_order"] = range(len(frame))  # keeps the order of rows that came from the same input row
+            frames.append(frame)
+        out_path = os.path.join(output_dir, filename)
+        if not frames:
+            continue
+        results = pd.concat(frames, ignore_index=True)
+        results[ROW_ID_FIELD] = pd.to_numeric(results[ROW_ID_FIELD], errors="coerce")
+        results = results.sort_values([ROW_ID_FIELD, "_order"], kind="stable")
+        results = results.drop_duplicates(subset=DEDUP_KEYS[bucket], keep="first")
+        results.to_csv(out_path, columns=fieldnames, index=False, quoting=csv.QUOTE_MINIMAL)
+        merged[bucket] = (out_path, len(results))
+    return merged
+
+
+def run_sharded(input_csv, output_dir, num_shards, shard_key="fips", processes=None, pipelined=True,
+                pipeline_options=None):
+    """Run every shard in its own process and merge the results"""
+    os.makedirs(output_dir, exist_ok=True)
+    tasks = [(input_csv, output_dir, shard, num_shards, shard_key, pipelined, pipeline_options)
+             for shard in range(num_shards)]
+    # spawn, so no shard inherits sqlite connections or event loop threads from the parent
+    with multiprocessing.get_context("spawn").Pool(processes or num_shards) as pool:
+        for shard in pool.imap_unordered(_run_shard_task, tasks):
+            print(f"Shard {shard} finished")
+    return merge_shards(output_dir)
+
+
+# --- Bing search scraper ---------------------------------------------------------
+
+BING_DEDUP_KEYS = ["url", "StateCountyFIPS", "arrest_date"]
+
+
+def run_bing_shard(input_csv, output_dir, shard, num_shards, subscription_key, endpoint, shard_key="fips"):
+    """Run one shard of the Bing scraper inside its own directory (its checkpoint and log files are relative)"""
+    input_csv = os.path.abspath(input_csv)
+    directory = shard_dir(output_dir, shard)
+    os.makedirs(directory, exist_ok=True)
+    os.chdir(directory)  # only affects this worker process
+    journal = bing_search_arrest_dataset.process_csv_and_search(
+        input_csv, subscription_key, endpoint, shard=shard, num_shards=num_shards, shard_key=shard_key)
+    journal.close()
+    return shard
+
+
+def _run_bing_shard_task(args):
+    return run_bing_shard(*args)
+
+
+def merge_bing_shards(output_dir, filename="final_search_results.csv"):
+    """Merge the journals of every Bing shard into one csv, in input order and without duplicates"""
+    frames = []
+    for path in sorted(glob.glob(os.path.join(output_dir, "shard-*", bing_search_arrest_dataset.JOURNAL_FILE))):
+        journal = SearchJournal(path)
+        rows = [dict(result, **{ROW_ID_FIELD: row_id}) for row_id, results in journal.iter_rows() for result in results]
+        journal.close()
+        if rows:
+            frames.append(pd.DataFrame(rows))
+    out_path = os.path.join(output_dir, filename)
+    if not frames:
+        return out_path, 0
+    results = pd.concat(frames, ignore_index=True)
+    results["_order"] = range(len(results))
+    results = results.sort_values([ROW_ID_FIELD, "_order"], kind="stable")
+    results = results.drop_duplicates(subset=BING_DEDUP_KEYS, keep="first")
+    results.drop(columns=[ROW_ID_FIELD, "_order"]).to_csv(out_path, index=False)
+    return out_path, len(results)
+
+
+def run_bing_sharded(input_csv, output_dir, num_shards, subscription_key, endpoint, shard_key="fips", processes=None):
+    """Run the Bing scraper with every shard in its own process and merge the results"""
+    os.makedirs(output_dir, exist_ok=True)
+    output_dir = os.path.abspath(output_dir)
+    tasks = [(input_csv, output_dir, shard, num_shards, subscription_key, endpoint, shard_key)
+             for shard in range(num_shards)]
+    with multiprocessing.get_context("spawn").Pool(processes or num_shards) as pool:
+        for shard in pool.imap_unordered(_run_bing_shard_task, tasks):
+            print(f"Shard {shard} finished")
+    return merge_bing_shards(output_dir)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the search-and-validate workflow in several processes")
+    parser.add_argument("input_csv")
+    parser.add_argument("output_dir")
+    parser.add_argument("--shards", type=int, default=multiprocessing.cpu_count())
+    parser.add_argument("--shard-key", choices=["fips", "state"], default="fips")
+    parser.add_argument("--only-shard", type=int, help="run just this shard in this process, without merging")
+    parser.add_argument("--merge-only", action="store_true", help="only merge shard outputs that already exist")
+    parser.add_argument("--serial", action="store_true", help="process each shard row by row instead of pipelined")
+    parser.add_argument("--bing", action="store_true", help="shard the Bing search scraper instead")
+    args = parser.parse_args()
+
+    if args.bing:
+        if args.merge_only:
+            result = merge_bing_shards(args.output_dir)
+        else:
+            with open('./api_keys/azure_api_key.txt', 'r') as f:
+                subscription_key = f.read().strip()
+            assert subscription_key
+            endpoint = "https://api.bing.microsoft.com/v7.0/search"
+            if args.only_shard is not None:
+                result = run_bing_shard(args.input_csv, args.output_dir, args.only_shard, args.shards,
+                                        subscription_key, endpoint, args.shard_key)
+            else:
+                result = run_bing_sharded(args.input_csv, args.output_dir, args.shards, subscription_key, endpoint,
+                                          args.shard_key)
+    elif args.merge_only:
+        result = merge_shards(args.output_dir)
+    elif args.only_shard is not None:
+        result = run_shard(args.input_csv, args.output_dir, args.only_shard, args.shards, args.shard_key,
+                           not args.serial)
+    else:
+        result = run_sharded(args.input_csv, args.output_dir, args.shards, args.shard_key,
+                             pipelined=not args.serial)
+    print(result)
@@ -0,0 +1,148 @@
+"""
+Token-budgeted passage selection, replacing the blind text[:N] cut of shorten_text.
+
+The article is split into passages (its lines, long lines into runs of
+sentences). Every passage is scored for what the validation questions ask
+about: the county and state, immigration enforcement terms and dates inside
+the search window. If the article does not fit the model's token budget, the
+best passages are kept, in their original order, until the budget is used up.
+Short passages that say nothing relevant (share buttons, "Advertisement", ...)
+are dropped either way.
+
+Tokens are counted with tiktoken when it is installed and estimated at four
+characters per token otherwise. TokenMeter adds up the tokens before and after
+selection for cost accounting.
+"""
+import re
+import threading
+from collections import namedtuple
+
+import prefilter
+from us_states import list_states
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# tokens of article text sent per check, about what the old 12288 / 88888 character cuts allowed
+TOKEN_BUDGETS = {"gpt-3.5-turbo": 3000, "gpt-4-turbo": 22000, "gpt-4o": 22000, "gpt-4o-mini": 22000}
+DEFAULT_TOKEN_BUDGET = 3000
+PASSAGE_TOKENS = 150  # long lines are cut into passages of about this size
+MIN_PASSAGE_CHARS = 40  # shorter passages are only kept when they score
+
+Passages = namedtuple("Passages", ["text", "tokens", "original_tokens"])
+
+_SENTENCE_END = re.compile(r"(?<=[.!?])\s+")
+_COUNT_RE = re.compile(r"\b\d[\d,]*\s+(?:people|persons|individuals|immigrants|men|women|workers|arrests?|detain|personas)")
+_encodings = {}
+
+
+def count_tokens(text, model=None):
+    """Number of tokens text takes for model, estimated if tiktoken is not installed"""
+    if tiktoken is None:
+        return (len(text) + 3) // 4
+    if model not in _encodings:
+        try:
+            _encodings[model] = tiktoken.encoding_for_model(model)
+        except (KeyError, ValueError):
+            _encodings[model] = tiktoken.get_encoding("cl100k_base")
+    return len(_encodings[model].encode(text, disallowed_special=()))
+
+
+def token_budget(model):
+    return TOKEN_BUDGETS.get(model, DEFAULT_TOKEN_BUDGET)
+
+
+def split_passages(text, passage_tokens=PASSAGE_TOKENS):
+    """Split text into passages: every line, long lines cut at sentence ends"""
+    max_chars = passage_tokens * 4
+    passages = []
+    for line in text.split("\n"):
+        line = line.strip()
+        if len(line) <= max_chars:
+            if line:
+                passages.append(line)
+            continue
+        current = ""
+        for sentence in _SENTENCE_END.split(line):
+            if current and len(current) + len(sentence) > max_chars:
+                passages.append(current)
+                current = ""
+            while len(sentence) > max_chars:  # a single endless sentence, cut it
+                passages.append(sentence[:max_chars])
+                sentence = sentence[max_chars:]
+            current = f"{current} {sentence}".strip()
+        if current:
+            passages.append(current)
+    return passages
+
+
+def score_passage(passage, county=None, state=None, start=None, end=None):
+    """Relevance of one lowercased passage to the search of county, state between start and end"""
+    score = 0.0
+    if county and county.lower() in passage:
+        score += 3
+    # the full name only: the passage is lowercased, so abbreviations such as "in", "or" or "me" would match plain words
+    if state and list_states.get(state, state).lower() in passage:
+        score += 1
+    score += 2 * min(len(prefilter.ENFORCEMENT_RE.findall(passage)), 3)
+    score += min(len(prefilter.IMMIGRATION_RE.findall(passage)), 3)
+    if _COUNT_RE.search(passage):
+        score += 1
+    if start is not None and end is not None:
+        start, end = prefilter.window_date(start), prefilter.window_date(end)
+        if any(start <= day <= end for day in prefilter.mentioned_dates(passage, start, end)):
+            score += 3
+    return score
+
+
+def select_passages(text, county=None, state=None, start=None, end=None, budget=DEFAULT_TOKEN_BUDGET, model=None,
+                    keep_first=2):
+    """
+    Pick the passages of text most relevant to the search that fit in budget tokens.
+    The first keep_first passages (headline and publication date) are always kept if they fit.
+    Returns Passages(text, tokens, original_tokens).
+    """
+    passages = split_passages(text)
+    original_tokens = count_tokens(text, model)
+    scored = []
+    for position, passage in enumerate(passages):
+        score = score_passage(passage, county, state, start, end)
+        if position < keep_first:
+            score += 100
+        elif score == 0 and len(passage) < MIN_PASSAGE_CHARS:
+            continue
+        scored.append((score, position, passage, count_tokens(passage, model) + 1))  # +1 for the newline
+
+    if sum(tokens for _, _, _, tokens in scored) > budget:
+        chosen, used = [], 0
+        for score, position, passage, tokens in sorted(scored, key=lambda item: (-item[0], item[1])):
+            if used + tokens <= budget:
+                chosen.append((score, position, passage, tokens))
+                used += tokens
+        scored = sorted(chosen, key=lambda item: item[1])
+    selected = "\n".join(passage for _, _, passage, _ in scored)
+    return Passages(selected, count_tokens(selected, model), original_tokens)
+
+
+class TokenMeter:
+    """Thread-safe totals of the article tokens scraped and the tokens actually sent"""
+
+    def __init__(self):
+        self.articles = 0
+        self.original_tokens = 0
+        self.tokens = 0
+        self._lock = threading.Lock()
+
+    def add(self, passages):
+        with self._lock:
+            self.articles += 1
+            self.original_tokens += passages.original_tokens
+            self.tokens += passages.tokens
+
+    def summary(self):
+        with self._lock:
+            saved = 1 - self.tokens / self.original_tokens if self.original_tokens else 0.0
+            return (f"{self.articles} articles, {self.tokens} of {self.original_tokens} article tokens sent "
+                    f"({saved:.0%} saved)")
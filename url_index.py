@@ -0,0 +1,236 @@
+"""
+URL canonicalization and a persistent index of every article URL the scrapers have seen.
+
+Search engines hand back the same article under many URLs: with tracking
+parameters (utm_*, fbclid, ...), as an AMP page or through the Google AMP
+cache, on a mobile host, over http and https. canonical_url() reduces all of
+them to one identity: https, lowercased host without www / m / amp, AMP paths
+and suffixes removed, tracking parameters dropped, the remaining parameters
+sorted and the fragment cut off.
+
+UrlIndex maps every canonical URL to the first URL it was seen under, less
+its tracking parameters (its representative, which still loads the page). The scrapers swap every link for its representative before
+anything is fetched or validated, so the article store, the verdict cache and
+the manual check list all see one URL per article, in this run and the next.
+
+The index lives in sqlite like the verdict cache. In front of it sits a Bloom
+filter kept in memory and saved next to the database, so a URL that has never
+been seen (most of them) costs no read. The filter only ever saves lookups:
+a URL it misses (added by another process) still ends up at its stored entry.
+"""
+import hashlib
+import math
+import os
+import re
+import sqlite3
+import threading
+import time
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+URL_INDEX_FILE = 'url_index.sqlite3'
+DEFAULT_CAPACITY = 5_000_000  # urls the Bloom filter is sized for, it degrades gracefully beyond that
+DEFAULT_ERROR_RATE = 0.001
+SAVE_EVERY = 10000  # adds between two saves of the Bloom filter
+
+# query parameters that only track where a click came from
+TRACKING_PARAMS = {
+    "fbclid", "gclid", "dclid", "gclsrc", "msclkid", "yclid", "igshid", "mc_cid", "mc_eid", "_ga", "_gl",
+    "ref", "ref_src", "ref_url", "referrer", "cmpid", "cmp", "ocid", "taid", "smid", "smtyp", "sr_share",
+    "ito", "itm_source", "itm_medium", "itm_campaign", "fromrss", "amp", "outputtype", "__twitter_impression",
+    "s_cid", "ns_source", "ns_mchannel", "ns_campaign",
+}
+TRACKING_PREFIXES = ("utm_", "at_", "pk_", "mtm_", "hsa_")
+HOST_PREFIXES = ("www.", "www2.", "m.", "mobile.", "amp.")
+AMP_CACHE_RE = re.compile(r"^/(?:[cv]/)?(?:s/)?(?P<rest>[^/]+\..+)$")  # /c/s/example.com/story on *.cdn.ampproject.org
+GOOGLE_AMP_RE = re.compile(r"^/amp/(?:s/)?(?P<rest>[^/]+\..+)$")  # /amp/s/example.com/story on google.com
+
+
+def _unwrap_amp_cache(host, path):
+    # the AMP caches carry the real host as the first path segment
+    if host.endswith(".cdn.ampproject.org"):
+        match = AMP_CACHE_RE.match(path)
+    elif re.match(r"^(?:www\.)?google\.[a-z.]+$", host):
+        match = GOOGLE_AMP_RE.match(path)
+    else:
+        return None
+    return match.group("rest") if match else None
+
+
+def _is_tracking(key):
+    key = key.lower()
+    return key in TRACKING_PARAMS or key.startswith(TRACKING_PREFIXES)
+
+
+def clean_url(url):
+    """url without its tracking parameters and fragment, the rest left as it is so it still loads the same page"""
+    parts = urlsplit((url or "").strip())
+    if parts.scheme.lower() not in ("http", "https"):
+        return url
+    query = [(key, value) for key, value in parse_qsl(parts.query, keep_blank_values=True) if not _is_tracking(key)]
+    return urlunsplit((parts.scheme, parts.netloc, parts.path, urlencode(query), ""))
+
+
+def canonical_url(url):
+    """The canonical form of url, every variant of one article maps to the same string"""
+    url = (url or "").strip()
+    if not url or url == "N/A":
+        return url
+    if "://" not in url:
+        url = "http://" + url.lstrip("/")
+    parts = urlsplit(url)
+    if parts.scheme.lower() not in ("http", "https"):
+        return url
+
+    host = (parts.hostname or "").rstrip(".")
+    path = parts.path
+    unwrapped = _unwrap_amp_cache(host, path)
+    if unwrapped is not None:
+        return canonical_url("https://" + unwrapped + (f"?{parts.query}" if parts.query else ""))
+    for prefix in HOST_PREFIXES:
+        if host.startswith(prefix) and host.count(".") > 1:
+            host = host[len(prefix):]
+            break
+    if parts.port and parts.port not in (80, 443):
+        host = f"{host}:{parts.port}"
+
+    path = re.sub(r"/{2,}", "/", path)
+    path = re.sub(r"^/amp(?=/)", "", path)  # /amp/2018/01/story
+    path = re.sub(r"/amp/?$", "/", path)  # /2018/01/story/amp/
+    path = re.sub(r"\.amp(?=\.html?$)|\.amp$", "", path)  # story.amp.html / story.amp
+    if len(path) > 1:
+        path = path.rstrip("/")
+
+    query = [(key, value) for key, value in parse_qsl(parts.query, keep_blank_values=True) if not _is_tracking(key)]
+    return urlunsplit(("https", host, path or "/", urlencode(sorted(query)), ""))
+
+
+class BloomFilter:
+    """Fixed size Bloom filter over strings, bits in a bytearray"""
+
+    def __init__(self, capacity=DEFAULT_CAPACITY, error_rate=DEFAULT_ERROR_RATE, bits=None):
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bits if bits is not None and len(bits) == (self.size + 7) // 8 else bytearray((self.size + 7) // 8)
+
+    def _positions(self, value):
+        # double hashing, k positions out of two 64 bit halves of one digest
+        digest = hashlib.blake2b(value.encode("utf-8"), digest_size=16).digest()
+        first, second = int.from_bytes(digest[:8], "little"), int.from_bytes(digest[8:], "little") | 1
+        return [(first + i * second) % self.size for i in range(self.hashes)]
+
+    def add(self, value):
+        for position in self._positions(value):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, value):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(value))
+
+    def save(self, path):
+        temporary = f"{path}.{os.getpid()}.tmp"
+        with open(temporary, "wb") as f:
+            f.write(self.bits)
+        os.replace(temporary, path)
+
+    @classmethod
+    def load(cls, path, capacity=DEFAULT_CAPACITY, error_rate=DEFAULT_ERROR_RATE):
+        """The filter saved at path, None if there is none or it was sized differently"""
+        if not os.path.exists(path):
+            return None
+        with open(path, "rb") as f:
+            bloom = cls(capacity, error_rate, bytearray(f.read()))
+        return bloom if any(bloom.bits) else None
+
+
+class UrlIndex:
+    """sqlite backed canonical url index with a Bloom filter front, can be shared by threads and processes"""
+
+    def __init__(self, path=URL_INDEX_FILE, capacity=DEFAULT_CAPACITY, error_rate=DEFAULT_ERROR_RATE):
+        self.path = os.path.abspath(path)  # resolved now, the database is only opened on first use
+        self.bloom_path = os.path.splitext(self.path)[0] + ".bloom"
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._adds = 0
+        self.variants_merged = 0  # links swapped for an earlier variant of the same article
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self._bloom = None
+        self._bloom_lock = threading.Lock()
+
+    @property
+    def bloom(self):
+        # loaded (or rebuilt from the database) on first use, so no file is touched before the index is needed
+        with self._bloom_lock:
+            if self._bloom is None:
+                bloom = BloomFilter.load(self.bloom_path, self.capacity, self.error_rate)
+                if bloom is None:
+                    bloom = BloomFilter(self.capacity, self.error_rate)
+                    for (canonical,) in self._connection().execute("SELECT canonical FROM urls"):
+                        bloom.add(canonical)
+                self._bloom = bloom
+            return self._bloom
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=60)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS urls (
+                    canonical TEXT PRIMARY KEY,
+                    url TEXT NOT NULL,
+                    first_seen REAL NOT NULL
+                )
+            """)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _lookup(self, canonical):
+        row = self._connection().execute("SELECT url FROM urls WHERE canonical = ?", (canonical,)).fetchone()
+        return row[0] if row is not None else None
+
+    def __contains__(self, url):
+        canonical = canonical_url(url)
+        with self._lock:
+            if canonical not in self.bloom:
+                return False
+        return self._lookup(canonical) is not None
+
+    def _merged(self, url, representative):
+        if representative != url:
+            with self._lock:
+                self.variants_merged += 1
+        return representative
+
+    def add(self, url):
+        """Record url and return the representative url of its article (url cleaned the first time it is seen)"""
+        canonical = canonical_url(url)
+        if not canonical or canonical == "N/A":
+            return url
+        url = clean_url(url)
+        with self._lock:
+            maybe_seen = canonical in self.bloom
+        if maybe_seen:
+            representative = self._lookup(canonical)
+            if representative is not None:
+                return self._merged(url, representative)
+
+        conn = self._connection()
+        with conn:
+            inserted = conn.execute("INSERT OR IGNORE INTO urls (canonical, url, first_seen) VALUES (?, ?, ?)",
+                                    (canonical, url, time.time())).rowcount
+        with self._lock:
+            self.bloom.add(canonical)
+            self._adds += 1
+            if self._adds % SAVE_EVERY == 0:
+                self.bloom.save(self.bloom_path)
+        if inserted:
+            return url
+        return self._merged(url, self._lookup(canonical))  # another process got there first
+
+    def save(self):
+        """Write the Bloom filter next to the database, so the next run starts with it"""
+        with self._lock:
+            if self._bloom is not None:  # never used in this process, nothing new to save
+                self._bloom.save(self.bloom_path)
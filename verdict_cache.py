@@ -0,0 +1,170 @@
+"""
+Persistent cache of LLM verdicts, replacing the in-process link_attributes dicts.
+
+A verdict is keyed by everything that can change the model's answer: the article
+url, a hash of the exact text sent, the location, the search date window, the
+model and the prompt version. Changing the prompt therefore only misses the
+entries built with the old prompt, and those age out through the LRU eviction.
+
+The cache lives in a sqlite database in WAL mode. Every thread and every process
+opens its own connection, so many pipeline workers or sharded runner processes
+can read and write the same file at once. The file is only created on the first
+lookup or store, so importing a module that builds a cache leaves no file behind.
+
+The links sent to the manual check file are only remembered for the current
+run (start_run begins a new one), so every run writes its own manual rows.
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+VERDICT_CACHE_FILE = 'verdict_cache.sqlite3'
+DEFAULT_MAX_ENTRIES = 1_000_000
+EVICTION_CHECK_EVERY = 1000  # puts between two eviction checks
+
+
+# helper function to hash the text that is sent to the model
+def content_hash(text):
+    return hashlib.sha256((text or "").encode("utf-8")).hexdigest()
+
+
+# helper function to hash a prompt template into a short version id
+def prompt_version(*templates):
+    return hashlib.sha256("\n".join(templates).encode("utf-8")).hexdigest()[:12]
+
+
+class VerdictCache:
+    """sqlite backed verdict cache that can be shared by threads and processes"""
+
+    def __init__(self, path=VERDICT_CACHE_FILE, max_entries=DEFAULT_MAX_ENTRIES):
+        self.path = os.path.abspath(path)
+        self.max_entries = max_entries
+        self._local = threading.local()
+        self._puts = 0
+        self._manual_checks = set()  # links sent to manual check in this run
+        self._manual_lock = threading.Lock()
+
+    def _connection(self):
+        # one connection per thread and per process, sqlite connections must not cross a fork
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=60)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS verdicts (
+                    key TEXT PRIMARY KEY,
+                    url TEXT NOT NULL,
+                    content_hash TEXT NOT NULL,
+                    location TEXT NOT NULL,
+                    start_date TEXT NOT NULL,
+                    end_date TEXT NOT NULL,
+                    model TEXT NOT NULL,
+                    prompt_version TEXT NOT NULL,
+                    valid INTEGER NOT NULL,
+                    explanation TEXT,
+                    record TEXT,
+                    created_at REAL NOT NULL,
+                    last_used REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS verdicts_last_used ON verdicts(last_used);
+                CREATE INDEX IF NOT EXISTS verdicts_url ON verdicts(url);
+            """)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    @staticmethod
+    def make_key(url, text_hash, location, start, end, model, version):
+        fields = [url, text_hash, location.lower(), start, end, model, version]
+        return hashlib.sha256("\x1f".join(fields).encode("utf-8")).hexdigest()
+
+    def get(self, url, text, location, start, end, model, version):
+        """Return (valid, explanation, record) for a cached verdict, or None on a miss"""
+        key = self.make_key(url, content_hash(text), location, start, end, model, version)
+        conn = self._connection()
+        row = conn.execute("SELECT valid, explanation, record FROM verdicts WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        with conn:
+            conn.execute("UPDATE verdicts SET last_used = ? WHERE key = ?", (time.time(), key))
+        valid, explanation, record = row
+        return bool(valid), explanation, (json.loads(record) if record else None)
+
+    def put(self, url, text, location, start, end, model, version, valid, explanation, record=None, text_hash=None):
+        """
+        Store a verdict, record is an optional json-serialisable dict of structured fields.
+        text_hash can be given instead of text when only the hash was kept (offline batch jobs).
+        """
+        text_hash = text_hash or content_hash(text)
+        key = self.make_key(url, text_hash, location, start, end, model, version)
+        now = time.time()
+        conn = self._connection()
+        with conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO verdicts (key, url, content_hash, location, start_date, end_date, model, "
+                "prompt_version, valid, explanation, record, created_at, last_used) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (key, url, text_hash, location.lower(), start, end, model, version, int(bool(valid)), explanation,
+                 json.dumps(record) if record is not None else None, now, now))
+        self._puts += 1
+        if self._puts % EVICTION_CHECK_EVERY == 0:
+            self.evict()
+
+    def get_for_urls(self, urls, location, start, end, model, versions):
+        """
+        Return (valid, explanation, record) of the most recently used verdict of any of urls
+        for this location and date window, whatever the text was, or None.
+        Used to share a verdict between near-duplicate copies of an article.
+        """
+        urls, versions = list(urls), list(versions)
+        if not urls:
+            return None
+        row = self._connection().execute(
+            f"SELECT valid, explanation, record FROM verdicts WHERE url IN ({','.join('?' * len(urls))}) "
+            f"AND location = ? AND start_date = ? AND end_date = ? AND model = ? "
+            f"AND prompt_version IN ({','.join('?' * len(versions))}) ORDER BY last_used DESC LIMIT 1",
+            urls + [location.lower(), start, end, model] + versions).fetchone()
+        if row is None:
+            return None
+        valid, explanation, record = row
+        return bool(valid), explanation, (json.loads(record) if record else None)
+
+    def evict(self, max_entries=None):
+        """Drop the least recently used verdicts beyond max_entries"""
+        max_entries = self.max_entries if max_entries is None else max_entries
+        conn = self._connection()
+        count = conn.execute("SELECT COUNT(*) FROM verdicts").fetchone()[0]
+        if count <= max_entries:
+            return 0
+        with conn:
+            conn.execute("DELETE FROM verdicts WHERE key IN "
+                         "(SELECT key FROM verdicts ORDER BY last_used LIMIT ?)", (count - max_entries,))
+        return count - max_entries
+
+    def drop_prompt_versions(self, keep_version):
+        """Delete every verdict built with a prompt other than keep_version"""
+        conn = self._connection()
+        with conn:
+            return conn.execute("DELETE FROM verdicts WHERE prompt_version != ?", (keep_version,)).rowcount
+
+    # links whose page could not be parsed and were sent to the manual check file, in this run only
+    def start_run(self):
+        """Forget the links sent to manual check so far, the next run writes them again"""
+        with self._manual_lock:
+            self._manual_checks.clear()
+
+    def is_manual_check(self, url):
+        with self._manual_lock:
+            return url in self._manual_checks
+
+    def mark_manual_check(self, url):
+        """Record url as sent to manual check in this run, returns False if it already was"""
+        with self._manual_lock:
+            if url in self._manual_checks:
+                return False
+            self._manual_checks.add(url)
+            return True